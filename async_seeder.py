@@ -5,10 +5,10 @@ A server that seeds torrents
 '''
 
 # Stdlib
-import asyncio, logging, hashlib, os, sys, math
+import asyncio, collections, logging, os, sys, math, time, signal, gc, itertools
 
 # Project
-import torrent, pwp
+import torrent, pwp, metrics, profiling, piececache, fdpool, catalog, tracker, pex, lifecycle, scheduler, diskio, writeback, merkle, superseed
 
 
 def byte_to_set(byte):
@@ -25,47 +25,138 @@ def bytestring_to_set(bytestring):
 
   return s
 
-# Configure the logger
-logging.basicConfig(
-  level=logging.DEBUG,
-  datefmt='%Y/%m/%d %H:%M:%S',
-  format='%(asctime)s %(name)s %(message)s',
-  filename='server_log.txt'
-)
+# The logger for all connections (configured in main)
+log = logging.getLogger('async_seeder')
+
+# Metrics
+BYTES_RECEIVED = metrics.counter('simpletorrent_bytes_received_total', 'Bytes received from peers, by torrent', ['infohash'])
+BYTES_SENT = metrics.counter('simpletorrent_bytes_sent_total', 'Bytes sent to peers, by torrent', ['infohash'])
+PEER_BYTES_RECEIVED = metrics.counter('simpletorrent_peer_bytes_received_total', 'Bytes received from each connected peer', ['peer'])
+PEER_BYTES_SENT = metrics.counter('simpletorrent_peer_bytes_sent_total', 'Bytes sent to each connected peer', ['peer'])
+MESSAGES_RECEIVED = metrics.counter('simpletorrent_messages_received_total', 'PWP messages received, by type', ['type'])
+CONNECTIONS = metrics.gauge('simpletorrent_connections', 'Open peer connections')
+QUEUE_DEPTH = metrics.gauge('simpletorrent_queued_messages', 'Received messages waiting to be handled')
+CACHE_HITS = metrics.counter('simpletorrent_piece_cache_hits_total', 'Blocks served from the shared piece cache')
+REQUESTS_REJECTED = metrics.counter('simpletorrent_rejected_requests_total', 'Block requests refused because the peer was choked or the block was invalid')
+CACHE_MISSES = metrics.counter('simpletorrent_piece_cache_misses_total', 'Blocks that had to be read from disk into the shared piece cache')
+READ_FAILURES = metrics.counter('simpletorrent_block_read_failures_total', 'Requested blocks that could not be read from disk')
+
+
+# The extensions we support, advertised in our handshake
+RESERVED = pwp.reserved_bits(pwp.FAST_EXTENSION, pwp.EXTENSION_PROTOCOL, pwp.V2)
+
+# Cached pieces suggested to a new peer that supports the Fast Extension
+SUGGEST_COUNT = 8
+
+# Stop serving (and reading from) a peer while this many bytes are
+# buffered for it, and start again once the buffer falls below the low
+# water mark
+WRITE_HIGH_WATER = 2**20
+WRITE_LOW_WATER = 2**18
+
+# The most block reads that a single peer may have in flight at once
+MAX_PENDING_READS = 32
+
+# Stop reading from a peer while this many of its requests and pieces
+# wait for the worker, and start again once half of them are handled. A
+# peer keeping to the request queue we advertise never reaches it.
+MAX_QUEUED_BULK = pwp.DEFAULT_REQQ
+
+# The layers from the piece layer up of the merkle trees of the v2
+# torrents we seed, kept to answer hash requests (see upper_tree)
+MAX_TREES = 16
+TREES = collections.OrderedDict()
+
+# The most hash requests of a single peer being answered at once
+MAX_HASH_REQUESTS = 2
+
+
+def announce_stats(infohash):
+  '''The (uploaded, downloaded, left) byte counts we report to trackers'''
+
+  sent = BYTES_SENT.children.get((infohash.hex(),))
+
+  return (sent.value if sent is not None else 0), 0, 0
+
 
 class PeerWireProtocol(asyncio.Protocol):
   '''Implements the Peer-Wire-Protocol
 
-     Parses incoming PWP messages and places them into a queue.
+     Parses incoming PWP messages and queues them with the scheduler.
   '''
 
-  def __init__(self, peers, files, torrents, seeking=None): 
+  def __init__(self, peers, files, torrents, scheduler, reads, download=None, cache=None, max_unchoked=None, timers=None, rate_limit=None, downloads=None, super_seed=None):
+
+    # Queues our messages for the worker (see scheduler.py)
+    self.scheduler = scheduler
 
-    # The queue in which to place messages
-    self.queue = asyncio.Queue()
+    # Our entry in the peer list (once the handshake is complete)
+    self.peer_info = None
 
     # The peer list
     self.peers = peers
 
-    # The file dictionary
+    # The file pool shared by all connections
     self.files = files
 
+    # Reads blocks off the event loop (see diskio.py)
+    self.reads = reads
+
+    # Block reads requested but not yet sent
+    self.pending_reads = 0
+
+    # The download this connection belongs to, if we are downloading
+    # (see session.py)
+    self.download = download
+
+    # Limits how fast we read, shared with other connections (see
+    # session.RateLimit)
+    self.rate_limit = rate_limit
+
     # The torrents we are serving
     self.torrents = torrents
 
+    # Mapping from infohash to the downloads in progress, whose verified
+    # pieces we also serve (see session.py)
+    self.downloads = downloads
+
+    # The download of the torrent we are serving, if it is incomplete
+    self.partial = None
+
+    # The piece cache shared with the other worker processes (if any)
+    self.cache = cache
+
+    # The most peers we upload to at once (None for no limit)
+    self.max_unchoked = max_unchoked
+
+    # Handshake and idle timeouts for this connection (see lifecycle.py)
+    self.timers = timers
+
+    # Decides which pieces we admit to having, if we are super-seeding
+    # (see superseed.py)
+    self.super_seed = super_seed
+
+    # Are we seeding (rather than downloading) on this connection?
+    self.seeding = download is None
+
+    # Does the peer support the Fast Extension (BEP 6)?
+    self.fast = False
+
+    # Does the peer support the extension protocol (BEP 10)?
+    self.extended = False
+
+    # Does the peer support BitTorrent v2 hash requests (BEP 52)?
+    self.v2 = False
+
     self.torr = None
 
     # Torrent identifier
     self.infohash = None
 
-    # The pieces we are missing
-    self.pieces = None
-
     # Are we seeking a particular torrent?
-    if seeking is not None:
-      self.torr = seeking
-      self.infohash = torrent.infohash(seeking)
-      self.pieces = dict()
+    if download is not None:
+      self.torr = download.torr
+      self.infohash = download.infohash
 
     # The message parser for this connection
     self.parser = pwp.MessageParser()
@@ -73,9 +164,25 @@ class PeerWireProtocol(asyncio.Protocol):
     # TODO: Change this
     self.peer_id = b'1'*20
 
+    # Per-torrent byte counters (known once we have the infohash)
+    self.torr_received = None
+    self.torr_sent = None
+
     # The function used to handle messages
     self.handler = self._infohash_handler
 
+    # Is the connection being closed because its torrent was removed?
+    self.draining = False
+
+    # Is the transport's write buffer full?
+    self.writing_paused = False
+
+    # Are we waiting for the download rate to allow more reads?
+    self.throttled = False
+
+    # Are too many of the peer's messages waiting for the worker?
+    self.backlogged = False
+
 
   def _infohash_handler(self):
     '''Handles the reception of the infohash'''
@@ -84,44 +191,65 @@ class PeerWireProtocol(asyncio.Protocol):
 
       msg = self.parser.next()
 
+      # Extensions may be used if both sides advertise them
+      self.fast = pwp.supports(self.parser.reserved, pwp.FAST_EXTENSION)
+      self.extended = pwp.supports(self.parser.reserved, pwp.EXTENSION_PROTOCOL)
+      self.v2 = pwp.supports(self.parser.reserved, pwp.V2)
+
       if self.infohash is None:
-        self.infohash = msg['payload']
+        self.infohash = msg.payload
+
+        if self.downloads is not None:
+          self.partial = self.downloads.get(self.infohash)
+
+        # The metainfo for the file we are serving (read from disk if the
+        # catalog is lazy and no one has asked for it recently)
+        self.torr = self.partial.torr if self.partial is not None else self.torrents.get(self.infohash)
 
         # Check that we have the file specified by the infohash
-        if self.infohash not in self.torrents:
-          self.log.debug('requested unknown torrent: {}'.format(self.infohash.hex()))
-          transport.close()
+        if self.torr is None:
+          log.debug('%s requested unknown torrent: %s', self.peer_label, self.infohash.hex())
+          self.transport.close()
           return
-
-        # The metainfo for the file we are serving
-        self.torr = self.torrents[self.infohash]
+        self._count_torrent()
 
         # Send our handshake
-        self.transport.write(pwp.create_handshake(self.infohash, self.peer_id))
+        self.send(pwp.create_handshake(self.infohash, self.peer_id, reserved=RESERVED))
 
       else:
         # Check that the response shake has the same infohash
-        if self.infohash != msg['payload']:
-          self.log.debug('response handshake had incorrect infohash')
+        if self.infohash != msg.payload:
+          log.debug('%s response handshake had incorrect infohash', self.peer_label)
           self.transport.close()
           return
 
       # Details about pieces and blocks for this torrent
-      self.blocks_expected = int(math.ceil(self.torr['info']['length'] / 2**14))
-      self.pieces_expected = int(math.ceil(self.torr['info']['length'] / self.torr['info']['piece length']))
+      self.blocks_expected = int(math.ceil(torrent.length(self.torr) / 2**14))
+      self.pieces_expected = int(math.ceil(torrent.length(self.torr) / self.torr['info']['piece length']))
       self.blocks_per_piece = int(self.torr['info']['piece length'] / 2**14)
       self.blocks_in_last_piece = self.blocks_expected % self.blocks_per_piece
 
-      if self.pieces is not None:
-        self.pieces = { i : set() for i in range(self.pieces_expected) }
-      else:
-        self.pieces = dict()
+      # A bitfield may be longer than any piece message
+      self.parser.max_length = pwp.max_message_length(self.pieces_expected)
+
+      # The file is opened by the pool when it is first read or written
+      self.path = 'files/' + self.torr['info']['name']
+
+      # Tell the peer we have every piece, or the pieces we have verified
+      if self.partial is not None:
+        self.send(pwp.have_none() if self.fast and not self.partial.verified else pwp.bitfield(self.partial.verified, self.pieces_expected))
 
-      # Open the file if necessary
-      if self.infohash not in self.files:
-        self.files[self.infohash] = open('files/' + self.torr['info']['name'], 'rb' if len(self.pieces)==0 else 'wb+')
+      # A super-seed admits to its pieces one at a time
+      elif self.seeding and self.super_seed is not None:
+        if self.fast:
+          self.send(pwp.have_none())
 
-      self.file = self.files[self.infohash]
+      elif self.seeding:
+        self.send(pwp.have_all() if self.fast else pwp.full_bitfield(self.pieces_expected))
+
+      # Offer the extensions we support (and the port we listen on)
+      if self.extended:
+        self.send(pwp.extension_handshake(pex.EXTENSIONS, self.sockname[1] if self.seeding else None))
 
       # Advance the handler
       self.handler = self._peer_id_handler
@@ -137,19 +265,31 @@ class PeerWireProtocol(asyncio.Protocol):
 
       msg = self.parser.next()
 
-      peer_id = msg['payload']
+      peer_id = msg.payload
 
       peer_info = {'infohash': self.infohash, 'peer_id': peer_id,
-        'transport': self.transport, 'queue': self.queue,
+        'transport': self.transport, 'protocol': self,
         'peer_choking': True, 'am_choking': True,
         'peer_interested': False, 'am_interested': False,
-        'peer_has': set(), 'torr': self.torr, 'file': self.file,
+        'peer_has': set(), 'torr': self.torr, 'files': self.files, 'path': self.path,
         'blocks_expected': self.blocks_expected, 'pieces_expected': self.pieces_expected,
         'blocks_per_piece': self.blocks_per_piece, 'blocks_in_last_piece': self.blocks_in_last_piece,
-        'pieces': self.pieces}
+        'download': self.download, 'partial': self.partial, 'cache': self.cache, 'reads': self.reads, 'fast': self.fast,
+        'allowed_fast': set(), 'peer_allowed_fast': set(), 'rejected': set(),
+        'listen': None if self.seeding else self.peername[:2], 'pex_id': None, 'pex_sent': set(), 'hash_requests': 0,
+        'super_seed': self.super_seed, 'offered': set(), 'advertised': set()}
 
       # Add this peer to the list
+      self.scheduler.add(peer_info)
       self.peers.append(peer_info)
+      self.peer_info = peer_info
+
+      # The connection is no longer half-open
+      if self.timers is not None:
+        self.timers.established(self)
+
+      if self.seeding:
+        self._start_seeding(peer_info)
 
       # We are now ready to handle normal PWP messages
       self.handler = self._message_handler
@@ -158,63 +298,187 @@ class PeerWireProtocol(asyncio.Protocol):
       self.handler()
 
 
-  # TODO: Move these checks to the MessageParser
-  def _bitfield_handler(self):
+  def _start_seeding(self, peer):
+    '''Suggest cached pieces, then unchoke the peer if there is a free
+       upload slot, or give it an allowed fast set if not'''
 
-    # Check for a bitfield message
-    if msg_id == 5:
+    if self.fast and self.cache is not None and self.super_seed is None:
+      for index in self.cache.pieces(self.infohash, SUGGEST_COUNT):
+        self.send(pwp.suggest_piece(index))
 
-      # Check the bitfield length
-      if len(msg['payload']) != int(math.ceil(num_pieces / 8)):
-        print('Received invalid bitfield from {}:{} (wrong length)'.format(peer_info[0], peer_info[1]))
-        transport.close()
-        return
+    if self.max_unchoked is None or unchoked_count(self.peers) < self.max_unchoked:
+      unchoke(peer)
 
-      peer_has = bytestring_to_set(msg['payload'])
+    elif self.fast:
+      peer['allowed_fast'] = set(pwp.allowed_fast_set(self.peername[0], self.infohash, self.pieces_expected))
 
-      # Check if any invalid bits were set
-      if max(peer_has) >= num_pieces:
-        print('Received invalid bitfield from {}:{} (extra bits were set)'.format(peer_info[0], peer_info[1]))
-        transport.close()
-        return
+      for index in peer['allowed_fast']:
+        self.send(pwp.allowed_fast(index))
+
+    if self.super_seed is not None:
+      self.super_seed.joined(peer)
 
 
   def _message_handler(self):
     '''Handles normal PWP messages'''
 
-    # Put all new messages into queue
+    # Queue all new messages
     for msg in self.parser:
-      self.queue.put_nowait(msg)
+      self.scheduler.push(self.peer_info, msg)
+
+    # Wait for the worker to catch up before reading more
+    if not self.backlogged and self.scheduler.bulk_waiting(self.peer_info) >= MAX_QUEUED_BULK:
+      self.backlog()
+
+
+  def _count_torrent(self):
+    '''Start counting bytes against our torrent'''
+
+    self.torr_received = BYTES_RECEIVED.labels(self.infohash.hex())
+    self.torr_sent = BYTES_SENT.labels(self.infohash.hex())
+
+
+  def send(self, data):
+    '''Send data to the peer'''
+
+    self.transport.write(data)
+
+    self.peer_sent.inc(len(data))
+    if self.torr_sent is not None:
+      self.torr_sent.inc(len(data))
+
+    if self.timers is not None:
+      self.timers.sent(self)
+
+
+  def drain(self):
+    '''Stop reading from the peer, and close the connection once the
+       messages already received have been handled (see worker)'''
+
+    if not self.writing_paused and not self.throttled and not self.backlogged:
+      self.transport.pause_reading()
+
+    self.draining = True
+
+
+  def pause_writing(self):
+    '''Called when the write buffer reaches the high water mark
+
+       The worker stops handling the peer's requests, and we stop reading
+       more of them, until the buffer drains.
+    '''
+
+    if not self.draining and not self.throttled and not self.backlogged:
+      self.transport.pause_reading()
+
+    self.writing_paused = True
+
+
+  def blocked(self):
+    '''Should the worker leave the peer's requests alone for now? (its
+       write buffer is full, or it has too many reads in flight)'''
+
+    return (self.writing_paused or self.pending_reads >= MAX_PENDING_READS) and not self.transport.is_closing()
+
+
+  def resume_writing(self):
+    '''Called when the write buffer falls below the low water mark'''
+
+    if not self.draining and not self.throttled and not self.backlogged:
+      self.transport.resume_reading()
+
+    self.writing_paused = False
+
+
+  def throttle(self):
+    '''Stop reading until the download rate allows (see session.RateLimit)'''
+
+    if not self.draining and not self.writing_paused and not self.backlogged:
+      self.transport.pause_reading()
+
+    self.throttled = True
+
+
+  def unthrottle(self):
+    if not self.draining and not self.writing_paused and not self.backlogged and not self.transport.is_closing():
+      self.transport.resume_reading()
+
+    self.throttled = False
+
+
+  def backlog(self):
+    '''Stop reading until the worker has handled more of the peer's
+       messages (see worker)'''
+
+    if not self.draining and not self.writing_paused and not self.throttled:
+      self.transport.pause_reading()
+
+    self.backlogged = True
+
+
+  def unbacklog(self):
+    if not self.draining and not self.writing_paused and not self.throttled and not self.transport.is_closing():
+      self.transport.resume_reading()
+
+    self.backlogged = False
 
 
   def connection_made(self, transport):
     '''Called when a connection is established'''
 
     self.transport = transport
+    self.transport.set_write_buffer_limits(high=WRITE_HIGH_WATER, low=WRITE_LOW_WATER)
     self.peername = transport.get_extra_info('peername')
+    self.sockname = transport.get_extra_info('sockname')
+    self.peer_label = '{}:{}'.format(*self.peername)
+
+    # Per-peer byte counters
+    self.peer_received = PEER_BYTES_RECEIVED.labels(self.peer_label)
+    self.peer_sent = PEER_BYTES_SENT.labels(self.peer_label)
 
-    # Set the logger for this connection
-    self.log = logging.getLogger('{}:{}'.format(*self.peername))
+    CONNECTIONS.inc()
 
-    self.log.debug('connection made')
+    log.debug('%s connection made', self.peer_label)
+
+    # Refuse the connection if too many others are mid-handshake
+    if self.timers is not None and not self.timers.opened(self):
+      log.debug('%s refused: too many half-open connections', self.peer_label)
+      transport.close()
+      return
 
     # Initiate the handshake, if necessary
-    if self.torr is not None:
-      self.transport.write(pwp.create_handshake(self.infohash, self.peer_id))
+    if self.download is not None:
+      self._count_torrent()
+
+      self.send(pwp.create_handshake(self.infohash, self.peer_id, reserved=RESERVED))
 
-      # TODO: Send our bitfield
+      # Tell the peer which pieces we have already
+      if self.download.verified:
+        self.send(pwp.bitfield(self.download.verified, self.download.num_pieces))
 
-      # Request the entire file
-      self.transport.write(pwp.request_all(self.torr['info']['length']))
+      # Request the first pieces the download gives us
+      self.download.joined(self)
 
 
   def connection_lost(self, exc):
     '''Called when the connection is lost'''
 
-    # Put the connection closed message in the queue
-    self.queue.put_nowait({'id': -2, 'name': 'closed', 'payload': None})
+    # Queue the connection closed message (once the peer is listed)
+    if self.peer_info is not None:
+      self.scheduler.push(self.peer_info, pwp.CLOSED_MESSAGE)
+
+    log.debug('%s connection lost', self.peer_label)
+
+    # Let other connections download our pieces
+    if self.download is not None:
+      self.download.left(self)
+
+    if self.timers is not None:
+      self.timers.closed(self)
 
-    self.log.debug('connection lost')
+    CONNECTIONS.dec()
+    PEER_BYTES_RECEIVED.remove(self.peer_label)
+    PEER_BYTES_SENT.remove(self.peer_label)
 
     super().connection_lost(exc)
 
@@ -222,168 +486,649 @@ class PeerWireProtocol(asyncio.Protocol):
   def data_received(self, data):
     '''Called when a socket receives data'''
 
+    timed = profiling.spans
+    if timed:
+      started = time.perf_counter()
+
+    self.peer_received.inc(len(data))
+    if self.torr_received is not None:
+      self.torr_received.inc(len(data))
+
+    if self.timers is not None:
+      self.timers.received(self)
+
+    if self.rate_limit is not None:
+      self.rate_limit.consume(self, len(data))
+
     # Add the data to the message buffer
     self.parser.add(data)
 
     # Handle the messages
     self.handler()
 
+    if timed:
+      profiling.record('data_received', started)
 
-async def worker(peers, n=10, sleep=0.001):
-  '''Fairly handle peer messages
 
-  All connected peers are served at the same rate. When there is
-  no work to do, this worker sleeps for the specified amount of time.
+def unchoke(peer):
+  '''Let a peer request any piece'''
 
-  '''
+  peer['am_choking'] = False
+  peer['protocol'].send(pwp.unchoke())
+
+
+def unchoked_count(peers):
+  '''The number of peers we are uploading to'''
+  return sum(1 for peer in peers if not peer['am_choking'])
+
+
+def unchoke_waiting(peers):
+  '''Give free upload slots to the peers that have waited longest'''
+
+  seeding = [peer for peer in peers if peer['protocol'].seeding and not peer['protocol'].draining]
+
+  if not seeding:
+    return
+
+  max_unchoked = seeding[0]['protocol'].max_unchoked
+  unchoked = unchoked_count(seeding)
+
+  for peer in seeding:
+    if max_unchoked is not None and unchoked >= max_unchoked:
+      break
+
+    if peer['am_choking']:
+      unchoke(peer)
+      unchoked += 1
+
+
+def rerequest(peer, index=None):
+  '''Request again the blocks the peer rejected (only those of the
+     given piece, if one is given)'''
+
+  blocks = { block for block in peer['rejected'] if index is None or block[0] == index }
+
+  if blocks:
+    peer['rejected'] -= blocks
+    peer['protocol'].send(b''.join(pwp.request(*block) for block in sorted(blocks)))
+
+
+def handle_extended(peer, ext):
+  '''Handle an extension protocol message'''
+
+  try:
+    if ext.id == 0:
+      handshake = pwp.parse_extension_handshake(ext.data)
+
+      # The message id the peer wants for ut_pex (0 disables it)
+      peer['pex_id'] = handshake['m'].get('ut_pex') or None
+
+      # Peers that connected to us can be advertised once we know the
+      # port they listen on
+      if isinstance(handshake.get('p'), int) and 0 < handshake['p'] < 65536:
+        peer['listen'] = (peer['protocol'].peername[0], handshake['p'])
+
+      # Tell the peer about its swarm straight away
+      if peer['pex_id'] is not None:
+        for _, msg in pex.updates(peer['protocol'].peers, only=peer):
+          peer['protocol'].send(msg)
 
-  # Closed connections to be cleaned up
-  closed = set()
+    elif ext.id == pex.UT_PEX:
+      added, dropped = pex.parse(ext.data)
+
+      # A download connects to the peers it is told about
+      download = peer['download'] or peer['partial']
+
+      if download is not None:
+        download.exchanged(added, dropped)
+
+  except Exception as e:
+    log.debug('%s sent an invalid extension message: %s', peer['protocol'].peer_label, e)
+    peer['transport'].close()
+
+
+async def exchange_peers(peers, interval=pex.INTERVAL):
+  '''Send every peer that supports ut_pex the changes to its swarm'''
 
   while True:
+    await asyncio.sleep(interval)
 
-    # Was there any work to do?
-    worked = False
+    for peer, msg in pex.updates([peer for peer in peers if not peer['protocol'].draining]):
+      peer['protocol'].send(msg)
+
+
+async def expire_timers(timers, tick=lifecycle.TICK):
+  '''Advance the connection lifecycle timers'''
+
+  while True:
+    await asyncio.sleep(tick)
+    timers.expire()
+
+
+def read_block(peer, index, begin, length, callback):
+  '''Read a block from the peer's torrent, then call callback(block)
+     (with None if the read failed)
+
+  With a shared piece cache, the whole piece is read on a miss so that
+  this and every other worker can serve its remaining blocks from memory.
+  Pieces of a download that are not written yet are served from its
+  write-back cache.
+  '''
+
+  if peer['partial'] is not None:
+    piece = peer['partial'].writes.get(index)
+
+    if piece is not None:
+      callback(piece[begin : begin + length])
+      return
+
+  cache = peer['cache']
+
+  if cache is not None:
+    block = cache.get(peer['infohash'], index, begin, length)
+
+    if block is not None:
+      CACHE_HITS.inc()
+      callback(block)
+      return
+
+    CACHE_MISSES.inc()
+
+  piece_len = peer['torr']['info']['piece length']
+  piece_end = min((index + 1) * piece_len, torrent.length(peer['torr']))
+
+  if cache is not None and piece_len <= cache.slot_size:
+
+    def piece_read(piece):
+      if piece is not None and cache.get(peer['infohash'], index, 0, 0) is None:
+        cache.put(peer['infohash'], index, piece)
+
+      callback(None if piece is None else piece[begin : begin + length])
+
+    peer['reads'].read(peer['path'], index * piece_len, piece_end - index * piece_len, piece_read)
+
+  else:
+    peer['reads'].read(peer['path'], index * piece_len + begin, length, callback, readahead_to=piece_end)
+
+
+def handle_choke(peer, payload):
+  peer['peer_choking'] = True
+
+
+def handle_unchoke(peer, payload):
+  peer['peer_choking'] = False
+
+  # Blocks rejected while we were choked can be requested again
+  rerequest(peer)
+
+
+def handle_interested(peer, payload):
+  peer['peer_interested'] = True
+
+
+def handle_uninterested(peer, payload):
+  peer['peer_interested'] = False
+
+
+def record_pieces(peer, pieces):
+  '''Record pieces the peer told us it has'''
+
+  new = set(pieces) - peer['peer_has']
+  peer['peer_has'].update(new)
 
-    for i, peer in enumerate(peers):
+  # A super-seed offers the next piece once the last is passed on
+  if new and peer['super_seed'] is not None:
+    peer['super_seed'].have(peer, new)
 
-      # Handle up to n messages per peer
-      for _ in range(n):
+  # The download may request the pieces from the peer
+  if new and peer['download'] is not None:
+    peer['download'].announced(peer['protocol'], new)
 
-        if peer['queue'].empty():
-          break
 
-        # Get the next message for this peer
-        msg = peer['queue'].get_nowait()
-        peer['queue'].task_done()
-        worked = True
+def handle_have(peer, index):
 
-        if msg['id'] == -1:
-          pass   # Keep-alive
-        elif msg['id'] == -2:
-          closed.add(i)
-        elif msg['id'] == 0:
-          peer['am_choking'] = True
-        elif msg['id'] == 1:
-          peer['peer_choking'] = False
-        elif msg['id'] == 2:
-          peer['am_interested'] = True
-        elif msg['id'] == 3:
-          peer['peer_interested'] = False
-        elif msg['id'] == 4:
-          peer['peer_has'].add(msg['payload'])
-        elif msg['id'] == 5:
-          peer['peer_has'].update(byteset_to_set(msg['payload']))
-        elif msg['id'] == 6:
+  if not 0 <= index < peer['pieces_expected']:
+    log.debug('%s sent an invalid have: %d', peer['protocol'].peer_label, index)
+    peer['transport'].close()
+    return
 
-          piece_len = peer['torr']['info']['piece length']
+  record_pieces(peer, (index,))
 
-          # Compute the byte-offset of this block within the file
-          offset = (msg['payload']['index'] * piece_len) + msg['payload']['begin']
 
-          # Check that the block is valid
-          if offset + msg['payload']['length'] > peer['torr']['info']['length']:
-            print('requested invalid block (overflow)')
-            continue
+def handle_bitfield(peer, payload):
+  '''Record the peer's pieces, closing the connection if the bitfield is
+     the wrong length or has bits set past the last piece'''
 
-          peer['file'].seek(offset)
+  num_pieces = peer['pieces_expected']
 
-          # Read the requested block
-          block = peer['file'].read(msg['payload']['length'])
+  if len(payload) != (num_pieces + 7) // 8:
+    log.debug('%s sent an invalid bitfield (wrong length)', peer['protocol'].peer_label)
+    peer['transport'].close()
+    return
 
-          # Send the requested block
-          peer['transport'].write(pwp.piece(msg['payload']['index'], msg['payload']['begin'], block))
+  pieces = bytestring_to_set(payload)
 
-        elif msg['id'] == 7:
+  if pieces and max(pieces) >= num_pieces:
+    log.debug('%s sent an invalid bitfield (extra bits were set)', peer['protocol'].peer_label)
+    peer['transport'].close()
+    return
 
-          print('received piece')
+  record_pieces(peer, pieces)
 
-          index = msg['payload']['index']
 
-          # We don't need this block
-          if index not in peer['pieces']:
-            continue
+def handle_have_all(peer, payload):
+  record_pieces(peer, range(peer['pieces_expected']))
 
-          # Add the block to our collection
-          peer['pieces'][index].add((msg['payload']['begin'], msg['payload']['block']))
 
-          # Assemble the piece if all blocks have arrived
-          if (index == peer['pieces_expected']-1 and len(peer['pieces'][index]) == peer['blocks_in_last_piece']) or len(peer['pieces'][index]) == peer['blocks_per_piece']:
+def handle_have_none(peer, payload):
+  peer['peer_has'] = set()
 
-            offset = index * peer['torr']['info']['piece length']
-            assembled = b''.join(block[1] for block in sorted(peer['pieces'][index]))
 
-            # If the piece is valid...
-            if hashlib.sha1(assembled).digest() == peer['torr']['info']['pieces'][20 * index: 20 * (index+1)]:
+def handle_request(peer, block):
+  '''Send the requested block, or reject the request'''
 
-              # Save the piece to disk
-              peer['file'].seek(offset)
-              peer['file'].write(assembled)
+  index, begin, length = block
 
-              # This piece is no longer needed
-              del peer['pieces'][index]
+  piece_len = peer['torr']['info']['piece length']
 
-              # Send 'have' message to peer
-              peer['transport'].write(pwp.have(index))
-            else:
+  # Compute the byte-offset of this block within the file
+  offset = (index * piece_len) + begin
 
-              # Discard all blocks of the invalid piece
-              pieces[index] = set()
+  # Choked peers may only request their allowed fast pieces, the block
+  # must be inside the file, and we must have verified its piece (and
+  # offered it to the peer, if we are super-seeding). Peers
+  # with the Fast Extension are told, so they can request elsewhere
+  # without waiting for a timeout.
+  choked = peer['am_choking'] and index not in peer['allowed_fast']
+  missing = (peer['partial'] is not None and index not in peer['partial'].verified) or (peer['super_seed'] is not None and index not in peer['advertised'])
 
-              # Re-request the invalid piece
-              peer['transport'].write(pwp.request_piece(index, peer['torr']['info']['length'], peer['torr']['info']['piece length']))
+  if choked or missing or offset + length > torrent.length(peer['torr']):
+    if not choked and not missing:
+      log.debug('%s requested an invalid block (overflow): %d %d %d', peer['protocol'].peer_label, index, begin, length)
+
+    if peer['fast']:
+      REQUESTS_REJECTED.inc()
+      peer['protocol'].send(pwp.reject_request(index, begin, length))
+
+    return
+
+  protocol = peer['protocol']
+
+  def block_read(data):
+    protocol.pending_reads -= 1
+
+    # The peer left while we were reading
+    if protocol.transport.is_closing():
+      return
+
+    # The block could not be read (or the file is shorter than it should
+    # be). Peers with the Fast Extension are told; others would wait for
+    # it forever, so they are dropped.
+    if data is None or len(data) != length:
+      READ_FAILURES.inc()
+      log.warning('%s: could not read block %d %d %d of %s', protocol.peer_label, index, begin, length, peer['path'])
+
+      if peer['fast']:
+        protocol.send(pwp.reject_request(index, begin, length))
+      else:
+        protocol.transport.close()
+
+      return
+
+    # Send the requested block
+    protocol.send(pwp.piece(index, begin, data))
+
+  # Read the requested block off the event loop
+  protocol.pending_reads += 1
+  read_block(peer, index, begin, length, block_read)
+
+
+def handle_reject(peer, block):
+  peer['rejected'].add(block)
+
+
+def handle_allowed_fast(peer, index):
+  peer['peer_allowed_fast'].add(index)
+
+  # Rejected blocks of an allowed fast piece can be requested right away
+  rerequest(peer, index)
+
+
+def handle_piece(peer, piece):
+  '''Store a received block, and hand its piece to the download (to be
+     verified and saved) once every block has arrived'''
+
+  index = piece.index
+  download = peer['download']
+
+  # We did not ask this peer for the block (or no longer do)
+  if download is None or peer['protocol'] not in download.owners.get(index, ()):
+    return
+
+  # Only the blocks we request make up a piece
+  if (piece.begin, len(piece.block)) not in pwp.piece_blocks(index, download.length, download.piece_length):
+    log.debug('%s sent an invalid block: %d %d %d', peer['protocol'].peer_label, index, piece.begin, len(piece.block))
+    peer['transport'].close()
+    return
+
+  # Add the block to our collection (a piece requested from two peers
+  # gets each block from whichever sends it first)
+  blocks = download.pieces[index]
+  blocks.setdefault(piece.begin, piece.block)
+
+  # Assemble the piece if all blocks have arrived
+  if (index == peer['pieces_expected']-1 and len(blocks) == peer['blocks_in_last_piece']) or len(blocks) == peer['blocks_per_piece']:
+    download.completed(peer['protocol'], index, b''.join(blocks[begin] for begin in sorted(blocks)))
+
+
+def upper_tree(peer):
+  '''A future for the layers of the merkle tree of the peer's (v2)
+     torrent from the piece layer up, built from the torrent's piece
+     layer on a disk thread when first needed. The piece layer is not
+     covered by the infohash, so the tree is None if it does not match
+     the pieces root.'''
+
+  infohash = peer['infohash']
+  upper = TREES.get(infohash)
+
+  if upper is not None:
+    TREES.move_to_end(infohash)
+    return upper
+
+  torr = peer['torr']
+
+  def build():
+    upper = merkle.upper_layers(torrent.piece_layer(torr), torrent.length(torr), torr['info']['piece length'])
+    return upper if upper[-1][0] == torrent.pieces_root(torr) else None
+
+  upper = TREES[infohash] = asyncio.get_event_loop().run_in_executor(peer['reads'].pool, build)
+
+  if len(TREES) > MAX_TREES:
+    TREES.popitem(last=False)
+
+  # Try again next time if the tree could not be built
+  def built(future):
+    if future.exception() is not None and TREES.get(infohash) is future:
+      del TREES[infohash]
+
+  upper.add_done_callback(built)
+
+  return upper
+
+
+def piece_tree(data, width, expected):
+  '''Every layer of the merkle tree of a piece, or None if its root is
+     not the expected piece hash'''
+
+  lower = merkle.layers(merkle.block_hashes(data), width)
+  return lower if lower[-1][0] == expected else None
+
+
+def handle_hash_request(peer, request):
+  '''Send hashes from the merkle tree of a v2 torrent we seed
+
+  The layers from the piece layer up are taken from the torrent. Hashes
+  below it must be of a single piece we have verified (and offered, if
+  we are super-seeding), and are hashed from that piece alone.
+  '''
+
+  protocol = peer['protocol']
+
+  def answer(hashes):
+    peer['hash_requests'] -= 1
+
+    if peer['transport'].is_closing():
+      return
+
+    if hashes is None:
+      protocol.send(pwp.hash_reject(*request))
+    else:
+      protocol.send(pwp.hashes(*request, hashes))
+
+  if (not protocol.seeding or peer['hash_requests'] >= MAX_HASH_REQUESTS or not torrent.is_v2(peer['torr'])
+    or request.root != torrent.pieces_root(peer['torr'])):
+    protocol.send(pwp.hash_reject(*request))
+    return
+
+  peer['hash_requests'] += 1
+
+  length = torrent.length(peer['torr'])
+  piece_length = peer['torr']['info']['piece length']
+
+  width = merkle.piece_width(length, piece_length)
+  height = merkle.log2(width)
+
+  def upper_built(future):
+    upper = future.result() if future.exception() is None else None
+
+    if upper is None or not merkle.valid_request(upper, height, request.base, request.index, request.length):
+      answer(None)
+      return
+
+    if request.base >= height:
+      answer(merkle.hashes(upper, height, None, *request[1:]))
+      return
+
+    index = merkle.request_piece(height, request.base, request.index)
+    missing = (peer['partial'] is not None and index not in peer['partial'].verified) or (peer['super_seed'] is not None and index not in peer['advertised'])
+
+    if missing or index * piece_length >= length:
+      answer(None)
+      return
+
+    def piece_read(data):
+      if data is None:
+        answer(None)
+        return
+
+      # The piece must still match the torrent
+      hashed = asyncio.get_event_loop().run_in_executor(peer['reads'].pool, piece_tree, data, width, upper[0][index])
+      hashed.add_done_callback(piece_hashed)
+
+    def piece_hashed(future):
+      lower = future.result() if future.exception() is None else None
+      answer(None if lower is None else merkle.hashes(upper, height, lower, *request[1:]))
+
+    read_block(peer, index, 0, min(piece_length, length - index * piece_length), piece_read)
+
+  upper_tree(peer).add_done_callback(upper_built)
+
+
+def handle_hashes(peer, hashes):
+  if peer['download'] is not None:
+    peer['download'].hashes_received(peer['protocol'], hashes)
+
+
+def handle_hash_reject(peer, request):
+  if peer['download'] is not None:
+    peer['download'].hashes_rejected(peer['protocol'], request)
+
+
+# The handler for each message id. Messages without one (keep-alives,
+# cancels, ports and suggestions) are ignored.
+HANDLERS = {0: handle_choke, 1: handle_unchoke, 2: handle_interested, 3: handle_uninterested,
+  4: handle_have, 5: handle_bitfield, 6: handle_request, 7: handle_piece, 14: handle_have_all,
+  15: handle_have_none, 16: handle_reject, 17: handle_allowed_fast, 20: handle_extended,
+  21: handle_hash_request, 22: handle_hashes, 23: handle_hash_reject}
+
+
+async def worker(peers, queues, reads, sleep=0.001):
+  '''Handle peer messages
+
+  Every round handles all waiting control messages, then the bulk
+  messages the scheduler picks (see scheduler.py), then issues the disk
+  reads they asked for (see diskio.py), and then lets the event loop run
+  so that new control messages are seen promptly. When there is no work
+  to do, this worker sleeps for the specified amount of time.
+
+  '''
+
+  while True:
+
+    # Connections closed this round
+    closed = []
+
+    # Was there any work to do?
+    worked = False
+
+    for peer, msg in itertools.chain(queues.control_messages(), queues.round()):
+      worked = True
+
+      if msg.id == pwp.CLOSED:
+        closed.append(peer)
+        continue
+
+      MESSAGES_RECEIVED.labels(msg.name).inc()
+
+      timed = profiling.spans
+      if timed:
+        started = time.perf_counter()
+
+      # Handle the message
+      handler = HANDLERS.get(msg.id)
+      if handler is not None:
+        handler(peer, msg.payload)
+
+      if timed:
+        profiling.record('dispatch', started)
+
+    # Read the blocks requested this round, merging neighbouring reads
+    reads.flush()
+
+    # Close draining connections once their messages are handled and
+    # their blocks sent, and read again from peers we have caught up with
+    for peer in peers:
+      if peer['protocol'].backlogged and queues.bulk_waiting(peer) <= MAX_QUEUED_BULK // 2:
+        peer['protocol'].unbacklog()
+
+      if peer['protocol'].draining and not queues.pending(peer) and not peer['protocol'].pending_reads and not peer['transport'].is_closing():
+        peer['transport'].close()
 
     # Clear data for all closed connections
-    for i in closed:
-      del peers[i]['queue']
-      del peers[i]
+    for peer in closed:
+      peers.remove(peer)
+
+      if peer['super_seed'] is not None:
+        peer['super_seed'].left(peer)
 
-    closed = set()
+    # Hand the upload slots of closed peers to waiting ones
+    if closed:
+      unchoke_waiting(peers)
 
     # Sleep if no work was done (this allows other coroutines to run)
-    if not worked:
-      await asyncio.sleep(sleep)
+    await asyncio.sleep(0 if worked else sleep)
 
 
-def start(port, my_peer_id):
-  '''Start the server on the given port'''
+def worker_address(address, i):
+  '''The metrics address of the i-th worker process'''
 
-  # A dictionary of all the infohashes we are seeding
-  torrs = dict()
+  if isinstance(address, str):
+    return '{}.{}'.format(address, i)
 
-  # Get infohash of all files in the torrents/ directory
-  for (dirpath, dirnames, filenames) in os.walk('torrents'):
-    for filename in filenames:
-      if filename[0] != '.':
-        torr_info = torrent.read_torrent_file(dirpath + '/' + filename)
-        torrs[torrent.infohash(torr_info)] = torr_info
+  return (address[0], address[1] + i)
 
-  # Display the torrents we are serving
-  print('Serving...\n' + '\n'.join(ihash.hex() + ' ' + torr['info']['name'] for ihash, torr in torrs.items()), end='\n\n')
+
+def serve(port, torrs, host=None, metrics_address=None, profile_dir='.', cache=None, reuse_port=False, max_open_files=1024, peer_id=b'1'*20, announce=True, max_unchoked=None, weights=None, peer_weights=None, disk_threads=4, super_seed=False):
+  '''Serve the given torrents in this process until interrupted
+
+  If announce is set, torrents with an announce URL are kept announced
+  to their trackers. At most max_unchoked peers are uploaded to at once
+  (see PeerWireProtocol._start_seeding). Uploads are shared between
+  torrents and peers by the given weights (see scheduler.Scheduler).
+  Blocks are read by disk_threads threads (see diskio.ReadEngine). With
+  super_seed, peers are only told about pieces one at a time (see
+  superseed.py).
+  '''
 
   # The event loop
-  loop = asyncio.get_event_loop()
+  loop = asyncio.new_event_loop()
+  asyncio.set_event_loop(loop)
 
   # List of all peers to which we are connected
   peers = []
 
-  # Mapping from infohash to file-object
-  files = dict()
+  # The messages received from every peer
+  queues = scheduler.Scheduler(weights, peer_weights)
+
+  # The files we are serving
+  files = fdpool.FilePool(max_open_files)
+
+  # Reads blocks on a thread pool
+  reads = diskio.ReadEngine(loop, files, disk_threads)
+
+  QUEUE_DEPTH.set_function(lambda: len(queues))
+
+  # Profiling that can be switched on while running (see profiling.py)
+  profiler = profiling.Profiler(profile_dir, connections=CONNECTIONS.get)
+  profiler.install()
+
+  if metrics_address is not None:
+    metrics.serve(metrics_address, routes=profiler.routes())
+
+  # Keeps our torrents announced to their trackers
+  announcer = tracker.Announcer(peer_id, port, announce_stats) if announce else None
+
+  if announcer is not None:
+    for ihash, url in torrs.announces.items():
+      announcer.add(ihash, url)
+
+    announcing = loop.create_task(announcer.run())
+
+  def on_change(added, removed):
+    # Let peers of removed torrents finish their outstanding requests
+    for peer in peers:
+      if peer['infohash'] in removed:
+        peer['protocol'].drain()
+
+    if announcer is not None:
+      for ihash in added:
+        if ihash in torrs.announces:
+          announcer.add(ihash, torrs.announces[ihash])
+
+      for ihash in removed:
+        announcer.remove(ihash)
+
+  # Pick up torrents added to or removed from the torrents directory
+  watcher = catalog.watch(loop, torrs, on_change)
+
+  # Tell peers about each other
+  exchanging = loop.create_task(exchange_peers(peers))
+
+  # Time out stalled handshakes and idle peers, and keep the others alive
+  timers = lifecycle.Lifecycle(lambda protocol: protocol.send(pwp.keep_alive()), lambda protocol: protocol.transport.close())
+  expiring = loop.create_task(expire_timers(timers))
+
+  # Shared by every connection, so that each piece is offered once
+  super_seeder = superseed.SuperSeeder() if super_seed else None
 
   # Create the server coroutine
-  server_factory = loop.create_server(lambda: PeerWireProtocol(peers, files, torrs), host='192.168.1.123', port=port)
+  server_factory = loop.create_server(lambda: PeerWireProtocol(peers, files, torrs, queues, reads, cache=cache, max_unchoked=max_unchoked, timers=timers,
+    super_seed=super_seeder), host=host, port=port, reuse_port=reuse_port or None)
 
   # Schedule the server
   server = loop.run_until_complete(server_factory)
 
   try:
-    x = loop.run_until_complete(worker(peers))
+    x = loop.run_until_complete(worker(peers, queues, reads))
   except KeyboardInterrupt:
     print('\rshutting down...')
 
-  # Close all files
-  for f in files.values():
-    f.close()
+  # Stop watching the torrents directory
+  if watcher.fileno() is not None:
+    loop.remove_reader(watcher.fileno())
+  watcher.close()
+
+  exchanging.cancel()
+  expiring.cancel()
+
+  # Tell the trackers we are leaving
+  if announcer is not None:
+    announcing.cancel()
+    loop.run_until_complete(announcer.close())
+
+  # Finish the reads in progress, and close all files
+  reads.close()
+  files.close()
 
   # Start closing the server
   server.close()
@@ -395,37 +1140,108 @@ def start(port, my_peer_id):
   loop.close()
 
 
-def leech(torr, addr):
-  '''Download the given torrent from the given peers.'''
+def start(port, my_peer_id, host=None, metrics_address=None, profile_dir='.', workers=1, cache_size=0, max_open_files=1024, metadata_budget=None, max_unchoked=None, weights=None, peer_weights=None, disk_threads=4, super_seed=False):
+  '''Start the server on the given port
 
-  # The event loop
-  loop = asyncio.get_event_loop()
+  The server listens on every interface unless a host is given. If a
+  metrics address is given, metrics are served there (see metrics.serve).
+  Profiles and allocation reports are written to profile_dir.
 
-  # List of all peers to which we are connected
-  peers = []
+  With more than one worker, that many processes are forked after the
+  torrents are loaded. Each runs its own event loop and accepts on the
+  same port through SO_REUSEPORT, and worker i serves its metrics on
+  the metrics port + i (or the metrics socket path + '.i'). A non-zero
+  cache_size (in bytes) gives the workers a shared piece cache. Each
+  process keeps at most max_open_files files open. Only the first
+  worker announces to trackers. Each process uploads to at most
+  max_unchoked peers at once.
+
+  Torrents added to the torrents directory are served without a
+  restart, and peers of removed torrents are disconnected once their
+  pending requests are answered. Each worker watches the directory
+  itself.
+
+  With a metadata_budget (in bytes), torrent metadata is only loaded
+  when a peer asks for it, and at most that much is kept in memory by
+  each process (see catalog.Catalog).
 
-  # Mapping from infohash to file-object
-  files = dict()
+  weights maps infohashes, and peer_weights maps peer IP addresses, to
+  their share of the upload (see scheduler.Scheduler). Each process
+  reads blocks with disk_threads threads.
+
+  With super_seed, the torrents are super-seeded (see superseed.py).
+  Each worker only knows about its own peers, so with several workers
+  each piece may be uploaded once per worker.
+  '''
+
+  # All the infohashes we are seeding, from the torrents/ directory
+  # (kept up to date while we run, see serve)
+  torrs = catalog.Catalog('torrents', metadata_budget)
+  torrs.scan()
+
+  # Display the torrents we are serving
+  print('Serving...\n' + '\n'.join(ihash.hex() + ' ' + name for ihash, name in torrs.names.items()), end='\n\n')
 
-  # Create the connection coroutine
-  coro = loop.create_connection(lambda: PeerWireProtocol(peers, files, [], torr), host=addr[0], port=addr[1])
+  # Created before forking, so that every worker shares it
+  cache = piececache.SharedPieceCache(cache_size) if cache_size > 0 else None
 
-  trans, proto = loop.run_until_complete(coro)
+  if workers <= 1:
+    serve(port, torrs, host, metrics_address, profile_dir, cache, max_open_files=max_open_files, peer_id=my_peer_id, max_unchoked=max_unchoked,
+      weights=weights, peer_weights=peer_weights, disk_threads=disk_threads, super_seed=super_seed)
+    return
+
+  # Keep the catalog out of the garbage collector's sight, so that the
+  # workers keep sharing its pages instead of copying them
+  if hasattr(gc, 'freeze'):
+    gc.freeze()
+
+  children = []
+
+  for i in range(workers):
+    pid = os.fork()
+
+    if pid == 0:
+      try:
+        serve(port, torrs, host, metrics_address and worker_address(metrics_address, i), profile_dir, cache, True, max_open_files,
+          my_peer_id, announce=(i == 0), max_unchoked=max_unchoked, weights=weights, peer_weights=peer_weights,
+          disk_threads=disk_threads, super_seed=super_seed)
+      finally:
+        os._exit(0)
+
+    children.append(pid)
+
+  print('started {} workers'.format(workers))
 
   try:
-    x = loop.run_until_complete(worker(peers))
+    for pid in children:
+      os.waitpid(pid, 0)
   except KeyboardInterrupt:
-    print('\rshutting down...')
-
-  # Close all files
-  for f in files.values():
-    f.close()
+    # Stop any workers that did not get the interrupt themselves
+    for pid in children:
+      try:
+        os.kill(pid, signal.SIGINT)
+      except ProcessLookupError:
+        pass
+
+    for pid in children:
+      try:
+        os.waitpid(pid, 0)
+      except ChildProcessError:
+        pass
+
+
+def leech(torr, addr, metrics_address=None, profile_dir='.', write_cache_size=writeback.BUDGET):
+  '''Download the given torrent from the given peer.
+
+  Without an address, the peers returned by the torrent's tracker are
+  used. Pieces already recorded in the download's state file (see
+  writeback.py) are not downloaded again.
+  '''
 
-  # Close the connection
-  trans.close()
+  # The session builds on this module, so is only imported when needed
+  import session
 
-  # Close the event loop
-  loop.close()
+  session.download([torr], [addr] if addr else [], metrics_address, profile_dir, write_cache_size=write_cache_size)
 
 
 def main():
@@ -433,16 +1249,19 @@ def main():
 
   port = 6881
   my_peer_id  = b'1' * 20
-
-  if sys.argv[1] == 'leech':
-    torr = torrent.read_torrent_file(sys.argv[2])
-    addr = sys.argv[3]
-
-    leech(torr, (addr, port))
-
-  elif sys.argv[1] == 'seed':
-    start(port, my_peer_id)
-
+  metrics_address = None
+  profile_dir = '.'
+  workers = 1
+  cache_size = 0
+  max_open_files = 1024
+  metadata_budget = None
+  max_unchoked = None
+  weights = dict()
+  peer_weights = dict()
+  disk_threads = 4
+  write_cache_size = writeback.BUDGET
+  super_seed = False
+  log_level = logging.WARNING
 
   # Parse Options
   for arg in sys.argv[1:]:
@@ -452,5 +1271,67 @@ def main():
     if arg.startswith('--port'):
       port = int(arg[6:])
 
+    if arg.startswith('--metrics='):
+      metrics_address = metrics.parse_address(arg[10:])
+
+    if arg == '--debug':
+      log_level = logging.DEBUG
+
+    if arg.startswith('--profile-dir='):
+      profile_dir = arg[14:]
+
+    if arg == '--spans':
+      profiling.enable_spans()
+
+    if arg.startswith('--workers='):
+      workers = int(arg[10:])
+
+    if arg.startswith('--cache-mb='):
+      cache_size = int(arg[11:]) * 2**20
+
+    if arg.startswith('--max-open-files='):
+      max_open_files = int(arg[17:])
+
+    if arg.startswith('--metadata-mb='):
+      metadata_budget = int(arg[14:]) * 2**20
+
+    if arg.startswith('--max-unchoked='):
+      max_unchoked = int(arg[15:])
+
+    if arg.startswith('--weight='):
+      infohash, weight = arg[9:].split(':')
+      weights[bytes.fromhex(infohash)] = float(weight)
+
+    if arg.startswith('--disk-threads='):
+      disk_threads = int(arg[15:])
+
+    if arg.startswith('--peer-weight='):
+      ip, _, weight = arg[14:].rpartition(':')
+      peer_weights[ip] = float(weight)
+
+    if arg.startswith('--write-cache-mb='):
+      write_cache_size = int(arg[17:]) * 2**20
+
+    if arg == '--super-seed':
+      super_seed = True
+
+  # Configure the logger (per-connection events are only logged with --debug)
+  logging.basicConfig(
+    level=log_level,
+    datefmt='%Y/%m/%d %H:%M:%S',
+    format='%(asctime)s %(name)s %(message)s',
+    filename='server_log.txt'
+  )
+
+  if sys.argv[1] == 'leech':
+    torr = torrent.read_torrent_file(sys.argv[2])
+    addr = sys.argv[3] if len(sys.argv) > 3 and not sys.argv[3].startswith('-') else None
+
+    leech(torr, addr and (addr, port), metrics_address, profile_dir, write_cache_size)
+
+  elif sys.argv[1] == 'seed':
+    start(port, my_peer_id, metrics_address=metrics_address, profile_dir=profile_dir, workers=workers, cache_size=cache_size, max_open_files=max_open_files, metadata_budget=metadata_budget, max_unchoked=max_unchoked,
+      weights=weights, peer_weights=peer_weights, disk_threads=disk_threads, super_seed=super_seed)
+
 if __name__ == '__main__':
   main()
@@ -0,0 +1,264 @@
+#!/usr/bin/env python3.6
+'''Microbenchmarks for the pwp and bencode hot paths
+
+Times the pure-Python functions that dominate CPU use when seeding and
+leeching, on realistic inputs: torrents of 1k to 1M pieces and bursts of
+piece messages from 1 to 64 MB. The slowest inputs only run with --full.
+
+  python3 bench_micro.py --output=before.json
+  python3 bench_micro.py --compare=before.json --threshold=5
+
+Each result is the best time per call over several repeats, in seconds.
+The results of a run, tagged with the git revision, can be saved with
+--output and used as the baseline for a later run with --compare, which
+lists every benchmark that slowed down by more than --threshold percent
+and exits with status 1 if there were any.
+'''
+
+# Stdlib
+import sys, os, io, json, time, subprocess, timeit, hashlib
+
+# Project
+import torrent, pwp, simple_seeder
+
+
+REPO_DIR = os.path.dirname(os.path.abspath(__file__))
+
+BLOCK_SIZE = 2**14
+
+# Size of the chunks in which a socket hands data to the parser
+RECV_SIZE = 2**16
+
+# Minimum time spent on each repeat of a benchmark
+MIN_TIME = 0.2
+
+
+def git_version():
+  '''The git revision of the code being benchmarked'''
+
+  try:
+    out = subprocess.check_output(['git', 'describe', '--always', '--dirty'], cwd=REPO_DIR, stderr=subprocess.DEVNULL)
+    return out.decode().strip()
+  except (OSError, subprocess.CalledProcessError):
+    return None
+
+
+def make_torrent(num_pieces, piece_length=2**18):
+  '''A torrent dictionary with the given number of (fake) pieces'''
+
+  # Deterministic but distinct piece hashes
+  pieces = b''.join(hashlib.sha1(i.to_bytes(4, 'big')).digest() for i in range(num_pieces))
+
+  return {
+    'announce': 'http://tracker.example.com:6969/announce',
+    'info': {
+      'name': 'bench.bin',
+      'piece length': piece_length,
+      'length': num_pieces * piece_length,
+      'pieces': pieces,
+      'md5sum': '0' * 32
+    },
+    'comment': 'benchmark',
+    'created by': 'SimpleTorrent',
+    'creation date': 1500000000,
+    'encoding': 'ascii'
+  }
+
+
+def piece_burst(size):
+  '''A stream of piece messages carrying size bytes of blocks'''
+
+  block = os.urandom(BLOCK_SIZE)
+  return b''.join(pwp.piece(i // 16, (i % 16) * BLOCK_SIZE, block) for i in range(size // BLOCK_SIZE))
+
+
+def mixed_stream(size):
+  '''A stream mixing piece messages with the control messages around them'''
+
+  block = os.urandom(BLOCK_SIZE)
+  msgs = []
+
+  for i in range(size // BLOCK_SIZE):
+    index, begin = i // 16, (i % 16) * BLOCK_SIZE
+    msgs.append(pwp.piece(index, begin, block))
+    msgs.append(pwp.request(index + 1, begin, BLOCK_SIZE))
+
+    if i % 16 == 15:
+      msgs.append(pwp.have(index))
+
+    if i % 64 == 0:
+      msgs.extend([pwp.keep_alive(), pwp.unchoke(), pwp.interested()])
+
+  return b''.join(msgs)
+
+
+def chunks(stream, size=RECV_SIZE):
+  '''Split a stream the way a socket would deliver it'''
+  return [stream[i : i + size] for i in range(0, len(stream), size)]
+
+
+def parse_stream(pieces):
+  '''Feed chunks to a MessageParser and drain it after each one'''
+
+  parser = pwp.MessageParser()
+  parser.infohash = parser.peer_id = True
+
+  for chunk in pieces:
+    parser.add(chunk)
+    for msg in parser:
+      pass
+
+
+def parse_with_reader(stream):
+  '''Parse a stream with parse_next_message until it runs dry'''
+
+  reader = io.BytesIO(stream)
+
+  while pwp.parse_next_message(reader).id != pwp.CLOSED:
+    pass
+
+
+def benchmarks(full):
+  '''Yield (name, function, bytes processed per call) for every benchmark'''
+
+  burst_sizes = [2**20, 2**24, 2**26] if full else [2**20, 2**24]
+  piece_counts = [10**3, 10**5, 10**6] if full else [10**3, 10**5]
+
+  # Encoders
+  yield 'encode.keep_alive', pwp.keep_alive, None
+  yield 'encode.choke', pwp.choke, None
+  yield 'encode.unchoke', pwp.unchoke, None
+  yield 'encode.interested', pwp.interested, None
+  yield 'encode.uninterested', pwp.uninterested, None
+  yield 'encode.have', lambda: pwp.have(123456), None
+  yield 'encode.request', lambda: pwp.request(123456, 2**14, 2**14), None
+  yield 'encode.cancel', lambda: pwp.cancel(123456, 2**14, 2**14), None
+  yield 'encode.port', lambda: pwp.port(6881), None
+
+  block = os.urandom(BLOCK_SIZE)
+  yield 'encode.piece', lambda: pwp.piece(123456, 2**14, block), BLOCK_SIZE
+
+  info_hash, peer_id = os.urandom(20), os.urandom(20)
+  yield 'encode.handshake', lambda: pwp.create_handshake(info_hash, peer_id), None
+
+  # Message parsing
+  for size in burst_sizes:
+    pieces = chunks(piece_burst(size))
+    yield 'MessageParser.pieces.{}MB'.format(size >> 20), lambda pieces=pieces: parse_stream(pieces), size
+
+    mixed = chunks(mixed_stream(size))
+    yield 'MessageParser.mixed.{}MB'.format(size >> 20), lambda mixed=mixed: parse_stream(mixed), size
+
+    stream = piece_burst(size)
+    yield 'parse_next_message.pieces.{}MB'.format(size >> 20), lambda stream=stream: parse_with_reader(stream), size
+
+  # Torrents
+  for num_pieces in piece_counts:
+    torr = make_torrent(num_pieces)
+    encoded = torrent.bencode(torr)
+    label = '{}k'.format(num_pieces // 1000)
+
+    yield 'bencode.{}'.format(label), lambda torr=torr: torrent.bencode(torr), len(encoded)
+    yield 'parse_bencode.{}'.format(label), lambda encoded=encoded: torrent.parse_bencode(encoded), len(encoded)
+    yield 'infohash.{}'.format(label), lambda torr=torr: torrent.infohash(torr), len(encoded)
+    yield 'request_all.{}'.format(label), lambda torr=torr: pwp.request_all(torr['info']['length']), None
+
+    # A bitfield with every other piece set
+    bitfield = b'\xaa' * ((num_pieces + 7) // 8)
+    yield 'bytestring_to_set.{}'.format(label), lambda bitfield=bitfield: simple_seeder.bytestring_to_set(bitfield), len(bitfield)
+
+
+def measure(func, repeat):
+  '''Best time per call of func, in seconds'''
+
+  timer = timeit.Timer(func)
+
+  # Pick a number of calls that takes at least MIN_TIME
+  number = 1
+  while True:
+    elapsed = timer.timeit(number)
+    if elapsed >= MIN_TIME:
+      break
+    number *= max(2, min(10, int(MIN_TIME / max(elapsed, 1e-9))))
+
+  return min([elapsed] + timer.repeat(repeat - 1, number)) / number
+
+
+def compare(results, baseline_file, threshold):
+  '''Print benchmarks that slowed down. Returns their number.'''
+
+  with open(baseline_file) as f:
+    baseline = json.load(f)
+
+  regressions = 0
+
+  for name, result in sorted(results.items()):
+    old = baseline['results'].get(name)
+
+    if old is None:
+      continue
+
+    change = 100 * (result['seconds'] - old['seconds']) / old['seconds']
+
+    if change > threshold:
+      regressions += 1
+      print('REGRESSION {}: {:.3g}s -> {:.3g}s ({:+.1f}%)'.format(name, old['seconds'], result['seconds'], change), file=sys.stderr)
+
+  return regressions
+
+
+def main():
+
+  full = False
+  repeat = 5
+  only = None
+  output = None
+  baseline = None
+  threshold = 10.0
+
+  # Parse Options
+  for arg in sys.argv[1:]:
+    if arg == '--full':
+      full = True
+
+    if arg.startswith('--repeat='):
+      repeat = int(arg[9:])
+
+    if arg.startswith('--filter='):
+      only = arg[9:]
+
+    if arg.startswith('--output='):
+      output = arg[9:]
+
+    if arg.startswith('--compare='):
+      baseline = arg[10:]
+
+    if arg.startswith('--threshold='):
+      threshold = float(arg[12:])
+
+  results = dict()
+
+  for name, func, nbytes in benchmarks(full):
+
+    if only is not None and only not in name:
+      continue
+
+    seconds = measure(func, repeat)
+    results[name] = {'seconds': seconds}
+
+    if nbytes is not None:
+      results[name]['mb_per_s'] = nbytes / 2**20 / seconds
+      print('{:40s} {:12.3f} us {:10.1f} MB/s'.format(name, 1e6 * seconds, results[name]['mb_per_s']))
+    else:
+      print('{:40s} {:12.3f} us'.format(name, 1e6 * seconds))
+
+  if output:
+    with open(output, 'w') as f:
+      json.dump({'version': git_version(), 'time': int(time.time()), 'results': results}, f, indent=2, sort_keys=True)
+
+  if baseline and compare(results, baseline, threshold) > 0:
+    sys.exit(1)
+
+
+if __name__ == '__main__':
+  main()
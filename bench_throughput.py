@@ -0,0 +1,362 @@
+#!/usr/bin/env python3.6
+'''Loopback end-to-end throughput benchmark
+
+Starts a seeder (async_seeder or simple_seeder) on localhost, serving a
+generated file, and downloads it with N concurrent leechers. Every
+combination of seeder, piece size, peer count and file size is run, and
+one JSON object per run is written to the output:
+
+  python3 bench_throughput.py --seeders=async,simple --piece-sizes=256K,1M \
+      --peers=1,8,32 --sizes=16M,64M --output=bench.jsonl
+
+Each result records the download rate (MB/s), the p50/p99 latency from
+sending a block request to receiving the block, the seeder's CPU time per
+GB sent and its peak RSS. The CPU and RSS figures are read from /proc, so
+they are null on systems without it.
+
+Passing --compare=old.jsonl reports every configuration whose throughput
+dropped by more than --threshold percent against an earlier run.
+'''
+
+# Stdlib
+import sys, os, socket, subprocess, signal, asyncio, struct, json, time, tempfile, itertools
+from concurrent.futures import ProcessPoolExecutor
+
+# Project
+import torrent, pwp
+
+
+REPO_DIR = os.path.dirname(os.path.abspath(__file__))
+
+# Runs a seeder in the working directory given to the subprocess
+SEEDER_SCRIPT = '''
+import sys, {module}
+{module}.start(int(sys.argv[1]), b'1'*20, host='127.0.0.1')
+'''
+
+SEEDER_MODULES = {'async': 'async_seeder', 'simple': 'simple_seeder'}
+
+# Requests each leecher keeps outstanding
+WINDOW = 64
+
+BLOCK_SIZE = 2**14
+
+
+def parse_size(text):
+  '''Parse a size such as 512, 256K, 16M or 1G'''
+
+  units = {'K': 2**10, 'M': 2**20, 'G': 2**30}
+
+  if text[-1].upper() in units:
+    return int(float(text[:-1]) * units[text[-1].upper()])
+
+  return int(text)
+
+
+def percentile(ordered, p):
+  '''The p-th percentile (0 <= p <= 1) of a sorted list'''
+
+  if len(ordered) == 0:
+    return None
+
+  return ordered[int(round(p * (len(ordered) - 1)))]
+
+
+def git_version():
+  '''The git revision of the code being benchmarked'''
+
+  try:
+    out = subprocess.check_output(['git', 'describe', '--always', '--dirty'], cwd=REPO_DIR, stderr=subprocess.DEVNULL)
+    return out.decode().strip()
+  except (OSError, subprocess.CalledProcessError):
+    return None
+
+
+def free_port():
+  '''Find a free TCP port on localhost'''
+
+  with socket.socket() as s:
+    s.bind(('127.0.0.1', 0))
+    return s.getsockname()[1]
+
+
+def generate_file(path, size):
+  '''Write size random bytes to path'''
+
+  with open(path, 'wb') as f:
+    while size > 0:
+      f.write(os.urandom(min(size, 2**20)))
+      size -= 2**20
+
+
+def proc_stats(pid):
+  '''Return (cpu seconds, peak rss in KiB) of a process, or Nones'''
+
+  try:
+    with open('/proc/{}/stat'.format(pid)) as f:
+      fields = f.read().rsplit(')', 1)[1].split()
+
+    # utime and stime are fields 14 and 15 of stat(5)
+    cpu = (int(fields[11]) + int(fields[12])) / os.sysconf('SC_CLK_TCK')
+
+    with open('/proc/{}/status'.format(pid)) as f:
+      peak = next(int(line.split()[1]) for line in f if line.startswith('VmHWM'))
+
+    return cpu, peak
+  except (OSError, StopIteration, ValueError):
+    return None, None
+
+
+def block_requests(file_size, piece_size):
+  '''All (index, begin, length) block requests for a file'''
+
+  reqs = []
+
+  for offset in range(0, file_size, BLOCK_SIZE):
+    index, begin = divmod(offset, piece_size)
+    reqs.append((index, begin, min(BLOCK_SIZE, file_size - offset, piece_size - begin)))
+
+  return reqs
+
+
+async def leech_once(host, port, info_hash, reqs, latencies):
+  '''Download every block once over one connection. Returns bytes received.'''
+
+  reader, writer = await asyncio.open_connection(host, port)
+
+  writer.write(pwp.create_handshake(info_hash, os.urandom(20)))
+
+  shake = await reader.readexactly(1)
+  await reader.readexactly(48 + shake[0])
+
+  writer.write(pwp.interested())
+
+  # Time at which each outstanding block was requested
+  sent = dict()
+  next_req = 0
+  received = 0
+
+  while next_req < min(WINDOW, len(reqs)):
+    writer.write(pwp.request(*reqs[next_req]))
+    sent[reqs[next_req][:2]] = time.perf_counter()
+    next_req += 1
+
+  while sent:
+    msg_len = struct.unpack('>I', await reader.readexactly(4))[0]
+
+    if msg_len == 0:
+      continue
+
+    msg = await reader.readexactly(msg_len)
+
+    if msg[0] != 7:
+      continue
+
+    key = struct.unpack('>II', msg[1:9])
+    latencies.append(time.perf_counter() - sent.pop(key))
+    received += msg_len - 9
+
+    if next_req < len(reqs):
+      writer.write(pwp.request(*reqs[next_req]))
+      sent[reqs[next_req][:2]] = time.perf_counter()
+      next_req += 1
+
+  writer.close()
+
+  return received
+
+
+def leech_process(host, port, info_hash, file_size, piece_size, num_peers):
+  '''Run num_peers leechers in this process's own event loop'''
+
+  loop = asyncio.new_event_loop()
+  asyncio.set_event_loop(loop)
+
+  reqs = block_requests(file_size, piece_size)
+  latencies = []
+
+  started = time.time()
+  results = loop.run_until_complete(asyncio.gather(*[leech_once(host, port, info_hash, reqs, latencies) for _ in range(num_peers)]))
+  finished = time.time()
+
+  loop.close()
+
+  return {'bytes': sum(results), 'started': started, 'finished': finished, 'latencies': latencies}
+
+
+def wait_for_port(host, port, timeout=10):
+  '''Wait until something is listening on the given port'''
+
+  deadline = time.time() + timeout
+
+  while time.time() < deadline:
+    try:
+      socket.create_connection((host, port), timeout=1).close()
+      return
+    except OSError:
+      time.sleep(0.05)
+
+  raise Exception('seeder did not start listening on port {}'.format(port))
+
+
+def run_one(seeder, piece_size, num_peers, file_size, data_file, workdir):
+  '''Benchmark a single configuration and return its result'''
+
+  # Lay out the files/ and torrents/ directories the seeders expect
+  rundir = tempfile.mkdtemp(dir=workdir)
+  os.mkdir(rundir + '/files')
+  os.mkdir(rundir + '/torrents')
+  os.link(data_file, rundir + '/files/bench.bin')
+
+  torr = torrent.create_torrent(rundir + '/files/bench.bin', piece_length=piece_size)
+  with open(rundir + '/torrents/bench.bin.torrent', 'bw') as f:
+    f.write(torrent.bencode(torr))
+
+  info_hash = torrent.infohash(torr)
+  host, port = '127.0.0.1', free_port()
+
+  env = dict(os.environ, PYTHONPATH=REPO_DIR)
+  script = SEEDER_SCRIPT.format(module=SEEDER_MODULES[seeder])
+  proc = subprocess.Popen([sys.executable, '-c', script, str(port)], cwd=rundir, env=env,
+                          stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+
+  try:
+    wait_for_port(host, port)
+
+    cpu_before, _ = proc_stats(proc.pid)
+
+    # Spread the leechers over several processes so they do not limit the seeder
+    num_procs = min(num_peers, os.cpu_count() or 1)
+    shares = [num_peers // num_procs + (1 if i < num_peers % num_procs else 0) for i in range(num_procs)]
+
+    with ProcessPoolExecutor(max_workers=num_procs) as pool:
+      futures = [pool.submit(leech_process, host, port, info_hash, file_size, piece_size, n) for n in shares]
+      parts = [fut.result() for fut in futures]
+
+    cpu_after, peak_rss = proc_stats(proc.pid)
+  finally:
+    proc.send_signal(signal.SIGINT)
+    try:
+      proc.wait(timeout=10)
+    except subprocess.TimeoutExpired:
+      proc.kill()
+      proc.wait()
+
+  total = sum(part['bytes'] for part in parts)
+  seconds = max(part['finished'] for part in parts) - min(part['started'] for part in parts)
+  latencies = sorted(itertools.chain.from_iterable(part['latencies'] for part in parts))
+
+  if total != file_size * num_peers:
+    raise Exception('received {} bytes, expected {}'.format(total, file_size * num_peers))
+
+  cpu = None if cpu_before is None or cpu_after is None else cpu_after - cpu_before
+
+  return {
+    'seeder': seeder,
+    'piece_size': piece_size,
+    'peers': num_peers,
+    'file_size': file_size,
+    'bytes': total,
+    'seconds': seconds,
+    'mb_per_s': total / 2**20 / seconds,
+    'latency_p50_ms': 1000 * percentile(latencies, 0.50),
+    'latency_p99_ms': 1000 * percentile(latencies, 0.99),
+    'cpu_seconds': cpu,
+    'cpu_seconds_per_gb': None if cpu is None else cpu / (total / 2**30),
+    'peak_rss_kb': peak_rss,
+  }
+
+
+def config_key(result):
+  return (result['seeder'], result['piece_size'], result['peers'], result['file_size'])
+
+
+def compare(results, baseline_file, threshold):
+  '''Print configurations whose throughput regressed. Returns their number.'''
+
+  with open(baseline_file) as f:
+    baseline = { config_key(r): r for r in map(json.loads, f) }
+
+  regressions = 0
+
+  for result in results:
+    old = baseline.get(config_key(result))
+
+    if old is None:
+      continue
+
+    change = 100 * (result['mb_per_s'] - old['mb_per_s']) / old['mb_per_s']
+
+    if change < -threshold:
+      regressions += 1
+      print('REGRESSION {} piece={} peers={} size={}: {:.1f} -> {:.1f} MB/s ({:+.1f}%)'.format(
+        result['seeder'], result['piece_size'], result['peers'], result['file_size'],
+        old['mb_per_s'], result['mb_per_s'], change), file=sys.stderr)
+
+  return regressions
+
+
+def main():
+
+  seeders = ['async', 'simple']
+  piece_sizes = [2**18, 2**20]
+  peer_counts = [1, 8]
+  file_sizes = [2**24, 2**26]
+  output = None
+  baseline = None
+  threshold = 10.0
+
+  # Parse Options
+  for arg in sys.argv[1:]:
+    if arg.startswith('--seeders='):
+      seeders = arg[10:].split(',')
+
+    if arg.startswith('--piece-sizes='):
+      piece_sizes = [parse_size(x) for x in arg[14:].split(',')]
+
+    if arg.startswith('--peers='):
+      peer_counts = [int(x) for x in arg[8:].split(',')]
+
+    if arg.startswith('--sizes='):
+      file_sizes = [parse_size(x) for x in arg[8:].split(',')]
+
+    if arg.startswith('--output='):
+      output = arg[9:]
+
+    if arg.startswith('--compare='):
+      baseline = arg[10:]
+
+    if arg.startswith('--threshold='):
+      threshold = float(arg[12:])
+
+  version = git_version()
+  results = []
+
+  out = open(output, 'w') if output else sys.stdout
+
+  with tempfile.TemporaryDirectory() as workdir:
+
+    # Generate each data file once and share it between runs
+    data_files = dict()
+    for size in file_sizes:
+      data_files[size] = '{}/data-{}.bin'.format(workdir, size)
+      generate_file(data_files[size], size)
+
+    for seeder, piece_size, num_peers, file_size in itertools.product(seeders, piece_sizes, peer_counts, file_sizes):
+
+      result = run_one(seeder, piece_size, num_peers, file_size, data_files[file_size], workdir)
+      result['version'] = version
+      results.append(result)
+
+      out.write(json.dumps(result) + '\n')
+      out.flush()
+
+  if output:
+    out.close()
+
+  if baseline and compare(results, baseline, threshold) > 0:
+    sys.exit(1)
+
+
+if __name__ == '__main__':
+  main()
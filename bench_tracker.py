@@ -0,0 +1,371 @@
+#!/usr/bin/env python3.6
+'''Checks of the tracker clients against local stand-in trackers
+
+Starts a stand-in HTTP tracker and a stand-in UDP tracker (BEP 15) on
+localhost, and runs the clients of tracker.py against them: announces
+and scrapes over both protocols, the tracker id sent back on later
+announces, UDP connection IDs expiring, lost datagrams being
+retransmitted, and requests queued behind slow or dead trackers under
+a shared limit.
+
+  python3 bench_tracker.py
+  python3 bench_tracker.py --filter=udp
+
+Each check prints whether it passed and how long it took. The exit
+status is 1 if any failed.
+'''
+
+# Stdlib
+import sys, asyncio, struct, random, socket, time, urllib.parse
+
+# Project
+import torrent, tracker
+
+
+# Seconds the stand-ins are given to answer before a check fails
+CHECK_TIMEOUT = 10.0
+
+# The peers every stand-in returns
+PEERS = [('10.0.0.1', 6881), ('10.0.0.2', 6882)]
+
+
+def compact_peers(peers):
+  return b''.join(socket.inet_aton(ip) + struct.pack('!H', port) for ip, port in peers)
+
+
+def query_params(query):
+  '''The parameters of a query string, with binary values left as bytes'''
+
+  params = dict()
+
+  for item in query.split('&'):
+    key, _, value = item.partition('=')
+    params.setdefault(key, []).append(urllib.parse.unquote_to_bytes(value))
+
+  return params
+
+
+class StandInHTTPTracker():
+  '''An HTTP tracker that answers every announce and scrape after delay
+     seconds, giving out a tracker id and PEERS'''
+
+  def __init__(self, delay=0.0, interval=1800):
+    self.delay = delay
+    self.interval = interval
+
+    # The parameters of every request, in order
+    self.requests = []
+
+    self.server = None
+
+
+  async def start(self):
+    self.server = await asyncio.start_server(self._serve, '127.0.0.1', 0)
+    return 'http://127.0.0.1:{}/announce'.format(self.server.sockets[0].getsockname()[1])
+
+
+  async def _serve(self, reader, writer):
+
+    try:
+      while True:
+        line = await reader.readline()
+
+        if not line:
+          break
+
+        while (await reader.readline()) not in (b'\r\n', b'\n', b''):
+          pass
+
+        path, _, query = line.split()[1].decode().partition('?')
+        params = query_params(query)
+        self.requests.append((path, params))
+
+        await asyncio.sleep(self.delay)
+
+        if path.endswith('/scrape'):
+          body = torrent.bencode({'files': { infohash : {'complete': 1, 'incomplete': 2, 'downloaded': 3} for infohash in params['info_hash'] }})
+        else:
+          body = torrent.bencode({'interval': self.interval, 'tracker id': b'stand-in', 'peers': compact_peers(PEERS)})
+
+        writer.write(b'HTTP/1.1 200 OK\r\nContent-Length: ' + str(len(body)).encode() + b'\r\n\r\n' + body)
+
+    except (ConnectionError, asyncio.CancelledError):
+      pass
+
+    finally:
+      writer.close()
+
+
+  def close(self):
+    self.server.close()
+
+
+class StandInUDPTracker(asyncio.DatagramProtocol):
+  '''A UDP tracker (BEP 15) that drops the first drop datagrams it is
+     sent, and ignores all of them if dead'''
+
+  def __init__(self, drop=0, dead=False):
+    self.drop = drop
+    self.dead = dead
+
+    # The action of every datagram received, dropped ones included
+    self.received = []
+
+    # Connection IDs given out
+    self.connection_ids = set()
+
+    self.transport = None
+
+
+  async def start(self):
+    loop = asyncio.get_event_loop()
+    self.transport, _ = await loop.create_datagram_endpoint(lambda: self, local_addr=('127.0.0.1', 0))
+    return 'udp://127.0.0.1:{}'.format(self.transport.get_extra_info('sockname')[1])
+
+
+  def datagram_received(self, data, addr):
+    connection_id, action, transaction_id = tracker.UDP_HEADER.unpack_from(data)
+    self.received.append(action)
+
+    if self.dead or len(self.received) <= self.drop:
+      return
+
+    if action == tracker.ACTION_CONNECT:
+      connection_id = random.getrandbits(64)
+      self.connection_ids.add(connection_id)
+      self.transport.sendto(tracker.UDP_CONNECT_RESPONSE.pack(action, transaction_id, connection_id), addr)
+
+    elif connection_id not in self.connection_ids:
+      self.transport.sendto(tracker.UDP_RESPONSE.pack(tracker.ACTION_ERROR, transaction_id) + b'unknown connection id', addr)
+
+    elif action == tracker.ACTION_ANNOUNCE:
+      self.transport.sendto(tracker.UDP_ANNOUNCE_RESPONSE.pack(action, transaction_id, 1800, 2, 1) + compact_peers(PEERS), addr)
+
+    elif action == tracker.ACTION_SCRAPE:
+      count = (len(data) - tracker.UDP_HEADER.size) // 20
+      self.transport.sendto(tracker.UDP_RESPONSE.pack(action, transaction_id) + tracker.UDP_SCRAPE_ENTRY.pack(1, 3, 2) * count, addr)
+
+
+  def close(self):
+    self.transport.close()
+
+
+async def check_http_announce():
+  stand_in = StandInHTTPTracker()
+  client = tracker.HTTPTracker(await stand_in.start())
+
+  try:
+    response = await client.announce(b'a' * 20, b'p' * 20, 6881, event='started')
+    assert response['peers'] == PEERS, response['peers']
+
+    # The tracker id of a response is sent back
+    await client.announce(b'a' * 20, b'p' * 20, 6881, tracker_id=response['tracker id'])
+    assert 'trackerid' not in stand_in.requests[0][1]
+    assert stand_in.requests[1][1]['trackerid'] == [b'stand-in']
+  finally:
+    client.close()
+    stand_in.close()
+
+
+async def check_http_scrape():
+  stand_in = StandInHTTPTracker()
+  client = tracker.HTTPTracker(await stand_in.start())
+
+  try:
+    files = await client.scrape([b'a' * 20, b'b' * 20])
+    assert stand_in.requests[0][0] == '/scrape'
+    assert files == { infohash : {'complete': 1, 'incomplete': 2, 'downloaded': 3} for infohash in (b'a' * 20, b'b' * 20) }, files
+  finally:
+    client.close()
+    stand_in.close()
+
+
+async def check_http_queued():
+  '''Requests queued for a connection do not time out while waiting'''
+
+  stand_in = StandInHTTPTracker(delay=0.2)
+  client = tracker.HTTPTracker(await stand_in.start(), max_connections=4, timeout=1.0)
+
+  try:
+    results = await asyncio.gather(*[client.announce(bytes([i]) * 20, b'p' * 20, 6881) for i in range(40)], return_exceptions=True)
+    failed = [result for result in results if isinstance(result, Exception)]
+    assert not failed, '{} of 40 announces failed: {!r}'.format(len(failed), failed[0])
+  finally:
+    client.close()
+    stand_in.close()
+
+
+async def check_http_shared_limit():
+  '''Requests queued behind a slow tracker leave the shared slots to
+     the other trackers'''
+
+  slow, fast = StandInHTTPTracker(delay=0.5), StandInHTTPTracker()
+  limit = asyncio.Semaphore(4)
+  slow_client = tracker.HTTPTracker(await slow.start(), max_connections=1, limit=limit)
+  fast_client = tracker.HTTPTracker(await fast.start(), limit=limit)
+
+  try:
+    queued = [asyncio.ensure_future(slow_client.announce(bytes([i]) * 20, b'p' * 20, 6881)) for i in range(8)]
+    await asyncio.sleep(0.05)
+
+    started = time.monotonic()
+    await fast_client.announce(b'a' * 20, b'p' * 20, 6881)
+    elapsed = time.monotonic() - started
+    assert elapsed < 0.3, 'announce to the fast tracker took {:.2f}s'.format(elapsed)
+
+    for future in queued:
+      future.cancel()
+    await asyncio.gather(*queued, return_exceptions=True)
+  finally:
+    slow_client.close()
+    fast_client.close()
+    slow.close()
+    fast.close()
+
+
+async def check_udp_announce_scrape():
+  stand_in = StandInUDPTracker()
+  client = tracker.UDPTracker(await stand_in.start())
+
+  try:
+    response = await client.announce(b'a' * 20, b'p' * 20, 6881, event='started')
+    assert response['peers'] == PEERS and response['complete'] == 1 and response['incomplete'] == 2, response
+
+    # Many infohashes are split over several requests
+    infohashes = [i.to_bytes(20, 'big') for i in range(tracker.MAX_SCRAPE + 10)]
+    files = await client.scrape(infohashes)
+    assert set(files) == set(infohashes) and files[infohashes[0]] == {'complete': 1, 'downloaded': 3, 'incomplete': 2}
+
+    # One connect served all three requests
+    assert stand_in.received == [tracker.ACTION_CONNECT, tracker.ACTION_ANNOUNCE, tracker.ACTION_SCRAPE, tracker.ACTION_SCRAPE], stand_in.received
+  finally:
+    client.close()
+    stand_in.close()
+
+
+async def check_udp_connection_expiry():
+  stand_in = StandInUDPTracker()
+  client = tracker.UDPTracker(await stand_in.start())
+  lifetime = tracker.CONNECTION_ID_LIFETIME
+
+  try:
+    tracker.CONNECTION_ID_LIFETIME = 0.2
+
+    await client.announce(b'a' * 20, b'p' * 20, 6881)
+    await client.announce(b'a' * 20, b'p' * 20, 6881)
+    await asyncio.sleep(0.3)
+    await client.announce(b'a' * 20, b'p' * 20, 6881)
+
+    assert stand_in.received.count(tracker.ACTION_CONNECT) == 2, stand_in.received
+  finally:
+    tracker.CONNECTION_ID_LIFETIME = lifetime
+    client.close()
+    stand_in.close()
+
+
+async def check_udp_retry():
+  '''Lost datagrams are sent again'''
+
+  stand_in = StandInUDPTracker(drop=2)
+  client = tracker.UDPTracker(await stand_in.start(), timeout=0.05)
+
+  try:
+    response = await client.announce(b'a' * 20, b'p' * 20, 6881)
+    assert response['peers'] == PEERS
+    assert stand_in.received == [tracker.ACTION_CONNECT] * 3 + [tracker.ACTION_ANNOUNCE], stand_in.received
+
+    # Gives up after its retries
+    stand_in.dead = True
+    client.retries = 2
+    started = time.monotonic()
+
+    try:
+      await client.announce(b'a' * 20, b'p' * 20, 6881)
+    except Exception as e:
+      assert 'no response' in str(e), e
+    else:
+      raise AssertionError('announce to a dead tracker succeeded')
+
+    assert time.monotonic() - started >= 0.05 * (1 + 2 + 4)
+  finally:
+    client.close()
+    stand_in.close()
+
+
+async def check_udp_shared_limit():
+  '''A dead UDP tracker holds a shared slot only while a datagram waits
+     for its answer'''
+
+  dead, live = StandInUDPTracker(dead=True), StandInUDPTracker()
+  limit = asyncio.Semaphore(1)
+  dead_client = tracker.UDPTracker(await dead.start(), timeout=0.2, limit=limit)
+  live_client = tracker.UDPTracker(await live.start(), limit=limit)
+
+  try:
+    stuck = asyncio.ensure_future(dead_client.announce(b'a' * 20, b'p' * 20, 6881))
+    await asyncio.sleep(0.05)
+
+    started = time.monotonic()
+    await live_client.announce(b'a' * 20, b'p' * 20, 6881)
+    elapsed = time.monotonic() - started
+
+    # At most one exchange with the dead tracker (and its reconnect) is
+    # waited for, not its whole backoff
+    assert elapsed < 1.0, 'announce to the live tracker took {:.2f}s'.format(elapsed)
+
+    stuck.cancel()
+    await asyncio.gather(stuck, return_exceptions=True)
+  finally:
+    dead_client.close()
+    live_client.close()
+    dead.close()
+    live.close()
+
+
+CHECKS = [('http announce', check_http_announce), ('http scrape', check_http_scrape),
+  ('http queued', check_http_queued), ('http shared limit', check_http_shared_limit),
+  ('udp announce and scrape', check_udp_announce_scrape), ('udp connection expiry', check_udp_connection_expiry),
+  ('udp retry', check_udp_retry), ('udp shared limit', check_udp_shared_limit)]
+
+
+async def run(only=None):
+  '''Run the checks, returning the names of those that failed'''
+
+  failed = []
+
+  for name, check in CHECKS:
+
+    if only is not None and only not in name:
+      continue
+
+    started = time.monotonic()
+
+    try:
+      await asyncio.wait_for(check(), CHECK_TIMEOUT)
+      result = 'ok'
+    except Exception as e:
+      result = 'FAILED: {}'.format(e or type(e).__name__)
+      failed.append(name)
+
+    print('{:28s} {:6.2f}s  {}'.format(name, time.monotonic() - started, result))
+
+  return failed
+
+
+def main():
+
+  only = None
+
+  # Parse Options
+  for arg in sys.argv[1:]:
+    if arg.startswith('--filter='):
+      only = arg[9:]
+
+  loop = asyncio.get_event_loop()
+  failed = loop.run_until_complete(run(only))
+
+  sys.exit(1 if failed else 0)
+
+
+if __name__ == '__main__':
+  main()
@@ -0,0 +1,378 @@
+'''The catalog of torrents being served
+
+A Catalog maps infohashes to torrent dictionaries, like the dictionary
+the seeders used to build once at startup, but it can be brought up to
+date while the seeder runs. Each .torrent file is remembered with its
+mtime and size, so a rescan only parses and hashes the files that were
+added or changed.
+
+With a memory budget, the catalog is lazy: only the location and name of
+each torrent stay resident, and the full metadata (most of which is the
+table of piece hashes) is read from its .torrent file when a peer first
+asks for it. The least recently used metadata is dropped when the loaded
+torrents exceed the budget.
+
+A Watcher reports when files in the torrents directory change, using
+inotify where it is available. Where it is not, the seeders fall back to
+rescanning the directory every few seconds, which only costs a stat()
+per file.
+'''
+
+# Stdlib
+import os, sys, struct, ctypes, ctypes.util, logging, collections
+
+# Project
+import torrent, metrics
+
+
+log = logging.getLogger('catalog')
+
+METADATA_LOADED = metrics.gauge('simpletorrent_metadata_loaded_bytes', 'Size of the torrent files whose metadata is in memory')
+METADATA_LOADS = metrics.counter('simpletorrent_metadata_loads_total', 'Torrent files read because a peer asked for a torrent that was not loaded')
+METADATA_EVICTIONS = metrics.counter('simpletorrent_metadata_evictions_total', 'Torrents whose metadata was dropped to stay under the memory budget')
+
+# How often to rescan the directory when inotify is unavailable (seconds)
+SCAN_INTERVAL = 5.0
+
+
+class Catalog():
+  '''The torrents in a directory, indexed by infohash
+
+     Without a budget every torrent is kept in memory. With a budget (in
+     bytes of .torrent files) metadata is loaded on first use and evicted
+     least recently used first. A torrent in use by a peer stays alive
+     through the peer's reference even after it is evicted.
+  '''
+
+  def __init__(self, directory='torrents', budget=None):
+
+    self.directory = directory
+
+    # The most bytes of metadata to keep loaded, or None for no limit
+    self.budget = budget
+
+    # Mapping from infohash to the path of its torrent file
+    self.paths = dict()
+
+    # Mapping from infohash to the name of the torrent
+    self.names = dict()
+
+    # Mapping from infohash to its tracker's announce URL (if it has one)
+    self.announces = dict()
+
+    # Mapping from infohash to the loaded torrent dictionary, least
+    # recently used first
+    self.torrents = collections.OrderedDict()
+
+    # Mapping from infohash to the size of its loaded torrent file
+    self.sizes = dict()
+
+    # Size of the loaded torrent files
+    self.loaded = 0
+
+    # Mapping from path to (mtime, size, infohash) of each torrent file
+    self.files = dict()
+
+
+  def __contains__(self, infohash):
+    return infohash in self.paths
+
+  def __getitem__(self, infohash):
+    torr = self.get(infohash)
+
+    if torr is None:
+      raise KeyError(infohash)
+
+    return torr
+
+  def __len__(self):
+    return len(self.paths)
+
+  def get(self, infohash, default=None):
+    '''The torrent dictionary for an infohash, loading it if necessary'''
+
+    torr = self.torrents.get(infohash)
+
+    if torr is not None:
+      self.torrents.move_to_end(infohash)
+      return torr
+
+    path = self.paths.get(infohash)
+
+    if path is None:
+      return default
+
+    try:
+      torr = torrent.read_torrent_file(path)
+    except Exception as e:
+      log.warning('could not read %s: %s', path, e)
+      return default
+
+    # The file was replaced since it was scanned; the next scan will notice
+    if torrent.infohash(torr) != infohash:
+      return default
+
+    METADATA_LOADS.inc()
+    self._keep(infohash, torr, self.files[path][1])
+
+    return torr
+
+
+  def _keep(self, infohash, torr, size):
+    '''Keep a torrent loaded, evicting others to stay under the budget'''
+
+    self._forget(infohash)
+
+    self.torrents[infohash] = torr
+    self.sizes[infohash] = size
+    self.loaded += size
+
+    while self.budget is not None and self.loaded > self.budget and len(self.torrents) > 1:
+      evicted = next(iter(self.torrents))
+      self._forget(evicted)
+      METADATA_EVICTIONS.inc()
+
+    METADATA_LOADED.set(self.loaded)
+
+
+  def _forget(self, infohash):
+    '''Drop a loaded torrent'''
+
+    if self.torrents.pop(infohash, None) is not None:
+      self.loaded -= self.sizes.pop(infohash)
+
+
+  def _torrent_paths(self):
+    '''All torrent files in the directory tree'''
+
+    for (dirpath, dirnames, filenames) in os.walk(self.directory):
+      for filename in filenames:
+        if filename[0] != '.':
+          yield dirpath + '/' + filename
+
+
+  def scan(self):
+    '''Bring the whole catalog up to date
+
+       Returns the lists of infohashes that were added and removed.
+    '''
+
+    paths = set(self._torrent_paths())
+    return self.update(paths | set(self.files))
+
+
+  def update(self, paths):
+    '''Bring the given torrent files up to date
+
+       Paths that no longer exist are removed from the catalog. Returns
+       the lists of infohashes that were added and removed.
+    '''
+
+    added, removed = [], []
+
+    for path in paths:
+
+      try:
+        st = os.stat(path)
+      except FileNotFoundError:
+        st = None
+
+      old = self.files.get(path)
+
+      # Unchanged since we last read it
+      if st is not None and old is not None and old[:2] == (st.st_mtime_ns, st.st_size):
+        continue
+
+      # The metadata loaded from the old file is stale
+      if old is not None:
+        self._forget(old[2])
+
+      if st is not None:
+        try:
+          torr_info = torrent.read_torrent_file(path)
+          infohash = torrent.infohash(torr_info)
+        except Exception as e:
+          # Probably still being written; try again on the next change
+          log.warning('could not read %s: %s', path, e)
+          continue
+
+        self.files[path] = (st.st_mtime_ns, st.st_size, infohash)
+
+        if infohash not in self.paths:
+          added.append(infohash)
+
+        self.paths[infohash] = path
+        self.names[infohash] = torr_info['info']['name']
+
+        if torr_info.get('announce'):
+          self.announces[infohash] = torr_info['announce']
+        else:
+          self.announces.pop(infohash, None)
+
+        # Lazy catalogs only keep the location
+        if self.budget is None:
+          self._keep(infohash, torr_info, st.st_size)
+
+      elif old is not None:
+        del self.files[path]
+
+      # The file was deleted, or now holds a different torrent
+      if old is not None and (st is None or old[2] != infohash) and self.paths.get(old[2]) == path:
+        others = [other for other, entry in self.files.items() if entry[2] == old[2]]
+
+        if others:
+          self.paths[old[2]] = others[0]
+        else:
+          del self.paths[old[2]]
+          del self.names[old[2]]
+          self.announces.pop(old[2], None)
+          removed.append(old[2])
+
+    METADATA_LOADED.set(self.loaded)
+
+    return added, removed
+
+
+  def report(self, added, removed):
+    '''Print the changes returned by scan or update'''
+
+    for infohash in added:
+      print('Serving ' + infohash.hex() + ' ' + self.names[infohash])
+
+    for infohash in removed:
+      print('Stopped serving ' + infohash.hex())
+
+
+# inotify(7) constants
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_DELETE_SELF = 0x00000400
+IN_Q_OVERFLOW = 0x00004000
+IN_ISDIR = 0x40000000
+
+# Events that mean a torrent file is complete, gone, or was renamed (and
+# the creation of subdirectories)
+WATCHED_EVENTS = IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO | IN_CREATE | IN_DELETE | IN_DELETE_SELF
+
+EVENT_HEADER = struct.Struct('iIII')
+
+
+class Watcher():
+  '''Reports changed files in a directory tree using inotify
+
+     If inotify is not available, fileno() returns None and the caller
+     should rescan the directory periodically instead.
+  '''
+
+  def __init__(self, directory):
+
+    self.directory = directory
+
+    # Mapping from watch descriptor to directory
+    self.watches = dict()
+
+    self.fd = None
+    self.libc = None
+
+    if not sys.platform.startswith('linux'):
+      return
+
+    try:
+      self.libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+      fd = self.libc.inotify_init1(os.O_NONBLOCK | os.O_CLOEXEC)
+    except (OSError, AttributeError):
+      return
+
+    if fd < 0:
+      return
+
+    self.fd = fd
+
+    for (dirpath, dirnames, filenames) in os.walk(directory):
+      self._watch(dirpath)
+
+
+  def _watch(self, path):
+    wd = self.libc.inotify_add_watch(self.fd, os.fsencode(path), WATCHED_EVENTS)
+
+    if wd >= 0:
+      self.watches[wd] = path
+
+
+  def fileno(self):
+    return self.fd
+
+
+  def read(self):
+    '''Read pending events
+
+       Returns the set of changed paths, or None if the whole tree should
+       be rescanned (a directory changed or events were lost).
+    '''
+
+    changed = set()
+    rescan = False
+
+    while True:
+      try:
+        buf = os.read(self.fd, 65536)
+      except BlockingIOError:
+        break
+
+      pos = 0
+
+      while pos < len(buf):
+        wd, mask, cookie, name_len = EVENT_HEADER.unpack_from(buf, pos)
+        name = buf[pos + EVENT_HEADER.size : pos + EVENT_HEADER.size + name_len].rstrip(b'\x00')
+        pos += EVENT_HEADER.size + name_len
+
+        if mask & (IN_Q_OVERFLOW | IN_ISDIR | IN_DELETE_SELF):
+          rescan = True
+
+          # Watch new subdirectories
+          if mask & IN_ISDIR and mask & (IN_CREATE | IN_MOVED_TO) and wd in self.watches:
+            self._watch(self.watches[wd] + '/' + os.fsdecode(name))
+
+        elif wd in self.watches and name and name[:1] != b'.' and not mask & IN_CREATE:
+          changed.add(self.watches[wd] + '/' + os.fsdecode(name))
+
+    return None if rescan else changed
+
+
+  def close(self):
+    if self.fd is not None:
+      os.close(self.fd)
+      self.fd = None
+
+
+def watch(loop, catalog, on_change, interval=SCAN_INTERVAL):
+  '''Keep a catalog up to date from an asyncio event loop
+
+     on_change(added, removed) is called after every change. Returns the
+     Watcher, which should be closed when the loop stops.
+  '''
+
+  watcher = Watcher(catalog.directory)
+
+  def changed(added, removed):
+    if added or removed:
+      catalog.report(added, removed)
+      on_change(added, removed)
+
+  def readable():
+    paths = watcher.read()
+    changed(*(catalog.scan() if paths is None else catalog.update(paths)))
+
+  def rescan():
+    changed(*catalog.scan())
+    loop.call_later(interval, rescan)
+
+  if watcher.fileno() is not None:
+    loop.add_reader(watcher.fileno(), readable)
+  else:
+    loop.call_later(interval, rescan)
+
+  return watcher
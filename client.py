@@ -9,19 +9,28 @@ import torrent
 def main():
 
   peers = []
+  announce = ''
+  version = 1
 
   for arg in sys.argv[1:]:
     if arg.startswith('-p'):
       ip, raw_port = arg[2:].split(':')
       peers.append((ip, int(raw_port)))
 
+    if arg.startswith('--tracker='):
+      announce = arg[10:]
+
+    # 1, 2 (BEP 52) or hybrid
+    if arg.startswith('--torrent-version='):
+      version = arg[18:] if arg[18:] == 'hybrid' else int(arg[18:])
+
   if sys.argv[1] == 'add':
 
     # Get the pathless filename
     file_name = sys.argv[2].split('/')[-1]
 
     # Create a torrent for the new file
-    torrent.create_torrent_file(sys.argv[2])
+    torrent.create_torrent_file(sys.argv[2], announce=announce, version=version)
 
     # Link the file into the local files/ directory
     os.link(sys.argv[2], 'files/' + file_name)
@@ -0,0 +1,148 @@
+'''Block reads off the event loop
+
+The ReadEngine collects the block reads requested while the worker
+handles a round of messages. When the round ends, it sorts them by file
+and offset, merges reads of adjacent or overlapping ranges (across every
+peer) into reads of up to MAX_READ bytes, and runs each merged read with
+os.pread on a thread pool. When a read completes, each requester is
+handed its own slice on the event loop thread.
+
+A read that stops short of the end of its piece also asks the kernel to
+start reading the rest of the piece (posix_fadvise WILLNEED), since the
+peer is about to request it.
+'''
+
+# Stdlib
+import os, time, collections
+from concurrent.futures import ThreadPoolExecutor
+
+# Project
+import metrics, profiling
+
+
+DISK_READS = metrics.counter('simpletorrent_disk_reads_total', 'Reads issued by the disk read engine')
+READS_COALESCED = metrics.counter('simpletorrent_disk_reads_coalesced_total', 'Block reads merged into a read of a neighbouring block')
+DISK_READ_SECONDS = metrics.histogram('simpletorrent_disk_read_seconds', 'Latency of block reads')
+
+# The largest read that requests are merged into
+MAX_READ = 2**20
+
+# Pieces to remember having read ahead, so each is only advised once
+READAHEAD_MEMORY = 4096
+
+WILLNEED = getattr(os, 'POSIX_FADV_WILLNEED', None)
+
+
+# A requested read. readahead_to is the end of its piece.
+_Request = collections.namedtuple('_Request', ['path', 'offset', 'length', 'readahead_to', 'callback'])
+
+
+class ReadEngine():
+  '''Reads blocks on a thread pool, merging neighbouring requests'''
+
+  def __init__(self, loop, files, workers=4, max_read=MAX_READ):
+
+    self.loop = loop
+
+    # The file pool shared by every connection (see fdpool.py)
+    self.files = files
+
+    self.pool = ThreadPoolExecutor(max_workers=workers)
+    self.max_read = max_read
+
+    # Reads requested since the last flush
+    self.requests = []
+
+    # Ranges already read ahead, most recent last
+    self.advised = collections.OrderedDict()
+
+
+  def read(self, path, offset, length, callback, readahead_to=None):
+    '''Read length bytes at offset, then call callback(data) on the
+       event loop (with None if the read failed)'''
+
+    self.requests.append(_Request(path, offset, length, readahead_to, callback))
+
+
+  def flush(self):
+    '''Issue the reads requested since the last flush'''
+
+    if not self.requests:
+      return
+
+    requests = sorted(self.requests, key=lambda r: (r.path, r.offset))
+    self.requests = []
+
+    batch = [requests[0]]
+    end = requests[0].offset + requests[0].length
+
+    for r in requests[1:]:
+
+      # Adjacent or overlapping, and the merged read is not too large
+      if r.path == batch[0].path and r.offset <= end and max(end, r.offset + r.length) - batch[0].offset <= self.max_read:
+        batch.append(r)
+        end = max(end, r.offset + r.length)
+        READS_COALESCED.inc()
+        continue
+
+      self._submit(batch, end)
+      batch = [r]
+      end = r.offset + r.length
+
+    self._submit(batch, end)
+
+
+  def _submit(self, batch, end):
+    '''Read the range covered by a batch of requests'''
+
+    path, start = batch[0].path, batch[0].offset
+
+    # Read ahead to the end of the piece, once per piece
+    readahead = None
+    readahead_to = max(r.readahead_to or 0 for r in batch)
+
+    if WILLNEED is not None and readahead_to > end and (path, readahead_to) not in self.advised:
+      readahead = (end, readahead_to - end)
+
+      self.advised[(path, readahead_to)] = True
+      if len(self.advised) > READAHEAD_MEMORY:
+        self.advised.popitem(last=False)
+
+    DISK_READS.inc()
+
+    future = self.loop.run_in_executor(self.pool, self._pread, path, end - start, start, readahead)
+    future.add_done_callback(lambda future: self._done(batch, start, future))
+
+
+  def _pread(self, path, length, offset, readahead):
+    '''Runs on a pool thread. Returns the data and the time taken.'''
+
+    started = time.perf_counter()
+    data = self.files.pread(path, length, offset)
+    elapsed = time.perf_counter() - started
+
+    if readahead is not None:
+      self.files.fadvise(path, readahead[0], readahead[1], WILLNEED)
+
+    return data, elapsed
+
+
+  def _done(self, batch, start, future):
+    '''Hand each requester its slice of a completed read'''
+
+    try:
+      data, elapsed = future.result()
+    except Exception:
+      data = None
+    else:
+      DISK_READ_SECONDS.observe(elapsed)
+
+      if profiling.spans:
+        profiling.record_duration('disk_read', elapsed)
+
+    for r in batch:
+      r.callback(None if data is None else data[r.offset - start : r.offset - start + r.length])
+
+
+  def close(self):
+    self.pool.shutdown()
@@ -0,0 +1,170 @@
+'''A bounded pool of open file descriptors
+
+Files are opened on first use and kept open for the next reader, up to a
+maximum number of descriptors. When the limit is reached the least
+recently used file that no one is reading or writing is closed. All I/O
+goes through os.pread and os.pwrite, which do not move a shared file
+offset, so one descriptor can be used by any number of connections and
+threads at once.
+'''
+
+# Stdlib
+import os, threading, collections
+
+# Project
+import metrics
+
+
+OPEN_FILES = metrics.gauge('simpletorrent_open_files', 'File descriptors held by the file pool')
+EVICTIONS = metrics.counter('simpletorrent_file_evictions_total', 'Files closed to stay under the open file limit')
+
+
+class _Entry():
+
+  __slots__ = ('fd', 'refs', 'size')
+
+  def __init__(self, fd, size):
+    self.fd = fd
+    self.refs = 0
+    self.size = size
+
+
+class FilePool():
+  '''Shared, reference-counted file descriptors with LRU eviction
+
+     A file is identified by its path and whether it was opened for
+     writing. Files are never closed while they have references, so the
+     limit can be briefly exceeded when more files than max_open are in
+     use at once; the extras are closed as soon as they are released.
+  '''
+
+  def __init__(self, max_open=1024):
+
+    self.max_open = max_open
+
+    # Mapping from (path, writable) to its entry
+    self.entries = dict()
+
+    # Entries without references, least recently used first
+    self.idle = collections.OrderedDict()
+
+    self.lock = threading.Lock()
+
+
+  def acquire(self, path, writable=False):
+    '''Return a descriptor for the file, which must later be released'''
+
+    key = (path, writable)
+
+    with self.lock:
+      entry = self.entries.get(key)
+
+      if entry is None:
+        self._evict(self.max_open - 1)
+
+        fd = os.open(path, os.O_RDWR | os.O_CREAT if writable else os.O_RDONLY)
+        entry = self.entries[key] = _Entry(fd, os.fstat(fd).st_size)
+        OPEN_FILES.inc()
+
+      elif entry.refs == 0:
+        del self.idle[key]
+
+      entry.refs += 1
+
+      return entry.fd
+
+
+  def release(self, path, writable=False):
+    '''Release a descriptor returned by acquire'''
+
+    key = (path, writable)
+
+    with self.lock:
+      entry = self.entries[key]
+      entry.refs -= 1
+
+      if entry.refs == 0:
+        self.idle[key] = entry
+        self._evict(self.max_open)
+
+
+  def _evict(self, limit):
+    '''Close idle files until at most limit are open (lock must be held)'''
+
+    while len(self.entries) > limit and self.idle:
+      key, entry = self.idle.popitem(last=False)
+      del self.entries[key]
+      os.close(entry.fd)
+      OPEN_FILES.dec()
+      EVICTIONS.inc()
+
+
+  def size(self, path):
+    '''The size of a file when it was opened'''
+
+    self.acquire(path)
+
+    try:
+      return self.entries[(path, False)].size
+    finally:
+      self.release(path)
+
+
+  def pread(self, path, length, offset):
+    '''Read length bytes at offset'''
+
+    fd = self.acquire(path)
+
+    try:
+      return os.pread(fd, length, offset)
+    finally:
+      self.release(path)
+
+
+  def fadvise(self, path, offset, length, advice):
+    '''Tell the kernel how a range of the file will be used (a no-op
+       where posix_fadvise is unavailable)'''
+
+    if not hasattr(os, 'posix_fadvise'):
+      return
+
+    fd = self.acquire(path)
+
+    try:
+      os.posix_fadvise(fd, offset, length, advice)
+    finally:
+      self.release(path)
+
+
+  def pwrite(self, path, data, offset):
+    '''Write data at offset, creating the file if necessary'''
+
+    fd = self.acquire(path, True)
+
+    try:
+      return os.pwrite(fd, data, offset)
+    finally:
+      self.release(path, True)
+
+
+  def fsync(self, path):
+    '''Flush the writes made to a file to stable storage'''
+
+    fd = self.acquire(path, True)
+
+    try:
+      os.fsync(fd)
+    finally:
+      self.release(path, True)
+
+
+  def close(self):
+    '''Close every file'''
+
+    with self.lock:
+      for entry in self.entries.values():
+        os.close(entry.fd)
+        OPEN_FILES.dec()
+
+      self.entries.clear()
+      self.idle.clear()
@@ -0,0 +1,212 @@
+'''Connection lifecycle timers
+
+Every connection has a single timer on a shared hashed timer wheel, so
+thousands of connections cost one periodic tick instead of a call_later
+each. The timer of a new connection fires when its handshake should have
+completed. After the handshake, it fires when the connection should send
+a keep-alive or when the peer has been silent for too long, whichever
+comes first. Activity only records a timestamp; the timer checks it when
+it fires and is rescheduled if the connection turns out to be busy.
+
+Connections that have not completed their handshake are half-open, and
+new connections are refused while there are too many of them.
+'''
+
+# Stdlib
+import time, math
+
+# Project
+import metrics
+
+
+TIMEOUTS = metrics.counter('simpletorrent_connection_timeouts_total', 'Connections closed or refused by a lifecycle timer, by reason', ['reason'])
+KEEP_ALIVES = metrics.counter('simpletorrent_keep_alives_sent_total', 'Keep-alive messages sent to idle peers')
+
+# Seconds between timer wheel ticks
+TICK = 1.0
+
+# Seconds a peer has to complete its handshake
+HANDSHAKE_TIMEOUT = 30
+
+# Seconds a peer may send nothing before it is disconnected (peers send
+# keep-alives every two minutes)
+IDLE_TIMEOUT = 180
+
+# Seconds we may send nothing before we send a keep-alive
+KEEP_ALIVE_INTERVAL = 120
+
+# The most connections that may be waiting for their handshake at once
+MAX_HALF_OPEN = 512
+
+
+class TimerWheel():
+  '''A hashed timer wheel
+
+     Keys are placed in the slot of the tick at which they expire, modulo
+     the number of slots. Each tick only looks at one slot, and keys more
+     than a revolution away are left in place until their round comes.
+  '''
+
+  def __init__(self, tick=TICK, slots=512):
+
+    self.tick = tick
+    self.slots = [set() for _ in range(slots)]
+
+    # Mapping from key to (deadline, slot)
+    self.deadlines = dict()
+
+    # The last tick that was expired
+    self.current = int(time.monotonic() // tick)
+
+
+  def __len__(self):
+    return len(self.deadlines)
+
+  def schedule(self, key, deadline):
+    '''Expire a key at the given time, replacing its previous deadline'''
+
+    self.cancel(key)
+
+    # Never schedule into a tick that has already been expired
+    n = max(int(math.ceil(deadline / self.tick)), self.current + 1)
+    slot = n % len(self.slots)
+
+    self.slots[slot].add(key)
+    self.deadlines[key] = (deadline, slot)
+
+
+  def cancel(self, key):
+    entry = self.deadlines.pop(key, None)
+
+    if entry is not None:
+      self.slots[entry[1]].discard(key)
+
+
+  def expire(self, now):
+    '''Remove and return the keys whose deadlines have passed'''
+
+    end = int(now // self.tick)
+    expired = []
+
+    # A slot is visited once per revolution, however long we slept
+    for n in range(max(self.current + 1, end - len(self.slots) + 1), end + 1):
+      slot = self.slots[n % len(self.slots)]
+
+      for key in [key for key in slot if self.deadlines[key][0] <= now]:
+        slot.discard(key)
+        del self.deadlines[key]
+        expired.append(key)
+
+    self.current = max(self.current, end)
+
+    return expired
+
+
+class Lifecycle():
+  '''Enforces handshake and idle timeouts and sends keep-alives
+
+     Connections are identified by any hashable key. keep_alive(key) must
+     send a keep-alive and close(key) must close the connection; neither
+     needs to report back. The owner calls expire() every TICK seconds.
+  '''
+
+  def __init__(self, keep_alive, close, handshake_timeout=HANDSHAKE_TIMEOUT, idle_timeout=IDLE_TIMEOUT, keep_alive_interval=KEEP_ALIVE_INTERVAL, max_half_open=MAX_HALF_OPEN):
+
+    self.keep_alive = keep_alive
+    self.close = close
+
+    self.handshake_timeout = handshake_timeout
+    self.idle_timeout = idle_timeout
+    self.keep_alive_interval = keep_alive_interval
+    self.max_half_open = max_half_open
+
+    self.wheel = TimerWheel()
+
+    # Mapping from key to [handshake done, last received, last sent]
+    self.conns = dict()
+
+    # Connections still waiting for their handshake
+    self.half_open = 0
+
+
+  def opened(self, key):
+    '''Start timing a new connection. Returns False if it should be
+       refused because too many connections are half-open.'''
+
+    if self.half_open >= self.max_half_open:
+      TIMEOUTS.labels('half_open').inc()
+      return False
+
+    now = time.monotonic()
+
+    self.half_open += 1
+    self.conns[key] = [False, now, now]
+    self.wheel.schedule(key, now + self.handshake_timeout)
+
+    return True
+
+
+  def established(self, key):
+    '''The connection completed its handshake'''
+
+    state = self.conns.get(key)
+
+    if state is None or state[0]:
+      return
+
+    state[0] = True
+    self.half_open -= 1
+    self._schedule(key, state)
+
+
+  def received(self, key):
+    state = self.conns.get(key)
+
+    if state is not None:
+      state[1] = time.monotonic()
+
+  def sent(self, key):
+    state = self.conns.get(key)
+
+    if state is not None:
+      state[2] = time.monotonic()
+
+
+  def closed(self, key):
+    '''Stop timing a connection'''
+
+    state = self.conns.pop(key, None)
+
+    if state is None:
+      return
+
+    if not state[0]:
+      self.half_open -= 1
+
+    self.wheel.cancel(key)
+
+
+  def _schedule(self, key, state):
+    self.wheel.schedule(key, min(state[1] + self.idle_timeout, state[2] + self.keep_alive_interval))
+
+
+  def expire(self):
+    '''Handle the timers that have fired'''
+
+    now = time.monotonic()
+
+    for key in self.wheel.expire(now):
+      state = self.conns[key]
+
+      if not state[0] or now - state[1] >= self.idle_timeout:
+        TIMEOUTS.labels('idle' if state[0] else 'handshake').inc()
+        self.closed(key)
+        self.close(key)
+        continue
+
+      if now - state[2] >= self.keep_alive_interval:
+        KEEP_ALIVES.inc()
+        self.keep_alive(key)
+        state[2] = now
+
+      self._schedule(key, state)
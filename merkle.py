@@ -0,0 +1,224 @@
+'''Merkle trees of block hashes, as used by BitTorrent v2 (BEP 52)
+
+Every 16 KiB block of a file is hashed with SHA-256, and those leaf
+hashes are combined pairwise into a binary tree. The leaf layer is padded
+with zero hashes up to a power of two, so the tree is always complete.
+
+A file longer than a piece has a tree of whole pieces: its leaf layer is
+padded to a power of two pieces, and the layer whose hashes each cover a
+piece is the file's 'piece layer'. A file no longer than a piece is
+covered by a single subtree of the next power of two blocks. Either way
+the root of the tree is the file's 'pieces root'.
+
+Because every block has its own hash, a piece that fails its check can
+be repaired by downloading again only the blocks whose leaf hashes do
+not match, once the leaf hashes of the piece are known.
+
+A peer answering requests for hashes need not hold the whole tree. The
+layers from the piece layer up are built from the piece layer of the
+torrent, and the layers below it only for the piece a request covers,
+from that piece's blocks.
+'''
+
+# Stdlib
+import hashlib, collections
+from concurrent.futures import ThreadPoolExecutor
+
+
+BLOCK = 2**14
+
+# The size of a hash, and the hash of a block past the end of the file
+HASH = 32
+ZERO = bytes(HASH)
+
+# Threads hashing the blocks of a file
+WORKERS = 4
+
+# Blocks hashed by each task
+CHUNK = 64
+
+# The most hashes a peer may ask for in one request
+MAX_HASHES = 512
+
+
+def sha256(data):
+  return hashlib.sha256(data).digest()
+
+
+def block_hashes(data):
+  '''The leaf hashes of the blocks of data'''
+  view = memoryview(data)
+  return [sha256(view[i : i + BLOCK]) for i in range(0, len(data), BLOCK)]
+
+
+def hash_chunks(chunks, workers=WORKERS):
+  '''The leaf hashes of a sequence of chunks, each a whole number of
+     blocks but the last, hashed on a thread pool
+
+     Only a few chunks are held at a time, so a file can be hashed while
+     it is read.
+  '''
+
+  leaves = []
+  window = collections.deque()
+
+  with ThreadPoolExecutor(max_workers=workers) as pool:
+    for chunk in chunks:
+      window.append(pool.submit(block_hashes, chunk))
+
+      if len(window) > 2 * workers:
+        leaves.extend(window.popleft().result())
+
+    while window:
+      leaves.extend(window.popleft().result())
+
+  return leaves
+
+
+def next_power(n):
+  '''The smallest power of two that is at least n'''
+  return 1 << max(n - 1, 0).bit_length()
+
+
+def log2(n):
+  '''The exponent of a power of two'''
+  return n.bit_length() - 1
+
+
+# The roots of subtrees of zero leaves, by height
+_pads = [ZERO]
+
+def pad(height):
+  '''The root of a subtree of 2**height zero leaves'''
+
+  while len(_pads) <= height:
+    _pads.append(sha256(_pads[-1] * 2))
+
+  return _pads[height]
+
+
+def layers(hashes, width, height=0):
+  '''Every layer of the tree over hashes, from the bottom up
+
+     The bottom layer is padded to width (a power of two) with the roots
+     of zero subtrees of the given height, i.e. hashes are themselves the
+     roots of subtrees of 2**height leaves.
+  '''
+
+  if len(hashes) > width:
+    raise Exception('{} hashes do not fit a layer of {}'.format(len(hashes), width))
+
+  layer = list(hashes) + [pad(height)] * (width - len(hashes))
+  tree = [layer]
+
+  while len(layer) > 1:
+    layer = [sha256(layer[i] + layer[i+1]) for i in range(0, len(layer), 2)]
+    tree.append(layer)
+
+  return tree
+
+
+def root(hashes, width, height=0):
+  '''The root of the tree over hashes (see layers)'''
+  return layers(hashes, width, height)[-1][0]
+
+
+def piece_width(length, piece_length):
+  '''The number of leaves under each piece hash of a file'''
+  return min(piece_length // BLOCK, width(length, piece_length))
+
+
+def width(length, piece_length):
+  '''The number of leaves of a file's tree (padding included)'''
+
+  blocks = -(-length // BLOCK)
+
+  if length <= piece_length:
+    return next_power(blocks)
+
+  return next_power(-(-length // piece_length)) * (piece_length // BLOCK)
+
+
+def piece_layer(leaves, length, piece_length):
+  '''The hash of each piece of a file, given its leaf hashes'''
+
+  per_piece = piece_width(length, piece_length)
+  return [root(leaves[i : i + per_piece], per_piece) for i in range(0, len(leaves), per_piece)]
+
+
+def pieces_root(leaves, length, piece_length):
+  '''The root of a file's tree, given its leaf hashes'''
+
+  # A single piece is its own root
+  if length <= piece_length:
+    return root(leaves, width(length, piece_length))
+
+  pieces = piece_layer(leaves, length, piece_length)
+  per_piece = piece_width(length, piece_length)
+
+  return root(pieces, next_power(len(pieces)), log2(per_piece))
+
+
+def upper_layers(pieces, length, piece_length):
+  '''Every layer of a file's tree from the piece layer up, given the
+     hash of each piece'''
+
+  per_piece = piece_width(length, piece_length)
+  return layers(pieces, next_power(len(pieces)), log2(per_piece))
+
+
+def valid_request(upper, height, base, index, length):
+  '''Can length hashes from index in layer base be taken from a tree
+     whose layers from height (the piece layer) up are upper, and the
+     layers below it known for a single piece?
+
+     As for the hash request message of BEP 52, length must be a power of
+     two no greater than MAX_HASHES, and index a multiple of it. Below
+     the piece layer the hashes must also be of a single piece.
+  '''
+
+  if base < 0 or base >= height + len(upper) or not 0 < length <= MAX_HASHES or length & (length - 1) or index % length:
+    return False
+
+  if base >= height:
+    return index + length <= len(upper[base - height])
+
+  return length << base <= 1 << height and index + length <= len(upper[0]) << (height - base)
+
+
+def request_piece(height, base, index):
+  '''The piece under the hash at index in layer base (below height, the
+     piece layer)'''
+  return index >> (height - base)
+
+
+def hashes(upper, height, lower, base, index, length, proof_layers):
+  '''The hashes from index in layer base, then the uncle hashes proving
+     the root of the subtree they form, from the bottom up (at most
+     proof_layers of them)
+
+     upper holds the layers from height (the piece layer) up, and lower
+     those below it of the tree of the request's piece (see
+     request_piece), which is only needed if base is below height.
+  '''
+
+  def node(layer, i):
+    if layer >= height:
+      return upper[layer - height][i]
+
+    # Positions in the piece's own tree
+    return lower[layer][i % len(lower[layer])]
+
+  result = [node(base, i) for i in range(index, index + length)]
+
+  layer = base + log2(length)
+  i = index // length
+
+  while layer < height + len(upper) - 1 and proof_layers > 0:
+    result.append(node(layer, i ^ 1))
+
+    layer += 1
+    i //= 2
+    proof_layers -= 1
+
+  return result
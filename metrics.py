@@ -0,0 +1,343 @@
+'''Low-overhead metrics
+
+Counters, gauges and histograms that can be exposed in the Prometheus text
+format over a local HTTP or Unix socket endpoint.
+
+Updating a metric is a dictionary-free attribute update: callers look up
+the child for a set of label values once (e.g. when a connection is made)
+and keep it, so the hot path only does an addition. Gauges that describe
+existing state (queue depths, connection counts) can instead be given a
+function, which is only called when the metrics are scraped.
+'''
+
+# Stdlib
+import bisect, os, socketserver, threading, http.server, urllib.parse
+
+
+# Default histogram buckets, in seconds
+LATENCY_BUCKETS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5)
+
+
+def _format_labels(names, values, extra=''):
+  pairs = ['{}="{}"'.format(name, str(value).replace('\\', '\\\\').replace('"', '\\"')) for name, value in zip(names, values)]
+
+  if extra:
+    pairs.append(extra)
+
+  return '{' + ','.join(pairs) + '}' if pairs else ''
+
+
+def _format_value(value):
+  if value == float('inf'):
+    return '+Inf'
+
+  return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class _Value():
+  '''A single counter or gauge value'''
+
+  __slots__ = ('value',)
+
+  def __init__(self):
+    self.value = 0
+
+  def inc(self, amount=1):
+    self.value += amount
+
+  def dec(self, amount=1):
+    self.value -= amount
+
+  def set(self, value):
+    self.value = value
+
+
+class _HistogramValue():
+  '''Bucketed observations for a single set of label values'''
+
+  __slots__ = ('bounds', 'counts', 'sum', 'count')
+
+  def __init__(self, bounds):
+    self.bounds = bounds
+    self.counts = [0] * (len(bounds) + 1)
+    self.sum = 0
+    self.count = 0
+
+  def observe(self, value):
+    self.counts[bisect.bisect_left(self.bounds, value)] += 1
+    self.sum += value
+    self.count += 1
+
+
+class Metric():
+  '''Base class of all metrics
+
+     A metric without labels can be updated directly; a metric with labels
+     is updated through the child returned by labels().
+  '''
+
+  kind = 'untyped'
+
+  def __init__(self, name, documentation, labelnames=()):
+
+    self.name = name
+    self.documentation = documentation
+    self.labelnames = tuple(labelnames)
+
+    # Mapping from a tuple of label values to its value
+    self.children = dict()
+
+    if not self.labelnames:
+      self._default = self.labels()
+
+
+  def _new_child(self):
+    return _Value()
+
+
+  def labels(self, *values):
+    '''The child for the given label values, created if necessary'''
+
+    child = self.children.get(values)
+
+    if child is None:
+      if len(values) != len(self.labelnames):
+        raise Exception('{} expects labels {}'.format(self.name, self.labelnames))
+
+      child = self.children[values] = self._new_child()
+
+    return child
+
+
+  def remove(self, *values):
+    '''Stop reporting the given label values'''
+    self.children.pop(values, None)
+
+
+  def samples(self):
+    '''Yield (suffix, labels, value) for every sample of this metric'''
+
+    for values, child in list(self.children.items()):
+      yield '', _format_labels(self.labelnames, values), child.value
+
+
+  def render(self):
+    lines = ['# HELP {} {}'.format(self.name, self.documentation), '# TYPE {} {}'.format(self.name, self.kind)]
+
+    for suffix, labels, value in self.samples():
+      lines.append('{}{}{} {}'.format(self.name, suffix, labels, _format_value(value)))
+
+    return '\n'.join(lines)
+
+
+class Counter(Metric):
+  '''A value that only goes up'''
+
+  kind = 'counter'
+
+  def inc(self, amount=1):
+    self._default.value += amount
+
+
+class Gauge(Metric):
+  '''A value that can go up and down, or be computed when scraped'''
+
+  kind = 'gauge'
+
+  def __init__(self, name, documentation, labelnames=()):
+    super().__init__(name, documentation, labelnames)
+    self.function = None
+
+  def inc(self, amount=1):
+    self._default.value += amount
+
+  def dec(self, amount=1):
+    self._default.value -= amount
+
+  def set(self, value):
+    self._default.value = value
+
+  def get(self):
+    '''The current value of a gauge without labels'''
+    return self._default.value if self.function is None else self.function()
+
+  def set_function(self, function):
+    '''Report the result of function() instead of a stored value
+
+       For gauges with labels, the function returns a mapping from tuples
+       of label values to values.
+    '''
+    self.function = function
+
+  def samples(self):
+    if self.function is None:
+      yield from super().samples()
+    elif self.labelnames:
+      for values, value in self.function().items():
+        yield '', _format_labels(self.labelnames, values), value
+    else:
+      yield '', '', self.function()
+
+
+class Histogram(Metric):
+  '''Counts observations (usually durations) in buckets'''
+
+  kind = 'histogram'
+
+  def __init__(self, name, documentation, labelnames=(), buckets=LATENCY_BUCKETS):
+    self.buckets = tuple(sorted(buckets))
+    super().__init__(name, documentation, labelnames)
+
+  def _new_child(self):
+    return _HistogramValue(self.buckets)
+
+  def observe(self, value):
+    self._default.observe(value)
+
+  def samples(self):
+    for values, child in list(self.children.items()):
+
+      cumulative = 0
+      for bound, count in zip(self.buckets + (float('inf'),), list(child.counts)):
+        cumulative += count
+        le = 'le="{}"'.format(_format_value(bound))
+        yield '_bucket', _format_labels(self.labelnames, values, le), cumulative
+
+      labels = _format_labels(self.labelnames, values)
+      yield '_sum', labels, child.sum
+      yield '_count', labels, child.count
+
+
+class Registry():
+  '''A collection of metrics, rendered together'''
+
+  def __init__(self):
+    self.metrics = dict()
+
+  def register(self, metric):
+    '''Add a metric, or return the identical one already registered'''
+
+    existing = self.metrics.get(metric.name)
+
+    if existing is not None:
+      if existing.kind != metric.kind or existing.labelnames != metric.labelnames:
+        raise Exception('metric {} is already registered with a different type'.format(metric.name))
+      return existing
+
+    self.metrics[metric.name] = metric
+    return metric
+
+  def counter(self, name, documentation, labelnames=()):
+    return self.register(Counter(name, documentation, labelnames))
+
+  def gauge(self, name, documentation, labelnames=()):
+    return self.register(Gauge(name, documentation, labelnames))
+
+  def histogram(self, name, documentation, labelnames=(), buckets=LATENCY_BUCKETS):
+    return self.register(Histogram(name, documentation, labelnames, buckets))
+
+  def render(self):
+    '''All metrics in the Prometheus text exposition format'''
+    return '\n'.join(metric.render() for metric in list(self.metrics.values())) + '\n'
+
+
+# The registry used by the seeders and leechers
+REGISTRY = Registry()
+
+
+def counter(name, documentation, labelnames=()):
+  return REGISTRY.counter(name, documentation, labelnames)
+
+
+def gauge(name, documentation, labelnames=()):
+  return REGISTRY.gauge(name, documentation, labelnames)
+
+
+def histogram(name, documentation, labelnames=(), buckets=LATENCY_BUCKETS):
+  return REGISTRY.histogram(name, documentation, labelnames, buckets)
+
+
+class _MetricsHandler(http.server.BaseHTTPRequestHandler):
+  '''Answers GETs of a command path with its result, and every other GET
+     with the rendered registry'''
+
+  registry = REGISTRY
+  routes = dict()
+
+  def do_GET(self):
+    url = urllib.parse.urlsplit(self.path)
+    command = self.routes.get(url.path)
+
+    if command is None:
+      body = self.registry.render().encode()
+      status = 200
+    else:
+      params = dict(urllib.parse.parse_qsl(url.query))
+      try:
+        body = command(params).encode()
+        status = 200
+      except Exception as e:
+        body = '{}\n'.format(e).encode()
+        status = 500
+
+    self.send_response(status)
+    self.send_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+    self.send_header('Content-Length', str(len(body)))
+    self.end_headers()
+    self.wfile.write(body)
+
+  def log_message(self, format, *args):
+    pass
+
+  def address_string(self):
+    # Unix sockets have no client address
+    return str(self.client_address[0]) if self.client_address else 'local'
+
+
+class _TCPServer(socketserver.ThreadingMixIn, http.server.HTTPServer):
+  daemon_threads = True
+
+
+class _UnixServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+  daemon_threads = True
+
+  def get_request(self):
+    conn, _ = super().get_request()
+    return conn, ('local', 0)
+
+
+def parse_address(text):
+  '''Parse a metrics address: PORT, HOST:PORT or unix:PATH'''
+
+  if text.startswith('unix:'):
+    return text[5:]
+
+  if ':' in text:
+    host, port = text.rsplit(':', 1)
+    return (host, int(port))
+
+  return ('127.0.0.1', int(text))
+
+
+def serve(address, registry=REGISTRY, routes=None):
+  '''Serve the registry on a background thread
+
+     The address is a (host, port) tuple for HTTP over TCP, or a path for
+     HTTP over a Unix socket. Routes maps extra paths to commands: functions
+     taking a dictionary of query parameters and returning text. Returns
+     the server, which can be stopped with shutdown().
+  '''
+
+  handler = type('MetricsHandler', (_MetricsHandler,), {'registry': registry, 'routes': routes or dict()})
+
+  if isinstance(address, str):
+    if os.path.exists(address):
+      os.unlink(address)
+    server = _UnixServer(address, handler)
+  else:
+    server = _TCPServer(address, handler)
+
+  thread = threading.Thread(target=server.serve_forever, name='metrics', daemon=True)
+  thread.start()
+
+  return server
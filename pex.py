@@ -0,0 +1,103 @@
+'''Peer exchange (ut_pex)
+
+Peers that support the extension protocol (BEP 10) and ut_pex are told
+about the other peers connected to us for the same torrent, so a swarm
+forms from its existing connections instead of from repeated tracker
+announces. A peer is only advertised if we know the address it listens
+on: the address we connected to, or the remote IP with the port from its
+extension handshake.
+
+Every connection that takes part is a dictionary with the keys
+
+  infohash   the torrent of the connection
+  listen     the peer's listen address (ip, port), or None if unknown
+  pex_id     the message id the peer gave ut_pex, or None
+  pex_sent   the set of addresses we have told the peer about
+
+which both seeders keep in their connection state.
+'''
+
+# Stdlib
+import socket, collections
+
+# Project
+import torrent, tracker, pwp
+
+
+# Our message id for ut_pex, advertised in our extension handshake
+UT_PEX = 1
+
+# The extensions we support, by name
+EXTENSIONS = {'ut_pex': UT_PEX}
+
+# Seconds between updates sent to a peer
+INTERVAL = 60
+
+# The most peers added or dropped in one message
+MAX_PEERS = 50
+
+
+def compact(peers):
+  '''Pack IPv4 and IPv6 addresses into compact peer lists'''
+
+  peers4, peers6 = [], []
+
+  for ip, port in peers:
+    if ':' in ip:
+      peers6.append(socket.inet_pton(socket.AF_INET6, ip) + port.to_bytes(2, 'big'))
+    else:
+      peers4.append(socket.inet_aton(ip) + port.to_bytes(2, 'big'))
+
+  return b''.join(peers4), b''.join(peers6)
+
+
+def message(pex_id, added, dropped):
+  '''A ut_pex message for the given added and dropped addresses'''
+
+  added4, added6 = compact(added)
+  dropped4, dropped6 = compact(dropped)
+
+  return pwp.extended(pex_id, torrent.bencode({
+    'added': added4, 'added.f': bytes(len(added4) // 6),
+    'added6': added6, 'added6.f': bytes(len(added6) // 18),
+    'dropped': dropped4, 'dropped6': dropped6}))
+
+
+def parse(data):
+  '''Decode a ut_pex message. Returns the added and dropped addresses.'''
+
+  update = torrent.parse_bencode(data)[0]
+
+  if not isinstance(update, dict):
+    raise Exception('invalid ut_pex message')
+
+  added = tracker.parse_compact_peers(update.get('added', b'')) + tracker.parse_compact_peers6(update.get('added6', b''))
+  dropped = tracker.parse_compact_peers(update.get('dropped', b'')) + tracker.parse_compact_peers6(update.get('dropped6', b''))
+
+  return added, dropped
+
+
+def updates(conns, only=None):
+  '''Yield (conn, message) for every connection whose view of its swarm
+     has changed since it was last sent an update (or only for the given
+     connection)'''
+
+  # The listen addresses of the peers of each torrent
+  swarms = collections.defaultdict(set)
+
+  for conn in conns:
+    if conn['listen'] is not None:
+      swarms[conn['infohash']].add(conn['listen'])
+
+  for conn in conns:
+    if conn['pex_id'] is None or (only is not None and conn is not only):
+      continue
+
+    others = swarms[conn['infohash']] - {conn['listen']}
+
+    added = list(others - conn['pex_sent'])[:MAX_PEERS]
+    dropped = list(conn['pex_sent'] - others)[:MAX_PEERS]
+
+    if added or dropped:
+      conn['pex_sent'] = (conn['pex_sent'] | set(added)) - set(dropped)
+      yield conn, message(conn['pex_id'], added, dropped)
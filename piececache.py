@@ -0,0 +1,103 @@
+'''A piece cache shared between processes
+
+The cache lives in an anonymous shared memory mapping that is created
+before the seeder forks its workers, so every worker sees the pieces that
+any of them has read from disk. It is a direct-mapped array of fixed-size
+slots: each piece can only live in the slot its (infohash, index) hashes
+to, and a newer piece simply replaces the old one. Pieces larger than a
+slot are never cached.
+
+Each slot starts with a header holding the infohash, piece index and
+length of the piece stored in it (a length of zero marks an empty slot).
+Slots are guarded by a small set of striped locks, also created before
+the fork.
+'''
+
+# Stdlib
+import mmap, struct, zlib, multiprocessing
+
+
+# Slot header: infohash, piece index, piece length
+HEADER = struct.Struct('>20sII')
+
+# Space reserved for the header at the start of each slot
+HEADER_SIZE = 32
+
+
+class SharedPieceCache():
+  '''Direct-mapped piece cache in shared memory'''
+
+  def __init__(self, size, slot_size=2**20, stripes=64):
+
+    # The largest piece that can be cached
+    self.slot_size = slot_size
+
+    self.stride = HEADER_SIZE + slot_size
+    self.num_slots = size // self.stride
+
+    if self.num_slots == 0:
+      raise Exception('cache size must be at least {} bytes'.format(self.stride))
+
+    # Anonymous mappings are shared with forked children
+    self.mem = mmap.mmap(-1, self.num_slots * self.stride)
+
+    ctx = multiprocessing.get_context('fork')
+    self.locks = [ctx.Lock() for _ in range(stripes)]
+
+
+  def _slot(self, infohash, index):
+    '''The slot number for a piece'''
+    return zlib.crc32(index.to_bytes(4, 'big'), zlib.crc32(infohash)) % self.num_slots
+
+
+  def get(self, infohash, index, begin, length):
+    '''Return a block of a cached piece, or None if it is not cached'''
+
+    slot = self._slot(infohash, index)
+    offset = slot * self.stride
+
+    with self.locks[slot % len(self.locks)]:
+      cached_hash, cached_index, piece_len = HEADER.unpack_from(self.mem, offset)
+
+      if piece_len == 0 or cached_index != index or cached_hash != infohash or begin + length > piece_len:
+        return None
+
+      start = offset + HEADER_SIZE + begin
+      return self.mem[start : start + length]
+
+
+  def put(self, infohash, index, piece):
+    '''Cache a piece, replacing whatever was in its slot'''
+
+    if len(piece) == 0 or len(piece) > self.slot_size:
+      return
+
+    slot = self._slot(infohash, index)
+    offset = slot * self.stride
+
+    with self.locks[slot % len(self.locks)]:
+      self.mem[offset + HEADER_SIZE : offset + HEADER_SIZE + len(piece)] = piece
+      HEADER.pack_into(self.mem, offset, infohash, index, len(piece))
+
+
+  def pieces(self, infohash, limit):
+    '''Up to limit indices of the pieces of a torrent that are cached'''
+
+    found = []
+
+    # Headers are read without taking the locks: a torn read can only
+    # produce a useless answer, never a corrupt block
+    for slot in range(self.num_slots):
+      cached_hash, cached_index, piece_len = HEADER.unpack_from(self.mem, slot * self.stride)
+
+      if piece_len != 0 and cached_hash == infohash:
+        found.append(cached_index)
+
+        if len(found) == limit:
+          break
+
+    return found
+
+
+  def close(self):
+    self.mem.close()
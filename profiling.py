@@ -0,0 +1,318 @@
+'''On-demand profiling and allocation tracing
+
+Instrumentation that can be switched on in a running seeder and costs
+nothing while it is off:
+
+  SIGUSR1  start a profile of the I/O thread, or stop it early. The profile
+           stops by itself after a number of seconds and its stats are
+           written to the output directory.
+  SIGUSR2  start tracemalloc; the next SIGUSR2 writes a report of the
+           largest allocation sites and the bytes per connection, then
+           stops tracing.
+
+The same controls, plus timing spans, are available as commands on the
+metrics endpoint (see Profiler.routes):
+
+  /debug/profile?seconds=30&mode=cprofile|sample
+  /debug/tracemalloc?action=start|snapshot|stop
+  /debug/spans?enable=1|0
+
+Spans are timed regions of the hot path (data_received, message dispatch,
+disk reads and hashing). Code marks a span with
+
+  timed = profiling.spans
+  if timed:
+    started = time.perf_counter()
+  ...
+  if timed:
+    profiling.record('name', started)
+
+so a disabled span costs a single attribute lookup. Span durations are
+reported in the simpletorrent_span_seconds histogram.
+'''
+
+# Stdlib
+import os, sys, signal, threading, time, cProfile, pstats, tracemalloc, collections, io
+
+# Project
+import metrics
+
+
+# Are timing spans enabled?
+spans = False
+
+SPAN_SECONDS = metrics.histogram('simpletorrent_span_seconds', 'Duration of timed regions of the hot path', ['span'])
+
+# Children of SPAN_SECONDS, by span name
+_span_children = dict()
+
+
+def record(name, started):
+  '''Record a span that started at the given perf_counter() time'''
+  record_duration(name, time.perf_counter() - started)
+
+
+def record_duration(name, seconds):
+  '''Record a span that took the given number of seconds'''
+
+  child = _span_children.get(name)
+
+  if child is None:
+    child = _span_children[name] = SPAN_SECONDS.labels(name)
+
+  child.observe(seconds)
+
+
+def enable_spans(enabled=True):
+  global spans
+  spans = enabled
+
+
+class Sampler():
+  '''A statistical profiler for one thread
+
+     A background thread records the stack of the target thread at a fixed
+     interval. Stacks are counted in the "folded" format used by
+     flamegraph tools: one line per distinct stack, frames separated by
+     semicolons, followed by the number of samples.
+  '''
+
+  def __init__(self, thread_id, interval=0.005):
+    self.thread_id = thread_id
+    self.interval = interval
+    self.stacks = collections.Counter()
+    self.running = False
+    self.thread = None
+
+  def start(self):
+    self.running = True
+    self.thread = threading.Thread(target=self._run, name='sampler', daemon=True)
+    self.thread.start()
+
+  def stop(self):
+    self.running = False
+    self.thread.join()
+
+  def _run(self):
+    while self.running:
+      frame = sys._current_frames().get(self.thread_id)
+      stack = []
+
+      while frame is not None:
+        code = frame.f_code
+        stack.append('{}:{}:{}'.format(os.path.basename(code.co_filename), code.co_name, frame.f_lineno))
+        frame = frame.f_back
+
+      if stack:
+        self.stacks[';'.join(reversed(stack))] += 1
+
+      time.sleep(self.interval)
+
+  def dump(self, file_name):
+    with open(file_name, 'w') as f:
+      for stack, count in self.stacks.most_common():
+        f.write('{} {}\n'.format(stack, count))
+
+
+class Profiler():
+  '''Runtime-toggleable profiling of the thread that installs it
+
+     connections is a function returning the number of open connections,
+     used to report allocated bytes per connection.
+  '''
+
+  def __init__(self, output_dir='.', seconds=30, mode='cprofile', connections=None):
+
+    # Where stats and reports are written
+    self.output_dir = output_dir
+
+    # Default profile length and profiler
+    self.seconds = seconds
+    self.mode = mode
+
+    self.connections = connections
+
+    # The running cProfile.Profile or Sampler, if any
+    self.profile = None
+
+    # Identifies the current profile, so a stale timer does not stop a newer one
+    self.session = 0
+
+    # The thread being profiled (signal handlers always run on it)
+    self.thread_id = threading.main_thread().ident
+
+    # Profile settings requested by a command, applied by the signal handler
+    self.requested = None
+
+    self.lock = threading.Lock()
+
+
+  def install(self):
+    '''Install the SIGUSR1 and SIGUSR2 handlers (must run on the main thread)'''
+
+    signal.signal(signal.SIGUSR1, lambda signum, frame: self.toggle())
+    signal.signal(signal.SIGUSR2, lambda signum, frame: self.toggle_tracemalloc())
+
+
+  def _output_file(self, kind, extension):
+    return os.path.join(self.output_dir, '{}-{}-{}.{}'.format(kind, os.getpid(), int(time.time()), extension))
+
+
+  def toggle(self):
+    '''Start a profile, or stop the running one'''
+
+    if self.profile is None:
+      seconds, mode = self.requested or (self.seconds, self.mode)
+      self.requested = None
+      self.start(seconds, mode)
+    else:
+      self.stop()
+
+
+  def start(self, seconds, mode):
+    '''Profile the calling thread for the given number of seconds'''
+
+    if self.profile is not None:
+      return
+
+    if mode == 'sample':
+      self.profile = Sampler(self.thread_id)
+      self.profile.start()
+    else:
+      self.profile = cProfile.Profile()
+      self.profile.enable()
+
+    self.session += 1
+    session = self.session
+
+    # cProfile must be stopped on the thread it profiles, so the timer
+    # delivers the same signal that started it
+    timer = threading.Timer(seconds, self._expire, (session,))
+    timer.daemon = True
+    timer.start()
+
+    print('profiling ({}) for {} seconds'.format(mode, seconds), file=sys.stderr)
+
+
+  def _expire(self, session):
+    if self.session == session and self.profile is not None:
+      os.kill(os.getpid(), signal.SIGUSR1)
+
+
+  def stop(self):
+    '''Stop the running profile and write its stats'''
+
+    if self.profile is None:
+      return None
+
+    profile, self.profile = self.profile, None
+
+    if isinstance(profile, Sampler):
+      profile.stop()
+      file_name = self._output_file('profile', 'folded')
+      profile.dump(file_name)
+    else:
+      profile.disable()
+      file_name = self._output_file('profile', 'pstats')
+      profile.dump_stats(file_name)
+
+    print('profile written to ' + file_name, file=sys.stderr)
+
+    return file_name
+
+
+  def toggle_tracemalloc(self):
+    '''Start tracing allocations, or report on them and stop'''
+
+    if tracemalloc.is_tracing():
+      self.tracemalloc_report()
+      tracemalloc.stop()
+    else:
+      tracemalloc.start(16)
+
+
+  def tracemalloc_report(self, limit=25):
+    '''Write a report of the largest allocation sites. Returns its text.'''
+
+    snapshot = tracemalloc.take_snapshot()
+    snapshot = snapshot.filter_traces([tracemalloc.Filter(False, tracemalloc.__file__)])
+
+    stats = snapshot.statistics('lineno')
+    total = sum(stat.size for stat in stats)
+    conns = self.connections() if self.connections is not None else 0
+
+    out = io.StringIO()
+    out.write('traced: {} bytes in {} blocks\n'.format(total, sum(stat.count for stat in stats)))
+
+    if conns > 0:
+      out.write('connections: {}, bytes per connection: {:.0f}\n'.format(conns, total / conns))
+
+    out.write('\ntop {} allocation sites:\n'.format(limit))
+    for stat in stats[:limit]:
+      out.write('{}\n'.format(stat))
+
+    out.write('\ntop 5 allocation stacks:\n')
+    for stat in snapshot.statistics('traceback')[:5]:
+      out.write('\n{} bytes in {} blocks\n'.format(stat.size, stat.count))
+      out.write('\n'.join(stat.traceback.format()) + '\n')
+
+    report = out.getvalue()
+
+    file_name = self._output_file('tracemalloc', 'txt')
+    with open(file_name, 'w') as f:
+      f.write(report)
+
+    print('allocation report written to ' + file_name, file=sys.stderr)
+
+    return report
+
+
+  def routes(self):
+    '''Commands for the metrics endpoint (see metrics.serve)'''
+
+    return {
+      '/debug/profile': self._profile_command,
+      '/debug/tracemalloc': self._tracemalloc_command,
+      '/debug/spans': self._spans_command,
+    }
+
+
+  def _profile_command(self, params):
+
+    with self.lock:
+      if self.profile is not None:
+        os.kill(os.getpid(), signal.SIGUSR1)
+        return 'stopping profile\n'
+
+      seconds = float(params.get('seconds', self.seconds))
+      mode = params.get('mode', self.mode)
+
+      # The signal handler starts the profile on the profiled thread
+      self.requested = (seconds, mode)
+      os.kill(os.getpid(), signal.SIGUSR1)
+
+    return 'profiling ({}) for {} seconds\n'.format(mode, seconds)
+
+
+  def _tracemalloc_command(self, params):
+
+    action = params.get('action', 'snapshot')
+
+    if action == 'start':
+      if not tracemalloc.is_tracing():
+        tracemalloc.start(16)
+      return 'tracing allocations\n'
+
+    if action == 'stop':
+      tracemalloc.stop()
+      return 'stopped tracing allocations\n'
+
+    if not tracemalloc.is_tracing():
+      return 'not tracing allocations (use action=start)\n'
+
+    return self.tracemalloc_report()
+
+
+  def _spans_command(self, params):
+    enable_spans(params.get('enable', '1') != '0')
+    return 'spans {}\n'.format('enabled' if spans else 'disabled')
@@ -4,31 +4,160 @@
 
 
 # Stdlib
-import socket, struct, threading, time
+import socket, struct, threading, time, hashlib, collections
 
+# Project
+import torrent
 
-def recv_until(conn, n, reattempts=3, pause=0.001):
 
-  msg = conn.recv(n)
+# Reserved handshake bits, as (byte, mask)
+FAST_EXTENSION = (7, 0x04)
+EXTENSION_PROTOCOL = (5, 0x10)
+V2 = (7, 0x10)
 
-  for _ in range(reattempts):
-    if len(msg) < n:
-      msg += conn.recv(n - len(msg))
-      time.sleep(pause)
-    else:
-      break
+# Requests we advertise that we can queue for a peer (BEP 10 'reqq')
+DEFAULT_REQQ = 250
+
+# The number of allowed fast pieces given to a choked peer (BEP 6)
+ALLOWED_FAST_COUNT = 10
+
+# The largest block a peer may request, cancel or reject. Clients ask
+# for 16 KiB; anything past 128 KiB is refused by every other client.
+MAX_BLOCK_LENGTH = 2**17
+
+# The longest message (without its length prefix) we accept before the
+# torrent is known: a piece message carrying the largest block. Longer
+# messages are refused before they are buffered.
+MAX_MESSAGE_LENGTH = 9 + MAX_BLOCK_LENGTH
+
+# The full bitfields sent by seeders, by number of pieces, kept for the
+# most recently used sizes (see full_bitfield)
+MAX_FULL_BITFIELDS = 64
+FULL_BITFIELDS = collections.OrderedDict()
+
+
+class SocketReader():
+  '''Buffered reader for a blocking socket
+
+     Data is received with recv_into into a reusable bytearray, in chunks
+     larger than the messages being read, and messages are served from
+     that buffer. Each read waits at most `timeout` seconds in total.
+  '''
+
+  def __init__(self, conn, timeout=30.0, bufsize=2**18):
+
+    self.conn = conn
+
+    # Seconds to wait for a complete read (None waits forever)
+    self.timeout = timeout
+
+    # The receive buffer and a view used to fill it without copying
+    self.buf = bytearray(bufsize)
+    self.view = memoryview(self.buf)
+
+    # The unread data is buf[start:end]
+    self.start = 0
+    self.end = 0
+
+
+  def buffered(self):
+    '''The number of bytes received but not yet read'''
+    return self.end - self.start
+
+
+  def read(self, n):
+    '''Read exactly n bytes
+
+       Returns b'' if the connection was closed before any of the bytes
+       arrived, and raises an exception if it was closed part way through
+       or the timeout expires.
+    '''
+
+    if self.end - self.start < n:
+      if not self._fill(n):
+        return b''
+
+    msg = bytes(self.view[self.start : self.start + n])
+    self.start += n
 
-  if len(msg) != n:
-    raise Exception ('Error: Failed to receive full message')
+    return msg
 
-  return msg
+
+  def _fill(self, n):
+    '''Receive until at least n bytes are buffered'''
+
+    avail = self.end - self.start
+
+    # Grow the buffer for messages larger than it
+    if n > len(self.buf):
+      buf = bytearray(max(n, 2 * len(self.buf)))
+      buf[:avail] = self.view[self.start : self.end]
+      self.view.release()
+      self.buf, self.view = buf, memoryview(buf)
+      self.start, self.end = 0, avail
+
+    # Move the unread data to the front of the buffer
+    elif avail == 0 or self.start + n > len(self.buf):
+      self.buf[:avail] = self.buf[self.start : self.end]
+      self.start, self.end = 0, avail
+
+    deadline = None if self.timeout is None else time.monotonic() + self.timeout
+
+    # The socket's own timeout, put back once we are done with it
+    timeout = self.conn.gettimeout()
+
+    try:
+      while self.end - self.start < n:
+
+        if deadline is not None:
+          remaining = deadline - time.monotonic()
+          if remaining <= 0:
+            raise Exception('Error: Timed out waiting for full message')
+          self.conn.settimeout(remaining)
+
+        try:
+          received = self.conn.recv_into(self.view[self.end:])
+        except socket.timeout:
+          raise Exception('Error: Timed out waiting for full message')
+
+        # The connection was closed
+        if received == 0:
+          if self.end == self.start:
+            return False
+          raise Exception('Error: Failed to receive full message')
+
+        self.end += received
+
+    finally:
+      if deadline is not None:
+        self.conn.settimeout(timeout)
+
+    return True
 
 
 def generate_peer_id():
   pass
 
 
-def create_handshake(info_hash, peer_id, protocol = 'BitTorrent protocol'):
+def reserved_bits(*extensions):
+  '''The reserved handshake bytes advertising the given extensions'''
+
+  reserved = bytearray(8)
+
+  for byte, mask in extensions:
+    reserved[byte] |= mask
+
+  return bytes(reserved)
+
+
+def supports(reserved, extension):
+  '''Does a peer's reserved handshake bytes advertise an extension?'''
+
+  byte, mask = extension
+  return len(reserved) == 8 and bool(reserved[byte] & mask)
+
+
+def create_handshake(info_hash, peer_id, protocol = 'BitTorrent protocol', reserved = bytes(8)):
   '''Create the bytestring for a handshake'''
 
   if len(protocol) > 255:
@@ -40,32 +169,34 @@ def create_handshake(info_hash, peer_id, protocol = 'BitTorrent protocol'):
   if len(peer_id) != 20:
     raise Exception('peer_id is not 20 bytes long')
 
+  if len(reserved) != 8:
+    raise Exception('reserved is not 8 bytes long')
+
   pstr_len = len(protocol).to_bytes(1, 'big')
   pstr = bytes(protocol, 'ascii')
-  reserved = b'\x00' * 8
 
   return pstr_len + pstr + reserved + info_hash + peer_id
 
 
-def receive_full_handshake(conn):
+def receive_full_handshake(reader):
 
-  ihash = receive_infohash(conn)
-  ihash['peer_id'] = receive_peer_id(conn)
+  ihash = receive_infohash(reader)
+  ihash['peer_id'] = receive_peer_id(reader)
 
   return ihash
 
 
-def receive_infohash(conn):
+def receive_infohash(reader):
 
   # Recieve the length of the protocol string
-  raw_len = conn.recv(1)
+  raw_len = reader.read(1)
 
   if len(raw_len) == 0:
     raise Exception('connection closed')
   else:
     pstr_len = ord(raw_len)
 
-  shake_body = recv_until(conn, 28 + pstr_len)
+  shake_body = reader.read(28 + pstr_len)
 
   return {
     'pstr': shake_body[:pstr_len],
@@ -85,9 +216,9 @@ def send_handshake_reply(conn, info_hash, this_peer_id):
   conn.send(pstr_len + pstr + reserved + info_hash + this_peer_id)
 
 
-def receive_peer_id(conn):
+def receive_peer_id(reader):
 
-  peer_id = recv_until(conn, 20)
+  peer_id = reader.read(20)
   return peer_id
 
 def keep_alive():
@@ -122,6 +253,142 @@ def port(listen_port):
   return b'\x00\x00\x00\x03\x09' + listen_port.to_bytes(2, 'big')
 
 
+def suggest_piece(index):
+  return b'\x00\x00\x00\x05\x0d' + index.to_bytes(4, 'big')
+
+def have_all():
+  return b'\x00\x00\x00\x01\x0e'
+
+def have_none():
+  return b'\x00\x00\x00\x01\x0f'
+
+def reject_request(index, begin, length):
+  return b'\x00\x00\x00\x0d\x10' + b''.join(x.to_bytes(4, 'big') for x in [index, begin, length])
+
+def allowed_fast(index):
+  return b'\x00\x00\x00\x05\x11' + index.to_bytes(4, 'big')
+
+
+def _hash_message(msg_id, root, base, index, length, proof_layers, hashes=b''):
+  return (49 + len(hashes)).to_bytes(4, 'big') + bytes([msg_id]) + root + HASH_HEADER.pack(base, index, length, proof_layers) + hashes
+
+
+def hash_request(root, base, index, length, proof_layers):
+  '''Ask for length hashes from index in layer base (0 for the leaves) of
+     the merkle tree with the given root, and proof_layers of the uncle
+     hashes above them (BEP 52)'''
+  return _hash_message(21, root, base, index, length, proof_layers)
+
+
+def hashes(root, base, index, length, proof_layers, hash_list):
+  '''The answer to a hash request: the hashes, then the uncle hashes'''
+  return _hash_message(22, root, base, index, length, proof_layers, b''.join(hash_list))
+
+
+def hash_reject(root, base, index, length, proof_layers):
+  '''Refuse a hash request'''
+  return _hash_message(23, root, base, index, length, proof_layers)
+
+
+def extended(ext_id, payload):
+  '''An extension protocol message (BEP 10)'''
+  return (len(payload) + 2).to_bytes(4, 'big') + b'\x14' + ext_id.to_bytes(1, 'big') + payload
+
+
+def extension_handshake(extensions, listen_port=None, reqq=DEFAULT_REQQ, version='SimpleTorrent'):
+  '''The extension protocol handshake, advertising the given mapping from
+     extension name to the message id we use for it'''
+
+  handshake = {'m': dict(extensions), 'reqq': reqq, 'v': version}
+
+  if listen_port is not None:
+    handshake['p'] = listen_port
+
+  return extended(0, torrent.bencode(handshake))
+
+
+def parse_extension_handshake(data):
+  '''Decode the payload of a peer's extension handshake'''
+
+  handshake = torrent.parse_bencode(data)[0]
+
+  if not isinstance(handshake, dict) or not isinstance(handshake.get('m', dict()), dict):
+    raise Exception('invalid extension handshake')
+
+  # Keep only the extensions with usable message ids
+  handshake['m'] = {name: ext_id for name, ext_id in handshake.get('m', dict()).items()
+    if isinstance(ext_id, int) and 0 <= ext_id < 256}
+
+  return handshake
+
+
+def bitfield(pieces, num_pieces):
+  '''A bitfield message for the given set of piece indices'''
+
+  field = bytearray((num_pieces + 7) // 8)
+
+  for index in pieces:
+    field[index // 8] |= 128 >> (index % 8)
+
+  return (len(field) + 1).to_bytes(4, 'big') + b'\x05' + bytes(field)
+
+
+def full_bitfield(num_pieces):
+  '''A bitfield message with all num_pieces pieces set, built once for
+     each torrent size rather than a bit at a time for every connection'''
+
+  message = FULL_BITFIELDS.get(num_pieces)
+
+  if message is not None:
+    FULL_BITFIELDS.move_to_end(num_pieces)
+    return message
+
+  # Whole bytes of set bits, then the bits of the last partial byte
+  field = b'\xff' * (num_pieces // 8)
+
+  if num_pieces % 8:
+    field += bytes([0xff << (8 - num_pieces % 8) & 0xff])
+
+  message = FULL_BITFIELDS[num_pieces] = (len(field) + 1).to_bytes(4, 'big') + b'\x05' + field
+
+  if len(FULL_BITFIELDS) > MAX_FULL_BITFIELDS:
+    FULL_BITFIELDS.popitem(last=False)
+
+  return message
+
+
+def allowed_fast_set(ip, info_hash, num_pieces, k=ALLOWED_FAST_COUNT):
+  '''The canonical allowed fast set for a peer (BEP 6)
+
+     Only defined for IPv4 peers; other addresses get an empty set.
+  '''
+
+  try:
+    address = socket.inet_aton(ip)
+  except OSError:
+    return []
+
+  k = min(k, num_pieces)
+  pieces = []
+
+  # Peers in the same /24 get the same set
+  x = bytes(address[:3]) + b'\x00' + info_hash
+
+  while len(pieces) < k:
+    x = hashlib.sha1(x).digest()
+
+    for i in range(5):
+      if len(pieces) >= k:
+        break
+
+      index = struct.unpack_from('>I', x, 4 * i)[0] % num_pieces
+
+      if index not in pieces:
+        pieces.append(index)
+
+  return pieces
+
+
 def request_all(file_size):
   piece_size = 2**18
   block_size = 2**14
@@ -147,34 +414,167 @@ def request_all(file_size):
   return b''.join( request(i, j*block_size, block_size) for i in range(num_whole_pieces) for j in range(blocks_per_piece) ) + t + v
 
  
+def piece_blocks(index, file_len, piece_size=2**18, block_size=2**14):
+  '''The (begin, length) of every block of a piece'''
+
+  start = index * piece_size
+  end = min(start + piece_size, file_len)
+
+  return [(begin - start, min(block_size, end - begin)) for begin in range(start, end, block_size)]
+
+
 def request_piece(index, file_len, piece_size=2**18, block_size=2**14):
   '''Request an entire piece'''
+  return b''.join(request(index, begin, length) for begin, length in piece_blocks(index, file_len, piece_size, block_size))
+
+
+def cancel_piece(index, file_len, piece_size=2**18, block_size=2**14):
+  '''Cancel the requests for an entire piece'''
+  return b''.join(cancel(index, begin, length) for begin, length in piece_blocks(index, file_len, piece_size, block_size))
+
+
+# Ids of the pseudo-messages produced by the parsers, which are not sent
+# on the wire
+INFOHASH = -4
+PEER_ID = -3
+CLOSED = -2
+KEEP_ALIVE = -1
+
+# Message names, by id (used for logging and metrics)
+NAMES = {INFOHASH: 'infohash', PEER_ID: 'peer_id', CLOSED: 'closed', KEEP_ALIVE: 'keep-alive',
+  0: 'choke', 1: 'unchoke', 2: 'interested', 3: 'uninterested', 4: 'have',
+  5: 'bitfield', 6: 'request', 7: 'piece', 8: 'cancel', 9: 'port',
+  13: 'suggest_piece', 14: 'have_all', 15: 'have_none', 16: 'reject_request',
+  17: 'allowed_fast', 20: 'extended', 21: 'hash_request', 22: 'hashes', 23: 'hash_reject'}
+
+
+class Message(collections.namedtuple('Message', ['id', 'payload'])):
+  '''A message received from a peer
+
+     The payload is None, an int (have, suggest_piece, allowed_fast and
+     port), bytes (bitfield, infohash and peer_id), a Block (request,
+     cancel and reject_request), a Piece, an Extended, a HashRequest
+     (hash_request and hash_reject) or Hashes.
+  '''
+
+  __slots__ = ()
+
+  @property
+  def name(self):
+    return NAMES[self.id]
+
+
+Block = collections.namedtuple('Block', ['index', 'begin', 'length'])
+Piece = collections.namedtuple('Piece', ['index', 'begin', 'block'])
+Extended = collections.namedtuple('Extended', ['id', 'data'])
+HashRequest = collections.namedtuple('HashRequest', ['root', 'base', 'index', 'length', 'proof_layers'])
+
+# hashes holds the requested hashes followed by the uncle hashes
+Hashes = collections.namedtuple('Hashes', ['root', 'base', 'index', 'length', 'proof_layers', 'hashes'])
+
+# Messages without a payload are shared rather than allocated
+CLOSED_MESSAGE = Message(CLOSED, None)
+KEEP_ALIVE_MESSAGE = Message(KEEP_ALIVE, None)
+
+LENGTH = struct.Struct('>I')
+INDEX = struct.Struct('>xI')
+BLOCK = struct.Struct('>xIII')
+PIECE_HEADER = struct.Struct('>xII')
+PORT = struct.Struct('>xH')
+HASH_HEADER = struct.Struct('>IIII')
+
+
+# Payload decoders. Each is given a buffer and the bounds of a message
+# (without its length prefix) within it.
+
+def _no_payload(buf, start, end):
+  return None
+
+def _index(buf, start, end):
+  if end - start != INDEX.size:
+    raise Exception('Invalid message length')
+  return INDEX.unpack_from(buf, start)[0]
+
+def _bytes(buf, start, end):
+  return buf[start + 1 : end]
 
-  net_offset = index * piece_size
-  reqs = []
+def _block(buf, start, end):
+  if end - start != BLOCK.size:
+    raise Exception('Invalid message length')
+  block = Block._make(BLOCK.unpack_from(buf, start))
+  if block.length > MAX_BLOCK_LENGTH:
+    raise Exception('Invalid block length')
+  return block
 
-  # Create individual requests
-  for i in range(16):
-    if net_offset >= file_len:
-      break
+def _piece(buf, start, end):
+  if end - start < PIECE_HEADER.size:
+    raise Exception('Invalid message length')
+  index, begin = PIECE_HEADER.unpack_from(buf, start)
+  return Piece(index, begin, buf[start + PIECE_HEADER.size : end])
 
-    reqs.append(request(index, i*block_size, min(block_size, file_len - net_offset)))
-    net_offset += block_size
+def _port(buf, start, end):
+  if end - start != PORT.size:
+    raise Exception('Invalid message length')
+  return PORT.unpack_from(buf, start)[0]
 
-  # Join all requests into single byte-string
-  return b''.join(reqs)
+def _extended(buf, start, end):
+  if end - start < 2:
+    raise Exception('Invalid message length')
+  return Extended(buf[start + 1], buf[start + 2 : end])
+
+
+def _hash_request(buf, start, end):
+  if end - start != 33 + HASH_HEADER.size:
+    raise Exception('Invalid message length')
+  return HashRequest(bytes(buf[start + 1 : start + 33]), *HASH_HEADER.unpack_from(buf, start + 33))
+
+def _hashes(buf, start, end):
+  if end - start < 33 + HASH_HEADER.size or (end - start - 33 - HASH_HEADER.size) % 32:
+    raise Exception('Invalid message length')
+  hash_list = buf[start + 33 + HASH_HEADER.size : end]
+  return Hashes(bytes(buf[start + 1 : start + 33]), *HASH_HEADER.unpack_from(buf, start + 33),
+    [bytes(hash_list[i : i + 32]) for i in range(0, len(hash_list), 32)])
+
+
+# The payload decoder for every message id, or None for invalid ids
+DECODERS = [None] * 256
+
+for ids, decoder in [((0, 1, 2, 3, 14, 15), _no_payload), ((4, 13, 17), _index), ((5,), _bytes),
+    ((6, 8, 16), _block), ((7,), _piece), ((9,), _port), ((20,), _extended), ((21, 23), _hash_request), ((22,), _hashes)]:
+  for msg_id in ids:
+    DECODERS[msg_id] = decoder
+
+
+def decode(buf, start, end):
+  '''Decode the message at buf[start:end] (without its length prefix)'''
+
+  msg_id = buf[start]
+  decoder = DECODERS[msg_id]
+
+  if decoder is None:
+    raise Exception('Invalid message received')
+
+  return Message(msg_id, decoder(buf, start, end))
 
 
 class MessageParser():
   '''Class for parsing PWP messages
 
-     TODO: Perhaps turn this into an iterator?
+     Received data is appended to a buffer, and messages are decoded in
+     place from a read position, so the buffer is only copied once per
+     add rather than once per message.
   '''
 
-  def __init__(self, initial_data=b''):
+  def __init__(self, initial_data=b'', max_length=MAX_MESSAGE_LENGTH):
 
     # Any initial data to place in the buffer
-    self.unread= initial_data
+    self.unread = initial_data
+
+    # The longest message we accept (see max_message_length)
+    self.max_length = max_length
+
+    # The position of the next message in the buffer
+    self.pos = 0
 
     # Have we seen the infohash yet?
     self.infohash = False
@@ -182,6 +582,9 @@ class MessageParser():
     # Have we seen the peer_id yet?
     self.peer_id = False
 
+    # The reserved bytes of the peer's handshake
+    self.reserved = bytes(8)
+
 
   def __iter__(self):
     return self
@@ -189,41 +592,71 @@ class MessageParser():
 
   def add(self, data):
     '''Add more data to the buffer'''
-    self.unread += data
+
+    # Drop the messages that have been parsed
+    if self.pos:
+      self.unread = self.unread[self.pos:] + data
+      self.pos = 0
+    else:
+      self.unread += data
 
 
   def has_next(self):
     '''Indicates whether there is a complete message in the buffer'''
 
+    avail = len(self.unread) - self.pos
+
     # We are waiting on the infohash
     if not self.infohash:
-      if len(self.unread) > 0:
-        handshake_len = 49 + self.unread[0]
-        if len(self.unread) >= handshake_len:
-          return True
-
-      return False
+      return avail > 0 and avail >= 49 + self.unread[self.pos]
 
     # We are waiting on the peer_id
     if not self.peer_id:
-      return len(self.unread) >= 20
+      return avail >= 20
 
     # We are waiting on a normal message
-    if len(self.unread) < 4:
+    if avail < 4:
       return False
 
-    # Read the length of the next message
-    msg_len = struct.unpack('>I', self.unread[:4])[0]
+    length = LENGTH.unpack_from(self.unread, self.pos)[0]
+
+    # Refuse messages longer than any valid one, rather than buffer them
+    if length > self.max_length:
+      raise Exception('Message too long')
 
     # Check if the entire message is in the buffer
-    return len(self.unread) >= 4+msg_len
+    return avail >= 4 + length
 
 
   def __next__(self):
     '''Parse and return the next message'''
 
-    # A dictionary representing the parsed message
-    resp = {'id': -2, 'name': '', 'payload': None}
+    unread, pos = self.unread, self.pos
+
+    # The common case: a normal message
+    if self.peer_id:
+      if len(unread) - pos < 4:
+        raise StopIteration()
+
+      length = LENGTH.unpack_from(unread, pos)[0]
+
+      if length > self.max_length:
+        raise Exception('Message too long')
+
+      start = pos + 4
+      end = start + length
+
+      # There are no more complete messages to parse
+      if len(unread) < end:
+        raise StopIteration()
+
+      self.pos = end
+
+      # Handle the keep-alive message
+      if start == end:
+        return KEEP_ALIVE_MESSAGE
+
+      return decode(unread, start, end)
 
     # There are no more messages to parse
     if not self.has_next():
@@ -231,135 +664,52 @@ class MessageParser():
 
     # The next 'message' is the infohash
     if not self.infohash:
-      resp['name'] = 'infohash'
-      pstr_len = self.unread[0]
-      resp['payload'] = self.unread[pstr_len+9 : pstr_len+29]
-      self.unread = self.unread[29+pstr_len:]
+      pstr_len = unread[pos]
+      self.reserved = bytes(unread[pos+pstr_len+1 : pos+pstr_len+9])
+      self.pos = pos + 29 + pstr_len
       self.infohash = True
-      return resp
+      return Message(INFOHASH, unread[pos+pstr_len+9 : pos+pstr_len+29])
 
     # The next 'message' is the peer_id
-    if not self.peer_id:
-      resp['name'] = 'peer_id'
-      resp['payload'] = self.unread[:20]
-      self.unread = self.unread[20:]
-      self.peer_id = True
-      return resp
-
-    # Read the length of the next message
-    msg_len = struct.unpack('>I', self.unread[:4])[0]
-
-    # Handle the keep-alive message
-    if msg_len == 0:
-      resp['id'] = -1
-      resp['name'] = 'keep-alive'
-      self.unread = self.unread[4:]
-      return resp
-
-    msg = self.unread[4:4 + msg_len]
-
-    # TODO: Check if the msg id is an ascii decimal
-    resp['id'] = msg[0]
-     
-    # Get payload if it exists
-    if resp['id'] == 0:
-      resp['name'] = 'choke' 
-    elif resp['id'] == 1:
-      resp['name'] = 'unchoke'
-    elif resp['id'] == 2:
-      resp['name'] = 'interested'
-    elif resp['id'] == 3:
-      resp['name'] = 'uninterested'
-    elif resp['id'] == 4:
-      resp['name'] = 'have'
-      resp['payload'] = struct.unpack('>I', msg[1:])[0]
-    elif resp['id'] == 5:
-      resp['name'] = 'bitfield'
-      resp['payload'] = msg[1:]
-    elif resp['id'] == 6:
-      resp['name'] = 'request'
-      index, begin, length = struct.unpack('>III', msg[1:])
-      resp['payload'] = { 'index': index, 'begin': begin, 'length': length }
-    elif resp['id'] == 7:
-      resp['name'] = 'piece'
-      index, begin = struct.unpack('>II', msg[1:9])
-      resp['payload'] = { 'index': index, 'begin': begin, 'block': msg[9:] }
-    elif resp['id'] == 8:
-      resp['name'] = 'cancel'
-      index, begin, length = struct.unpack('>III', msg[1:])
-      resp['payload'] = { 'index': index, 'begin': begin, 'length': length }
-    elif resp['id'] == 9:
-      resp['name'] = 'port'
-      resp['payload'] = struct.unpack('>H', msg[1:])[0]
-    else:
-      # Invalid msg id
-      raise Exception('Invalid message received')
-
-    # Advance the buffer
-    self.unread = self.unread[4 + msg_len:]
-
-    return resp
+    self.pos = pos + 20
+    self.peer_id = True
+    return Message(PEER_ID, unread[pos : pos+20])
 
   def next(self):
     return self.__next__()
 
 
-def parse_next_message(conn):
-  '''Parse the next message received from a peer'''
+def max_message_length(num_pieces):
+  '''The longest valid message for a torrent of num_pieces pieces: a
+     piece message or, in large torrents, a bitfield'''
+  return max(MAX_MESSAGE_LENGTH, 1 + (num_pieces + 7) // 8)
+
+
+def parse_next_message(reader, max_length=MAX_MESSAGE_LENGTH):
+  '''Parse the next message received from a peer
 
-  resp = {'id': -2, 'name': '', 'payload': ''}
+     The reader is the SocketReader for the peer's connection, and
+     messages longer than max_length are refused.
+  '''
 
   # Get the length of the next message
-  len_prefix = recv_until(conn, 4)
+  len_prefix = reader.read(4)
 
   # Check if connection is closed
   if len(len_prefix) == 0:
-    return resp
+    return CLOSED_MESSAGE
 
-  msg_len = struct.unpack('>I', len_prefix)[0]
+  msg_len = LENGTH.unpack(len_prefix)[0]
 
   if msg_len == 0:
-    resp['id'] = -1
-    resp['name'] = 'keep-alive'
-    return resp
-
-  remaining = recv_until(conn, msg_len)
-
-  resp['id'] = remaining[0]
-
-  # Get payload if it exists
-  if resp['id'] == 0:
-    resp['name'] = 'choke' 
-  elif resp['id'] == 1:
-    resp['name'] = 'unchoke'
-  elif resp['id'] == 2:
-    resp['name'] = 'interested'
-  elif resp['id'] == 3:
-    resp['name'] = 'uninterested'
-  elif resp['id'] == 4:
-    resp['name'] = 'have'
-    resp['payload'] = struct.unpack('>I', remaining[1:])[0]
-  elif resp['id'] == 5:
-    resp['name'] = 'bitfield'
-    resp['payload'] = remaining[1:]
-  elif resp['id'] == 6:
-    resp['name'] = 'request'
-    index, begin, length = struct.unpack('>III', remaining[1:])
-    resp['payload'] = { 'index': index, 'begin': begin, 'length': length }
-  elif resp['id'] == 7:
-    resp['name'] = 'piece'
-    index, begin = struct.unpack('>II', remaining[1:9])
-    resp['payload'] = { 'index': index, 'begin': begin, 'block': remaining[9:] }
-  elif resp['id'] == 8:
-    resp['name'] = 'cancel'
-    index, begin, length = struct.unpack('>III', remaining[1:])
-    resp['payload'] = { 'index': index, 'begin': begin, 'length': length }
-  elif resp['id'] == 9:
-    resp['name'] = 'port'
-    resp['payload'] = struct.unpack('>H', remaining[1:])[0]
-  else:
-    # Invalid msg id
-    raise Exception('Invalid message received')
+    return KEEP_ALIVE_MESSAGE
+
+  if msg_len > max_length:
+    raise Exception('Error: Message too long')
+
+  msg = reader.read(msg_len)
 
-  return resp
+  if len(msg) == 0:
+    raise Exception('Error: Failed to receive full message')
 
+  return decode(msg, 0, len(msg))
@@ -0,0 +1,196 @@
+'''The order in which received messages are handled
+
+Messages are split into two classes. Control messages (everything but
+requests and pieces) are small and are always handled first, so that
+chokes, haves and extension messages see the same latency however busy
+we are. Bulk messages (requests and pieces) are handled by deficit round
+robin weighted by the bytes they move: every round, each torrent with
+waiting messages is given a quantum of bytes times its weight, which is
+shared among its peers the same way. A torrent with many peers therefore
+gets no more than its weight's share, and a peer asking for large blocks
+gets no more than a peer asking for small ones.
+
+Each peer is a dictionary holding its own queues and deficit, under the
+keys 'control', 'bulk', 'deficit' and 'weight', plus the 'infohash'
+and 'protocol' of its connection.
+'''
+
+# Stdlib
+import collections
+
+# Project
+import pwp
+
+
+# Bytes added to a torrent's or peer's deficit each round, per unit of weight
+QUANTUM = 2**18
+
+# Messages handled by the round robin. A closed connection is queued
+# behind the peer's bulk messages so they are handled before it is
+# cleaned up.
+BULK = frozenset([6, 7, pwp.CLOSED])
+
+
+def cost(msg):
+  '''The number of bytes a bulk message moves'''
+
+  # At most pwp.MAX_BLOCK_LENGTH, which the decoder checks
+  if msg.id == 6:
+    return msg.payload.length
+  if msg.id == 7:
+    return len(msg.payload.block)
+
+  return 0
+
+
+def blocked(peer):
+  '''Is the peer waiting for its write buffer or disk reads? (see
+     PeerWireProtocol.blocked)'''
+  return peer['protocol'].blocked()
+
+
+class _Torrent():
+
+  __slots__ = ('deficit', 'peers')
+
+  def __init__(self):
+    self.deficit = 0
+
+    # Peers with bulk messages waiting, in round robin order
+    self.peers = collections.deque()
+
+
+class Scheduler():
+  '''Queues the messages of every peer and decides which to handle next
+
+     torrent_weights maps infohashes, and peer_weights maps peer IP
+     addresses, to weights (1 if not given).
+  '''
+
+  def __init__(self, torrent_weights=None, peer_weights=None, quantum=QUANTUM):
+
+    self.torrent_weights = torrent_weights or dict()
+    self.peer_weights = peer_weights or dict()
+    self.quantum = quantum
+
+    if any(weight <= 0 for weight in list(self.torrent_weights.values()) + list(self.peer_weights.values())):
+      raise Exception('weights must be positive')
+
+    # Peers with control messages waiting, in arrival order
+    self.control = collections.deque()
+
+    # Mapping from infohash to the torrents with bulk messages waiting
+    self.active = collections.OrderedDict()
+
+    # The number of messages waiting
+    self.queued = 0
+
+
+  def __len__(self):
+    return self.queued
+
+  def add(self, peer):
+    '''Give a new peer its queues'''
+
+    peer['control'] = collections.deque()
+    peer['bulk'] = collections.deque()
+    peer['deficit'] = 0
+    peer['weight'] = self.peer_weights.get(peer['protocol'].peername[0], 1)
+
+
+  def push(self, peer, msg):
+    '''Queue a message received from a peer'''
+
+    self.queued += 1
+
+    if msg.id in BULK:
+      peer['bulk'].append(msg)
+
+      if len(peer['bulk']) == 1:
+        torrent = self.active.get(peer['infohash'])
+
+        if torrent is None:
+          torrent = self.active[peer['infohash']] = _Torrent()
+
+        torrent.peers.append(peer)
+
+    else:
+      peer['control'].append(msg)
+
+      if len(peer['control']) == 1:
+        self.control.append(peer)
+
+
+  def pending(self, peer):
+    '''Does the peer have messages waiting?'''
+    return bool(peer['control'] or peer['bulk'])
+
+  def bulk_waiting(self, peer):
+    '''The number of the peer's bulk messages waiting'''
+    return len(peer['bulk'])
+
+
+  def control_messages(self):
+    '''Yield (peer, message) for every waiting control message'''
+
+    while self.control:
+      peer = self.control.popleft()
+
+      while peer['control']:
+        self.queued -= 1
+        yield peer, peer['control'].popleft()
+
+
+  def round(self):
+    '''Yield (peer, message) for the bulk messages of one round'''
+
+    for infohash in list(self.active):
+      torrent = self.active[infohash]
+      torrent.deficit += self.quantum * self.torrent_weights.get(infohash, 1)
+
+      peers = torrent.peers
+
+      # Blocked peers passed over since one was last served
+      skipped = 0
+
+      while peers and skipped < len(peers):
+        peer = peers[0]
+
+        # Wait for the peer's write buffer to drain, or its reads to finish
+        if blocked(peer):
+          peers.rotate(-1)
+          skipped += 1
+          continue
+
+        msg = peer['bulk'][0]
+        size = cost(msg)
+
+        # The peer has used its share; it gets another on its next turn
+        if size > peer['deficit']:
+          peer['deficit'] += self.quantum * peer['weight']
+          peers.rotate(-1)
+          continue
+
+        # The torrent has used its share of this round
+        if size > torrent.deficit:
+          break
+
+        peer['bulk'].popleft()
+        peer['deficit'] -= size
+        torrent.deficit -= size
+        self.queued -= 1
+        skipped = 0
+
+        # Peers that are no longer waiting do not keep their deficit
+        if not peer['bulk']:
+          peer['deficit'] = 0
+          peers.popleft()
+
+        yield peer, msg
+
+      if not peers:
+        del self.active[infohash]
+
+      # Only a torrent limited by its share keeps its deficit
+      elif skipped >= len(peers):
+        torrent.deficit = 0
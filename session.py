@@ -0,0 +1,1187 @@
+#!/usr/bin/env python3.6
+'''Downloading many torrents in one event loop
+
+A Session downloads any number of torrents with a single event loop,
+worker (see async_seeder.worker) and file pool, under limits shared by
+all of them:
+
+  - At most max_active torrents are downloaded at a time. The others
+    wait in a queue, so that the active ones get all of the connections
+    and bandwidth and finish sooner.
+  - At most max_connections connections are open or being opened, split
+    evenly between the active torrents.
+  - At most rate bytes per second are received, over every connection
+    (see RateLimit).
+  - Downloaded pieces are held in memory up to a single budget before
+    they are written (see writeback.py). While it is used up, a download
+    holding more than its share stops requesting pieces until some are
+    written, so a torrent on a slow disk does not hold up the others.
+  - Completed pieces are hashed by a fixed number of threads.
+
+Within a torrent, pieces are handed to connections as they ask for them.
+Each connection has up to PIPELINE pieces requested at a time, and is
+given the next missing piece its peer has whenever one of them completes
+(or the peer announces new pieces), so faster peers download more of the
+torrent, and pieces held back by a super-seed (see superseed.py) or not
+yet downloaded by another leecher are fetched from whoever has them.
+
+Pieces can be given deadlines and priorities, and are requested in that
+order (then in file order). Download.read returns a range of the file
+as soon as its pieces are verified, giving them a deadline and the
+pieces after them later ones, so a file can be consumed while it
+downloads. Pieces near their deadline are requested straight away, past
+the pipeline, and from a second connection if one is already on them.
+
+A listening session also uploads: peers that connect to it are served
+the verified pieces of the torrents it is downloading, and every
+connected peer of a torrent is told about each piece as it is verified.
+'''
+
+# Stdlib
+import asyncio, collections, hashlib, heapq, logging, math, sys, time
+from concurrent.futures import ThreadPoolExecutor
+
+# Project
+import async_seeder, torrent, pwp, metrics, profiling, fdpool, diskio, scheduler, lifecycle, tracker, writeback, merkle
+
+
+log = logging.getLogger('session')
+
+DOWNLOADS = metrics.gauge('simpletorrent_downloads', 'Torrents in the download session, by state', ['state'])
+VERIFY_SECONDS = metrics.histogram('simpletorrent_piece_verify_seconds', 'Time spent hashing received pieces')
+VERIFY_FAILURES = metrics.counter('simpletorrent_piece_verify_failures_total', 'Received pieces that failed their hash check')
+BLOCKS_REDOWNLOADED = metrics.counter('simpletorrent_blocks_redownloaded_total', 'Blocks of v2 pieces downloaded again because they did not match their leaf hash')
+DEADLINE_MISSES = metrics.counter('simpletorrent_piece_deadline_misses_total', 'Pieces verified after their deadline')
+DUPLICATE_REQUESTS = metrics.counter('simpletorrent_duplicate_piece_requests_total', 'Pieces near their deadline requested from a second peer')
+READ_WAIT_SECONDS = metrics.histogram('simpletorrent_stream_read_wait_seconds', 'Time reads waited for their pieces to be verified')
+THROTTLED = metrics.counter('simpletorrent_download_throttled_total', 'Times a connection stopped reading to keep to the download rate')
+
+# Torrents downloaded at a time
+MAX_ACTIVE = 4
+
+# Connections open at a time, over every torrent
+MAX_CONNECTIONS = 200
+
+# Addresses of a torrent's peers queued at a time, of those learned from
+# other peers (ut_pex)
+MAX_ADDRESSES = 500
+
+# Threads hashing completed pieces
+VERIFY_THREADS = 2
+
+# Pieces requested from a connection at a time
+PIPELINE = 4
+
+# Seconds from a read to the deadline of the pieces it needs
+READ_DEADLINE = 1.0
+
+# Pieces after a read that are given deadlines too
+READAHEAD = 8
+
+# Pieces this close to their deadline (in seconds) are requested at once,
+# and from more than one connection
+HURRY = 2.0
+DUPLICATES = 2
+
+# Seconds between checks for pieces near their deadline
+HURRY_INTERVAL = 0.25
+
+
+def verify(data, expected, width=None):
+  '''Runs on a verification thread. Returns whether the data has the
+     expected hash, and the time taken.
+
+     The hash is SHA-1, or with a width, the root of the merkle tree of
+     that many leaves over the blocks of a v2 piece (see merkle.py).
+  '''
+
+  started = time.perf_counter()
+
+  if width is None:
+    valid = hashlib.sha1(data).digest() == expected
+  else:
+    valid = merkle.root(merkle.block_hashes(data), width) == expected
+
+  return valid, time.perf_counter() - started
+
+
+class RateLimit():
+  '''A token bucket for the bytes received over every connection
+
+     When the bucket runs dry, the connection that emptied it stops
+     reading (see PeerWireProtocol.throttle) until enough time has passed
+     to pay for what was read.
+  '''
+
+  def __init__(self, loop, rate, burst=None):
+
+    self.loop = loop
+
+    # Bytes per second
+    self.rate = rate
+
+    # The most bytes that may arrive at once (a second's worth by default)
+    self.burst = burst or rate
+
+    self.tokens = self.burst
+    self.updated = time.monotonic()
+
+    # Connections waiting for the bucket to refill
+    self.throttled = set()
+    self.timer = None
+
+
+  def consume(self, protocol, size):
+    '''Account for bytes a connection received'''
+
+    self._refill()
+    self.tokens -= size
+
+    if self.tokens < 0 and protocol not in self.throttled:
+      THROTTLED.inc()
+      protocol.throttle()
+      self.throttled.add(protocol)
+
+      if self.timer is None:
+        self.timer = self.loop.call_later(-self.tokens / self.rate, self._release)
+
+
+  def _refill(self):
+    now = time.monotonic()
+
+    self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+    self.updated = now
+
+
+  def _release(self):
+    '''Let the throttled connections read again, once the debt is paid'''
+
+    self.timer = None
+    self._refill()
+
+    # More was received since the timer was set
+    if self.tokens < 0:
+      self.timer = self.loop.call_later(-self.tokens / self.rate, self._release)
+      return
+
+    for protocol in self.throttled:
+      protocol.unthrottle()
+
+    self.throttled.clear()
+
+
+class Download():
+  '''A torrent downloaded by a session
+
+     Connections of the download call joined() once connected, completed()
+     for each piece whose blocks have all arrived, and left() once closed.
+
+     The pieces of a v2 (or hybrid) torrent are checked against their
+     merkle hashes. When one fails, the leaf hashes of its blocks are
+     asked of the peer that sent it, and only the blocks that do not
+     match them are downloaded again.
+
+     Pieces are requested in order of deadline, then priority, then
+     index. read() gives the pieces it needs a deadline and waits for
+     them to be verified.
+  '''
+
+  def __init__(self, session, torr, addresses):
+
+    self.session = session
+
+    self.torr = torr
+    self.infohash = torrent.infohash(torr)
+    self.name = torr['info']['name']
+    self.path = 'files/' + self.name
+
+    self.length = torrent.length(torr)
+    self.piece_length = torr['info']['piece length']
+    self.num_pieces = int(math.ceil(self.length / self.piece_length))
+
+    # Are the pieces hashed block by block (BEP 52)? If so, each piece
+    # hash is the root of a subtree of piece_width leaves.
+    self.v2 = torrent.is_v2(torr)
+
+    if self.v2:
+      self.root = torrent.pieces_root(torr)
+      self.piece_width = merkle.piece_width(self.length, self.piece_length)
+
+    # Mapping from the index of each v2 piece that failed its check to
+    # the connection asked for its leaf hashes, and the piece's data
+    self.repairs = dict()
+
+    # Peers not tried yet (asked of the tracker if there are none)
+    self.addresses = collections.deque(addresses)
+
+    # Every address queued, so that none is tried twice
+    self.known = set(self.addresses)
+
+    # Is the tracker being asked for peers?
+    self.finding = False
+
+    # Mapping from each connection to the pieces requested from it
+    self.connections = dict()
+
+    # Connections being opened
+    self.connecting = 0
+
+    # Mapping from the index of each requested piece to the connections
+    # it was requested from (more than one if it is late)
+    self.owners = dict()
+
+    # Mapping from index to the time (time.monotonic) a piece is wanted by
+    self.deadlines = dict()
+
+    # Mapping from index to the priority of a piece (higher first, 0 if
+    # not given)
+    self.priorities = dict()
+
+    # Mapping from index to the futures of reads waiting for the piece
+    self.waiters = dict()
+
+    # Made when the download starts
+    self.writes = None
+    self.pieces = None
+    self.verified = set()
+
+    # Pieces not requested from any connection
+    self.unassigned = set()
+
+    # A heap of (deadline, -priority, index) by which unassigned pieces
+    # are picked for peers that have every piece. Entries of pieces
+    # requested or re-ranked since are skipped.
+    self.queue = []
+
+    # Mapping from each connection whose peer lacks pieces to a heap like
+    # queue of just the pieces the peer has, so that picking one for it
+    # does not mean going through those it does not have
+    self.available = dict()
+
+    # Has the download stopped (complete or not)?
+    self.finished = False
+
+    # Done, with whether every piece was saved, once the download has
+    # stopped and its pieces are written
+    self.done = session.loop.create_future()
+
+
+  def start(self):
+    '''Find the pieces we are missing'''
+
+    # Pieces written before a restart are not downloaded again
+    self.writes = writeback.WriteBackCache(self.session.files, self.path, self.num_pieces, self.piece_length,
+      budget=self.session.write_cache_size, shared=self.session.caches,
+      notify=lambda failed: self.session.loop.call_soon_threadsafe(self._flushed, failed))
+
+    # Mapping from the index of each missing piece to its blocks received
+    # (by offset)
+    self.pieces = { i : dict() for i in range(self.num_pieces) if i not in self.writes.have }
+
+    self.unassigned = set(self.pieces)
+    self.queue = [self._rank(index) for index in self.pieces]
+    heapq.heapify(self.queue)
+
+    # The pieces we have and may upload
+    self.verified = set(self.writes.have)
+
+    # Wake the reads made while queued for the pieces we already have
+    for index in self.verified:
+      for waiter in self.waiters.pop(index, ()):
+        if not waiter.done():
+          waiter.set_result(None)
+
+
+  def _rank(self, index):
+    return (self.deadlines.get(index, math.inf), -self.priorities.get(index, 0), index)
+
+
+  def _unassign(self, index):
+    '''Queue a piece to be requested'''
+
+    self.unassigned.add(index)
+    self._push(index)
+
+
+  def _push(self, index):
+    '''Rank an unassigned piece for every connection whose peer has it'''
+
+    rank = self._rank(index)
+    heapq.heappush(self.queue, rank)
+
+    for protocol, heap in self.available.items():
+      if index in protocol.peer_info['peer_has']:
+        heapq.heappush(heap, rank)
+
+
+  def _next(self, heap, has):
+    '''Take the first piece to request from a heap of pieces in has, or
+       None if all of them are requested'''
+
+    while heap:
+      rank = heapq.heappop(heap)
+      index = rank[2]
+
+      # Requested, re-ranked, or (in a connection's heap) no longer
+      # claimed by the peer
+      if index not in self.unassigned or rank != self._rank(index) or index not in has:
+        continue
+
+      self.unassigned.remove(index)
+      return index
+
+    return None
+
+
+  def _request(self, protocol, index):
+    self.owners.setdefault(index, set()).add(protocol)
+    self.connections[protocol].add(index)
+
+    protocol.send(pwp.request_piece(index, self.length, self.piece_length))
+
+
+  def set_deadline(self, index, deadline):
+    '''Want a piece by the given time (time.monotonic), if that is
+       sooner than before'''
+
+    if index in self.verified or deadline >= self.deadlines.get(index, math.inf):
+      return
+
+    self.deadlines[index] = deadline
+
+    if index in self.unassigned:
+      self._push(index)
+
+
+  def prioritize(self, index, priority):
+    '''Rank a piece among the pieces without a deadline'''
+
+    if index in self.verified:
+      return
+
+    self.priorities[index] = priority
+
+    if index in self.unassigned:
+      self._push(index)
+
+
+  def joined(self, protocol):
+    '''A connection was made'''
+
+    if self.finished:
+      protocol.transport.close()
+      return
+
+    self.connections[protocol] = set()
+    self.assign(protocol)
+
+
+  def announced(self, protocol, indices):
+    '''A connection's peer told us it has more pieces'''
+
+    if protocol not in self.connections or protocol.peer_info is None:
+      return
+
+    has = protocol.peer_info['peer_has']
+
+    # A peer with every piece is given pieces from the shared queue
+    if len(has) >= self.num_pieces:
+      self.available.pop(protocol, None)
+
+    else:
+      heap = self.available.get(protocol)
+
+      # Start from every piece the peer has told us of so far
+      if heap is None:
+        heap = self.available[protocol] = []
+        indices = has
+
+      ranks = [self._rank(index) for index in indices if index in self.unassigned]
+
+      if len(ranks) > len(heap):
+        heap.extend(ranks)
+        heapq.heapify(heap)
+      else:
+        for rank in ranks:
+          heapq.heappush(heap, rank)
+
+    self.assign(protocol)
+
+
+  def assign(self, protocol):
+    '''Request pieces from a connection until it has PIPELINE of them
+       (once its peer has told us which pieces it has)'''
+
+    assigned = self.connections.get(protocol)
+
+    if assigned is None or protocol.peer_info is None or protocol.transport.is_closing():
+      return
+
+    # Wait for the pieces we (or the other downloads) have to be written
+    # (see _flushed)
+    if self.writes.full():
+      return
+
+    has = protocol.peer_info['peer_has']
+    heap = self.queue if len(has) >= self.num_pieces else self.available.get(protocol, [])
+
+    while len(assigned) < PIPELINE:
+      index = self._next(heap, has)
+
+      if index is None:
+        break
+
+      self._request(protocol, index)
+
+
+  def hurry(self):
+    '''Request pieces near their deadline right away, and from a second
+       connection if they are already requested'''
+
+    now = time.monotonic()
+
+    for index, deadline in self.deadlines.items():
+      owners = self.owners.get(index, ())
+
+      if deadline - now > HURRY or len(owners) >= DUPLICATES:
+        continue
+
+      # Being verified, or not started
+      if not owners and index not in self.unassigned:
+        continue
+
+      spare = [protocol for protocol in self.connections if protocol not in owners and not protocol.transport.is_closing()
+        and protocol.peer_info is not None and index in protocol.peer_info['peer_has']]
+
+      if not spare:
+        continue
+
+      # The least busy connection, even if its pipeline is full
+      protocol = min(spare, key=lambda protocol: len(self.connections[protocol]))
+
+      if owners:
+        DUPLICATE_REQUESTS.inc()
+      else:
+        self.unassigned.discard(index)
+
+      self._request(protocol, index)
+
+
+  def left(self, protocol):
+    '''A connection was closed. Its pieces go to the other connections.'''
+
+    assigned = self.connections.pop(protocol, None)
+    self.available.pop(protocol, None)
+
+    if assigned is None:
+      return
+
+    # Pieces waiting for leaf hashes from the connection
+    for index, repair in list(self.repairs.items()):
+      if repair[0] is protocol:
+        del self.repairs[index]
+        self.pieces[index] = dict()
+        self._unassign(index)
+
+    for index in assigned:
+      owners = self.owners[index]
+      owners.discard(protocol)
+
+      # No other connection is downloading the piece
+      if not owners:
+        del self.owners[index]
+        self.pieces[index] = dict()
+        self._unassign(index)
+
+    for other in self.connections:
+      self.assign(other)
+
+    # Replace the connection
+    self.session.connect()
+
+
+  def completed(self, protocol, index, data):
+    '''Every block of a piece arrived. It is hashed off the event loop.'''
+
+    owners = self.owners.pop(index)
+    self.pieces[index] = dict()
+
+    # Cancel the piece where it was also requested
+    for owner in owners:
+      self.connections[owner].discard(index)
+
+      if owner is not protocol:
+        owner.send(pwp.cancel_piece(index, self.length, self.piece_length))
+
+    if self.v2:
+      future = self.session.loop.run_in_executor(self.session.verifier, verify, data, torrent.piece_hash(self.torr, index), self.piece_width)
+    else:
+      expected = self.torr['info']['pieces'][20 * index: 20 * (index+1)]
+      future = self.session.loop.run_in_executor(self.session.verifier, verify, data, expected)
+    future.add_done_callback(lambda future: self._verified(protocol, index, data, future))
+
+    # Keep the connections busy while the piece is hashed
+    for owner in owners:
+      self.assign(owner)
+
+
+  def _verified(self, protocol, index, data, future):
+
+    # The download stopped while the piece was hashed
+    if self.finished:
+      return
+
+    valid, elapsed = future.result()
+    VERIFY_SECONDS.observe(elapsed)
+
+    if profiling.spans:
+      profiling.record_duration('hash', elapsed)
+
+    if not valid:
+      VERIFY_FAILURES.inc()
+
+      # Find out which blocks are bad from their leaf hashes
+      if self.v2 and protocol.v2 and protocol in self.connections and not protocol.transport.is_closing():
+        self.repairs[index] = (protocol, data)
+        protocol.send(pwp.hash_request(self.root, 0, index * self.piece_width, self.piece_width, 0))
+        return
+
+      self._redownload(index, protocol)
+      return
+
+    # Save the piece, written in the background with its neighbours
+    self.writes.put(index, data)
+    del self.pieces[index]
+
+    self.verified.add(index)
+    self.priorities.pop(index, None)
+
+    if time.monotonic() > self.deadlines.pop(index, math.inf):
+      DEADLINE_MISSES.inc()
+
+    # Wake the reads waiting for the piece
+    for waiter in self.waiters.pop(index, ()):
+      if not waiter.done():
+        waiter.set_result(None)
+
+    # Tell every peer of the torrent, whichever side connected
+    for peer in self.session.peers:
+      if peer['infohash'] == self.infohash and not peer['transport'].is_closing():
+        peer['protocol'].send(pwp.have(index))
+
+    if not self.pieces:
+      self.session.finish(self, True)
+
+
+  def _flushed(self, failed):
+    '''A batch of pieces was written, or failed to be (failed is then
+       the indices of its pieces)'''
+
+    if failed:
+      # The pieces are not saved, so they may not be read or uploaded
+      self.verified -= failed
+      self.writes.discard(failed)
+
+      if not self.finished:
+        self.session.finish(self, False)
+
+      return
+
+    # Write the pieces that waited for the batch, if there are enough
+    self.writes.relieve()
+
+    # Room was made in the budget every download shares
+    for download in list(self.session.active.values()):
+      for protocol in list(download.connections):
+        download.assign(protocol)
+
+
+  def _redownload(self, index, protocol):
+    '''Download a piece again, from the same peer if it is still
+       connected and has room'''
+
+    self.pieces[index] = dict()
+    self._unassign(index)
+
+    self.assign(protocol)
+    for other in self.connections:
+      self.assign(other)
+
+
+  def hashes_received(self, protocol, hashes):
+    '''The leaf hashes of a piece that failed its check arrived. Its
+       blocks that match them are kept, and the others requested again.'''
+
+    if self.finished or not self.repairs:
+      return
+
+    index = hashes.index // self.piece_width
+    repair = self.repairs.get(index)
+
+    # Not the hashes we asked this peer for
+    if (repair is None or repair[0] is not protocol or hashes.root != self.root or hashes.base != 0
+        or hashes.index != index * self.piece_width or hashes.length != self.piece_width):
+      return
+
+    del self.repairs[index]
+    protocol, data = repair
+
+    # The hashes must be those of the piece
+    leaves = hashes.hashes[:self.piece_width]
+
+    if len(leaves) != self.piece_width or merkle.root(leaves, self.piece_width) != torrent.piece_hash(self.torr, index):
+      log.debug('%s sent bad hashes for piece %d of %s', protocol.peer_label, index, self.name)
+      self._redownload(index, protocol)
+      return
+
+    blocks = self.pieces[index] = dict()
+    bad = []
+
+    for begin, length in pwp.piece_blocks(index, self.length, self.piece_length):
+      block = data[begin : begin + length]
+
+      if merkle.sha256(block) == leaves[begin // merkle.BLOCK]:
+        blocks[begin] = block
+      else:
+        bad.append((begin, length))
+
+    # Nothing to repair (the piece cannot have failed its check, so start
+    # it over rather than trust it)
+    if not bad:
+      self._redownload(index, protocol)
+      return
+
+    BLOCKS_REDOWNLOADED.inc(len(bad))
+
+    self.owners[index] = {protocol}
+    self.connections[protocol].add(index)
+
+    protocol.send(b''.join(pwp.request(index, begin, length) for begin, length in bad))
+
+
+  def hashes_rejected(self, protocol, request):
+    '''A peer would not send the leaf hashes of a piece. All of it is
+       downloaded again.'''
+
+    if self.finished or not self.repairs:
+      return
+
+    index = request.index // self.piece_width
+    repair = self.repairs.get(index)
+
+    if repair is not None and repair[0] is protocol and request.root == self.root:
+      del self.repairs[index]
+      self._redownload(index, protocol)
+
+
+  def exchanged(self, added, dropped):
+    '''A peer told us (with ut_pex) of addresses added to and dropped
+       from its swarm. New ones are queued and connected to, and dropped
+       ones not tried yet are forgotten.'''
+
+    if self.finished:
+      return
+
+    # Peers that left are not tried, but may be queued again if they
+    # come back
+    dropped = set(dropped)
+    stale = dropped & set(self.addresses)
+
+    if stale:
+      self.addresses = collections.deque(address for address in self.addresses if address not in stale)
+      self.known -= stale
+
+    # Peers already tried or connected to are not tried again
+    skip = self.known | dropped | {protocol.peername[:2] for protocol in self.connections}
+    new = [address for address in dict.fromkeys(added) if address not in skip]
+    new = new[:max(MAX_ADDRESSES - len(self.addresses), 0)]
+
+    if not new:
+      return
+
+    self.addresses.extend(new)
+    self.known.update(new)
+
+    self.session.connect()
+
+
+  async def read(self, offset, length, deadline=None):
+    '''The length bytes at offset, once their pieces are verified
+
+       The pieces are wanted by the deadline (READ_DEADLINE seconds from
+       now if not given), and the READAHEAD pieces after them a second
+       apart after that, so that reading on is not held up.
+    '''
+
+    if offset < 0 or length < 0 or offset + length > self.length:
+      raise Exception('read outside of {}'.format(self.name))
+
+    if length == 0:
+      return b''
+
+    first = offset // self.piece_length
+    last = (offset + length - 1) // self.piece_length
+
+    # A stopped download will not get the pieces it is missing
+    if self.finished and not all(index in self.verified for index in range(first, last + 1)):
+      raise Exception('the download of {} stopped'.format(self.name))
+
+    started = time.monotonic()
+
+    if deadline is None:
+      deadline = started + READ_DEADLINE
+
+    for index in range(first, last + 1):
+      self.set_deadline(index, deadline)
+
+    for i, index in enumerate(range(last + 1, min(last + 1 + READAHEAD, self.num_pieces))):
+      self.set_deadline(index, deadline + i + 1)
+
+    if self.pieces is not None:
+      self.hurry()
+
+    # Wait for the pieces we do not have
+    waiting = []
+
+    for index in range(first, last + 1):
+      if index not in self.verified:
+        waiter = self.session.loop.create_future()
+        self.waiters.setdefault(index, []).append(waiter)
+        waiting.append(waiter)
+
+    if waiting:
+      await asyncio.gather(*waiting)
+
+    READ_WAIT_SECONDS.observe(time.monotonic() - started)
+
+    data = b''.join([await self._piece(index) for index in range(first, last + 1)])
+    start = offset - first * self.piece_length
+
+    return data[start : start + length]
+
+
+  def read_blocking(self, offset, length, deadline=None, timeout=None):
+    '''read() for threads other than the session's, which must be
+       running its event loop'''
+    return asyncio.run_coroutine_threadsafe(self.read(offset, length, deadline), self.session.loop).result(timeout)
+
+
+  def _piece(self, index):
+    '''A future for the data of a verified piece'''
+
+    future = self.session.loop.create_future()
+
+    # Not written yet
+    data = self.writes.get(index)
+
+    if data is not None:
+      future.set_result(data)
+      return future
+
+    def piece_read(data):
+      if future.done():
+        return
+
+      if data is None:
+        future.set_exception(Exception('could not read piece {} of {}'.format(index, self.name)))
+      else:
+        future.set_result(data)
+
+    start = index * self.piece_length
+    self.session.reads.read(self.path, start, min(self.piece_length, self.length - start), piece_read)
+
+    return future
+
+
+class Session():
+  '''Downloads torrents in one event loop, under shared limits
+
+     rate is in bytes per second (None for no limit), and
+     write_cache_size in bytes.
+  '''
+
+  def __init__(self, loop, max_active=MAX_ACTIVE, max_connections=MAX_CONNECTIONS, rate=None, write_cache_size=writeback.BUDGET, verify_threads=VERIFY_THREADS, peer_id=b'1'*20, port=6881, max_unchoked=None):
+
+    self.loop = loop
+
+    self.max_active = max_active
+    self.max_connections = max_connections
+    self.write_cache_size = write_cache_size
+
+    # Announced to trackers (and listened on, see listen)
+    self.peer_id = peer_id
+    self.port = port
+
+    # The most peers we upload to at once (None for no limit)
+    self.max_unchoked = max_unchoked
+
+    # Accepts connections from peers, once listening
+    self.server = None
+
+    # List of all peers to which we are connected
+    self.peers = []
+
+    # The messages received from every peer
+    self.queues = scheduler.Scheduler()
+
+    # The files we are downloading
+    self.files = fdpool.FilePool()
+
+    # Reads the blocks we upload on a thread pool
+    self.reads = diskio.ReadEngine(loop, self.files)
+
+    # Shared by every connection
+    self.rate_limit = RateLimit(loop, rate) if rate else None
+
+    # Hashes completed pieces
+    self.verifier = ThreadPoolExecutor(max_workers=verify_threads)
+
+    # The write-back caches of the active downloads, which share
+    # write_cache_size
+    self.caches = []
+
+    # Time out stalled handshakes and idle peers, and keep the others alive
+    self.timers = lifecycle.Lifecycle(lambda protocol: protocol.send(pwp.keep_alive()), lambda protocol: protocol.transport.close())
+
+    # Every download added, in order
+    self.downloads = []
+
+    # The worker and timers, while running
+    self.tasks = []
+
+    # Downloads waiting for their turn
+    self.queued = collections.deque()
+
+    # Mapping from infohash to the downloads in progress
+    self.active = collections.OrderedDict()
+
+    DOWNLOADS.set_function(lambda: {('queued',): len(self.queued), ('active',): len(self.active)})
+
+
+  def add(self, torr, addresses=()):
+    '''Queue a torrent to be downloaded from the given peers (or those
+       of its tracker). Returns its Download.'''
+
+    download = Download(self, torr, addresses)
+
+    self.downloads.append(download)
+    self.queued.append(download)
+
+    self.start_next()
+
+    return download
+
+
+  def start_next(self):
+    '''Start queued downloads while fewer than max_active are running'''
+
+    while self.queued and len(self.active) < self.max_active:
+      download = self.queued.popleft()
+      self.active[download.infohash] = download
+
+      download.start()
+
+      # Finished before a restart
+      if not download.pieces:
+        self.finish(download, True)
+        continue
+
+      if not download.addresses:
+        download.finding = True
+        self.loop.create_task(self.find_peers(download))
+
+    self.connect()
+
+
+  async def find_peers(self, download):
+    '''Ask the download's tracker for peers'''
+
+    url = download.torr.get('announce')
+
+    try:
+      if not url:
+        raise Exception('no peer given and the torrent has no tracker')
+
+      found = await tracker.announce_once(url, download.infohash, self.peer_id, self.port, download.length)
+      download.addresses.extend(found)
+      download.known.update(found)
+
+    except Exception as e:
+      log.warning('%s: could not find peers: %s', download.name, e)
+
+    download.finding = False
+
+    if not download.finished:
+      self.connect()
+
+
+  def connect(self):
+    '''Connect to the active downloads' peers, up to the limits'''
+
+    if not self.active:
+      return
+
+    # Each active download may use an equal share of the connections
+    share = int(math.ceil(self.max_connections / len(self.active)))
+    opened = sum(len(download.connections) + download.connecting for download in self.active.values())
+
+    for download in list(self.active.values()):
+      while download.addresses and opened < self.max_connections and len(download.connections) + download.connecting < share:
+        download.connecting += 1
+        opened += 1
+
+        self.loop.create_task(self.open(download, download.addresses.popleft()))
+
+      # No peer is left to download from
+      if not (download.connections or download.connecting or download.addresses or download.finding):
+        log.warning('%s: no peers left', download.name)
+        self.finish(download, False)
+
+
+  async def open(self, download, address):
+    '''Connect to a peer of a download'''
+
+    try:
+      await self.loop.create_connection(lambda: async_seeder.PeerWireProtocol(self.peers, self.files, [], self.queues, self.reads, download,
+        timers=self.timers, rate_limit=self.rate_limit), host=address[0], port=address[1])
+
+    except OSError as e:
+      log.debug('%s: could not connect to %s:%s: %s', download.name, address[0], address[1], e)
+
+    download.connecting -= 1
+
+    if not download.finished:
+      self.connect()
+
+
+  def finish(self, download, complete):
+    '''Stop a download, and start the next one in the queue'''
+
+    download.finished = True
+    del self.active[download.infohash]
+
+    for protocol in list(download.connections):
+      protocol.transport.close()
+
+    download.connections.clear()
+    download.owners.clear()
+
+    # Reads of pieces that will not arrive fail
+    for waiters in download.waiters.values():
+      for waiter in waiters:
+        if not waiter.done():
+          waiter.set_exception(Exception('the download of {} stopped'.format(download.name)))
+
+    download.waiters.clear()
+
+    self.loop.create_task(self._written(download, complete))
+
+    self.start_next()
+
+
+  async def _written(self, download, complete):
+    '''Resolve a stopped download once its pieces are written'''
+
+    written = download.writes.close(wait=False)
+
+    try:
+      if written is not None:
+        await asyncio.wrap_future(written)
+    except Exception:
+      complete = False
+
+    # An earlier batch may have failed too
+    if len(download.writes.have) < download.num_pieces:
+      complete = False
+
+    log.info('%s: %s', download.name, 'downloaded' if complete else 'stopped')
+
+    download.done.set_result(complete)
+
+
+  async def listen(self, host=None):
+    '''Accept connections from peers of the downloads in progress'''
+
+    self.server = await self.loop.create_server(lambda: async_seeder.PeerWireProtocol(self.peers, self.files, dict(), self.queues, self.reads,
+      max_unchoked=self.max_unchoked, timers=self.timers, rate_limit=self.rate_limit, downloads=self.active), host=host, port=self.port)
+
+
+  async def run(self):
+    '''Download every torrent added, returning once all have stopped'''
+
+    working = self.loop.create_task(async_seeder.worker(self.peers, self.queues, self.reads))
+
+    # Stopped by close()
+    self.tasks = [working, self.loop.create_task(async_seeder.expire_timers(self.timers)), self.loop.create_task(flush_writes(self.caches)),
+      self.loop.create_task(hurry(self.active))]
+
+    while True:
+      waiting = [download.done for download in self.downloads if not download.done.done()]
+
+      if not waiting:
+        break
+
+      await asyncio.wait(waiting + [working], return_when=asyncio.FIRST_COMPLETED)
+
+      # Raise the worker's exception, if it failed
+      if working.done():
+        working.result()
+
+
+  def close(self):
+    '''Stop the downloads in progress, and write what they downloaded
+       (called while the event loop is not running)'''
+
+    for download in self.active.values():
+      download.finished = True
+
+      for protocol in download.connections:
+        protocol.transport.close()
+
+      download.writes.close()
+
+    self.active.clear()
+
+    for task in self.tasks:
+      task.cancel()
+
+    # Let the tasks finish cancelling
+    self.loop.run_until_complete(asyncio.gather(*self.tasks, return_exceptions=True))
+
+    if self.server is not None:
+      self.server.close()
+
+    self.verifier.shutdown()
+    self.reads.close()
+    self.files.close()
+
+
+async def hurry(downloads, interval=HURRY_INTERVAL):
+  '''Request the pieces of every download that are near their deadline'''
+
+  while True:
+    await asyncio.sleep(interval)
+
+    for download in list(downloads.values()):
+      if download.deadlines:
+        download.hurry()
+
+
+async def flush_writes(caches, interval=writeback.FLUSH_INTERVAL):
+  '''Write the downloaded pieces every interval seconds, so that little
+     is lost if we are killed'''
+
+  while True:
+    await asyncio.sleep(interval)
+
+    for cache in caches:
+      cache.flush()
+
+
+def download(torrs, addresses=(), metrics_address=None, profile_dir='.', listen=False, **limits):
+  '''Download the given torrents from the given peers until all have
+     stopped or we are interrupted (see Session for the limits). Returns
+     whether each was downloaded completely.
+
+  Without addresses, the peers returned by each torrent's tracker are
+  used. If listen is set, peers may also connect to us (on the session's
+  port) to download what we have.
+  '''
+
+  # The event loop
+  loop = asyncio.new_event_loop()
+  asyncio.set_event_loop(loop)
+
+  session = Session(loop, **limits)
+
+  downloads = [session.add(torr, addresses) for torr in torrs]
+
+  if listen:
+    loop.run_until_complete(session.listen())
+
+  async_seeder.QUEUE_DEPTH.set_function(lambda: len(session.queues))
+
+  # Profiling that can be switched on while running (see profiling.py)
+  profiler = profiling.Profiler(profile_dir, connections=async_seeder.CONNECTIONS.get)
+  profiler.install()
+
+  if metrics_address is not None:
+    metrics.serve(metrics_address, routes=profiler.routes())
+
+  try:
+    loop.run_until_complete(session.run())
+  except KeyboardInterrupt:
+    print('\rshutting down...')
+
+  # Write what was downloaded, and close all files
+  session.close()
+
+  # Close the event loop
+  loop.close()
+
+  return [download.done.done() and download.done.result() for download in downloads]
+
+
+def main():
+
+  addresses = []
+  metrics_address = None
+  profile_dir = '.'
+  limits = dict()
+  listen = True
+  log_level = logging.WARNING
+
+  # Parse Options
+  for arg in sys.argv[1:]:
+    if arg.startswith('--port='):
+      limits['port'] = int(arg[7:])
+
+    if arg.startswith('--peer='):
+      host, _, peer_port = arg[7:].rpartition(':')
+      addresses.append((host, int(peer_port)))
+
+    if arg.startswith('--max-active='):
+      limits['max_active'] = int(arg[13:])
+
+    if arg.startswith('--max-connections='):
+      limits['max_connections'] = int(arg[18:])
+
+    if arg.startswith('--rate-kb='):
+      limits['rate'] = int(arg[10:]) * 2**10
+
+    if arg.startswith('--write-cache-mb='):
+      limits['write_cache_size'] = int(arg[17:]) * 2**20
+
+    if arg.startswith('--verify-threads='):
+      limits['verify_threads'] = int(arg[17:])
+
+    if arg.startswith('--max-unchoked='):
+      limits['max_unchoked'] = int(arg[15:])
+
+    if arg == '--no-listen':
+      listen = False
+
+    if arg.startswith('--metrics='):
+      metrics_address = metrics.parse_address(arg[10:])
+
+    if arg.startswith('--profile-dir='):
+      profile_dir = arg[14:]
+
+    if arg == '--debug':
+      log_level = logging.DEBUG
+
+  logging.basicConfig(
+    level=log_level,
+    datefmt='%Y/%m/%d %H:%M:%S',
+    format='%(asctime)s %(name)s %(message)s',
+    filename='session_log.txt'
+  )
+
+  torrs = [torrent.read_torrent_file(arg) for arg in sys.argv[1:] if not arg.startswith('-')]
+
+  for torr, complete in zip(torrs, download(torrs, addresses, metrics_address, profile_dir, listen, **limits)):
+    print('{}: {}'.format(torr['info']['name'], 'downloaded' if complete else 'incomplete'))
+
+
+if __name__ == '__main__':
+  main()
@@ -4,7 +4,7 @@
 import sys, socket, math, hashlib, time
 
 # Project
-import torrent, pwp
+import torrent, pwp, merkle
 
 def main():
 
@@ -44,18 +44,17 @@ def main():
     print(e.args)
     return
 
+  # Buffered reader for the connection
+  reader = pwp.SocketReader(conn)
+
   # Create our handshake bytestring
-  handshake = pwp.create_handshake(bytehash, my_peer_id)
+  handshake = pwp.create_handshake(bytehash, my_peer_id, reserved=pwp.reserved_bits(pwp.FAST_EXTENSION, pwp.V2))
 
   # Send our handshake
   conn.send(handshake)  
 
   # Receive handshake from peer
-  shake_resp = pwp.receive_full_handshake(conn)
-
-  if shake_resp['reserved'] != (b'\x00' * 8):
-    print('Handshake failed: unequal reserved bits')
-    return
+  shake_resp = pwp.receive_full_handshake(reader)
 
   if shake_resp['info_hash'] != bytehash:
     print('Handshake failed: unequal infohashes')
@@ -63,11 +62,30 @@ def main():
 
   print('Handshake success')
 
+  # Can the peer reject our requests (instead of dropping them)?
+  fast = pwp.supports(shake_resp['reserved'], pwp.FAST_EXTENSION)
+
+  # Blocks the peer rejected while choking us, to be requested again
+  rejected = set()
+
+  # Are pieces checked against merkle hashes (BEP 52)? If the peer can
+  # send the leaf hashes of a bad piece, only its bad blocks are
+  # downloaded again.
+  v2 = torrent.is_v2(torr_info)
+  repair = v2 and pwp.supports(shake_resp['reserved'], pwp.V2)
+
+  if v2:
+    root = torrent.pieces_root(torr_info)
+    width = merkle.piece_width(torrent.length(torr_info), torr_info['info']['piece length'])
+
+  # Mapping from index to the data of bad pieces waiting for leaf hashes
+  repairs = dict()
+
   # Indicate that we are interested in receiving pieces
   conn.send(pwp.interested())
 
   # Request the entire file
-  req = pwp.request_all(torr_info['info']['length'])
+  req = pwp.request_all(torrent.length(torr_info))
   conn.send(req)
 
   piece_size = torr_info['info']['piece length']
@@ -79,7 +97,7 @@ def main():
 
   pieces = {i : set() for i in range(pieces_expected)}
 
-  print('Progress: {:.2f}%'.format(100 * bytes_received / torr_info['info']['length']), end='')
+  print('Progress: {:.2f}%'.format(100 * bytes_received / torrent.length(torr_info)), end='')
 
   # Create the output file
   with open('downloads/' + torr_info['info']['name'], 'w'):
@@ -89,34 +107,80 @@ def main():
   while len(pieces) > 0:
 
     # Receive and parse the next message
-    msg = pwp.parse_next_message(conn)
-    msg_id = msg['id']
+    msg = pwp.parse_next_message(reader, pwp.max_message_length(pieces_expected))
+    msg_id = msg.id
 
-    if msg_id == -2:
+    if msg_id == pwp.CLOSED:
       break
+    elif msg_id == 1:
+
+      # Request the blocks that were rejected while we were choked
+      conn.send(b''.join(pwp.request(*block) for block in sorted(rejected)))
+      rejected = set()
+
+    elif msg_id == 16 and fast:
+      rejected.add(msg.payload)
+    elif msg_id == 17 and fast:
+
+      # Blocks of an allowed fast piece can be requested right away
+      allowed = { block for block in rejected if block[0] == msg.payload }
+      conn.send(b''.join(pwp.request(*block) for block in sorted(allowed)))
+      rejected -= allowed
+
+    elif msg_id == 22 and repairs and msg.payload.index // width in repairs:
+
+      index = msg.payload.index // width
+      assembled = repairs.pop(index)
+      leaves = msg.payload.hashes[:width]
+
+      # Keep the blocks that match hashes of the piece
+      if len(leaves) == width and merkle.root(leaves, width) == torrent.piece_hash(torr_info, index):
+        bad = []
+
+        for begin, length in pwp.piece_blocks(index, torrent.length(torr_info)):
+          block = assembled[begin : begin + length]
+
+          if merkle.sha256(block) == leaves[begin // 2**14]:
+            pieces[index].add((begin, block))
+          else:
+            bad.append((begin, length))
+
+        conn.send(b''.join(pwp.request(index, begin, length) for begin, length in bad))
+        print('\rRequested {} bad blocks of piece {} again.'.format(len(bad), index))
+
+      else:
+        conn.send(pwp.request_piece(index, torrent.length(torr_info)))
+
+    elif msg_id == 23 and repairs and msg.payload.index // width in repairs:
+
+      # Download the whole piece again
+      index = msg.payload.index // width
+      del repairs[index]
+      conn.send(pwp.request_piece(index, torrent.length(torr_info)))
+
     elif msg_id == 7:
 
-      if msg['payload']['index'] >= pieces_expected:
+      if msg.payload.index >= pieces_expected:
         print('Received block with invalid piece index')
         return
 
-      if msg['payload']['begin'] % (2**14) != 0:
+      if msg.payload.begin % (2**14) != 0:
         print('Received block with invalid offset')
         return
 
-      if len(msg['payload']['block']) > 2**14:
+      if len(msg.payload.block) > 2**14:
         print('Received block longer than 2**14 bytes')
         return
 
-      bytes_received  += len(msg['payload']['block'])
+      bytes_received  += len(msg.payload.block)
 
       # Display the download progress
-      print('\rProgress: {:.2f}%'.format(100 * bytes_received / torr_info['info']['length']), end='')
+      print('\rProgress: {:.2f}%'.format(100 * bytes_received / torrent.length(torr_info)), end='')
 
-      index = msg['payload']['index']
+      index = msg.payload.index
 
       # Add the block to our collection
-      pieces[index].add((msg['payload']['begin'], msg['payload']['block']))
+      pieces[index].add((msg.payload.begin, msg.payload.block))
 
       # Assemble the piece if all blocks have arrived
       if (index == pieces_expected-1 and len(pieces[index]) == blocks_in_last_piece) or len(pieces[index]) == 16:
@@ -125,8 +189,13 @@ def main():
           piece = pieces[index]
           assembled = b''.join(block[1] for block in sorted(piece))
 
+          if v2:
+            valid = merkle.root(merkle.block_hashes(assembled), width) == torrent.piece_hash(torr_info, index)
+          else:
+            valid = hashlib.sha1(assembled).digest() == torr_info['info']['pieces'][20 * index: 20 * (index+1)]
+
           # If the piece is valid...
-          if hashlib.sha1(assembled).digest() == torr_info['info']['pieces'][20 * index: 20 * (index+1)]:
+          if valid:
 
             # Save the piece to disk
             with open('downloads/' + torr_info['info']['name'], 'rb+') as f:
@@ -142,10 +211,14 @@ def main():
             # Discard all blocks of the invalid piece
             pieces[index] = set()
 
-            # Re-request the invalid piece
-            conn.send(pwp.request_piece(index, torr_info['info']['length']))
+            # Ask which blocks are bad, or re-request the invalid piece
+            if repair:
+              repairs[index] = assembled
+              conn.send(pwp.hash_request(root, 0, index * width, width, 0))
+            else:
+              conn.send(pwp.request_piece(index, torrent.length(torr_info)))
 
-            print('Received invalid piece: {}.'.format(msg['payload']['index']))
+            print('Received invalid piece: {}.'.format(msg.payload.index))
         
   print()
 
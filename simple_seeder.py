@@ -1,14 +1,50 @@
 #!/usr/bin/env python3.6
 '''A simple torrent seeder
 
-A multi-threaded server that seeds torrents
+A server that seeds torrents. All sockets are multiplexed by a single
+selectors-based I/O loop, and blocking disk reads are handed off to a
+fixed pool of worker threads.
 '''
 
 # Stdlib
-import sys, os, socket, threading, time, math
+import sys, os, socket, selectors, queue, math, time
+from concurrent.futures import ThreadPoolExecutor
 
 # Project
-import torrent, pwp
+import torrent, pwp, metrics, profiling, fdpool, catalog, pex, lifecycle
+
+
+# Stop reading from a peer while this many bytes are waiting to be sent to it
+WRITE_HIGH_WATER = 2**20
+
+# The most block reads that a single peer may have in flight at once
+MAX_PENDING_READS = 32
+
+# The extensions we support, advertised in our handshake
+RESERVED = pwp.reserved_bits(pwp.FAST_EXTENSION, pwp.EXTENSION_PROTOCOL)
+
+
+# Metrics
+BYTES_RECEIVED = metrics.counter('simpletorrent_bytes_received_total', 'Bytes received from peers, by torrent', ['infohash'])
+BYTES_SENT = metrics.counter('simpletorrent_bytes_sent_total', 'Bytes sent to peers, by torrent', ['infohash'])
+PEER_BYTES_RECEIVED = metrics.counter('simpletorrent_peer_bytes_received_total', 'Bytes received from each connected peer', ['peer'])
+PEER_BYTES_SENT = metrics.counter('simpletorrent_peer_bytes_sent_total', 'Bytes sent to each connected peer', ['peer'])
+MESSAGES_RECEIVED = metrics.counter('simpletorrent_messages_received_total', 'PWP messages received, by type', ['type'])
+CONNECTIONS = metrics.gauge('simpletorrent_connections', 'Open peer connections')
+QUEUE_DEPTH = metrics.gauge('simpletorrent_queued_messages', 'Received messages waiting to be handled')
+PENDING_READS = metrics.gauge('simpletorrent_pending_disk_reads', 'Block reads waiting for a disk worker')
+SEND_BUFFER = metrics.gauge('simpletorrent_send_buffer_bytes', 'Bytes waiting to be sent to peers')
+REQUESTS_REJECTED = metrics.counter('simpletorrent_rejected_requests_total', 'Block requests refused because the peer was choked or the block was invalid')
+DISK_READ_SECONDS = metrics.histogram('simpletorrent_disk_read_seconds', 'Latency of block reads')
+
+
+def timed_pread(files, path, length, offset):
+  '''Read a block, returning it with the time the read took'''
+
+  started = time.perf_counter()
+  block = files.pread(path, length, offset)
+
+  return block, time.perf_counter() - started
 
 
 def byte_to_set(byte):
@@ -23,176 +59,663 @@ def bytestring_to_set(bytestring):
 
   return s
 
-def handle_incoming(conn, my_peer_id, torrents):
-  '''Function called to handle each incoming connection'''
 
-  # Get address and port of our peer
-  peer_info = conn.getpeername()
+class Seeder():
+  '''Seeds torrents to many peers from a single I/O thread
+
+     Connections are never given their own thread. The I/O loop accepts,
+     reads and writes with non-blocking sockets, and a fixed pool of
+     workers performs the disk reads. When max_connections peers are
+     connected the listening socket is ignored, so that new peers wait in
+     the kernel backlog instead of consuming threads or memory.
+
+     At most max_unchoked peers (None for no limit) are uploaded to at
+     once. The others wait, in the order they connected, for a peer to
+     leave; peers with the Fast Extension may meanwhile download their
+     allowed fast pieces.
+
+     If torrents is a Catalog, the I/O loop keeps it up to date with its
+     directory. Peers of a torrent that is removed are sent the blocks
+     they already requested, then disconnected.
+  '''
+
+  def __init__(self, my_peer_id, torrents, backlog=1024, max_connections=10000, workers=4, max_open_files=1024, max_unchoked=None):
+
+    self.my_peer_id = my_peer_id
+
+    # The torrents we are serving
+    self.torrents = torrents
+
+    # Length of the kernel's queue of pending connections
+    self.backlog = backlog
+
+    # The most peers we will serve at once
+    self.max_connections = max_connections
+
+    # The most peers we upload to at once
+    self.max_unchoked = max_unchoked
+
+    # Readiness notifications for every socket
+    self.sel = selectors.DefaultSelector()
+
+    # Threads that perform the blocking disk reads
+    self.pool = ThreadPoolExecutor(max_workers=workers)
+
+    # Open files, shared by every connection and disk worker
+    self.files = fdpool.FilePool(max_open_files)
+
+    # Finished disk reads, waiting to be handed back to the I/O loop
+    self.completed = queue.Queue()
+
+    # Lets the disk workers wake up the I/O loop
+    self.wake_r, self.wake_w = socket.socketpair()
+    self.wake_r.setblocking(False)
+    self.wake_w.setblocking(False)
+
+    # Mapping from socket to connection state
+    self.conns = dict()
+
+    self.listener = None
+    self.accepting = False
+
+    # Reports changes to the torrents directory (see catalog.py)
+    self.watcher = None
+
+    # The handler for each message id, or pseudo-message (see _handle).
+    # Messages without one (keep-alives, cancels, ports, suggestions and
+    # rejects) are ignored.
+    self.handlers = {pwp.INFOHASH: self._on_infohash, pwp.PEER_ID: self._on_peer_id,
+      0: self._on_choke, 1: self._on_unchoke, 2: self._on_interested, 3: self._on_uninterested,
+      4: self._on_have, 5: self._on_bitfield, 6: self._on_request, 14: self._on_have_all,
+      15: self._on_have_none, 20: self._on_extended}
+
+    # Handshake and idle timeouts for every connection, keyed by socket
+    self.timers = lifecycle.Lifecycle(self._keep_alive, lambda sock: self._close(self.conns[sock]))
+
+    QUEUE_DEPTH.set_function(self.completed.qsize)
+    PENDING_READS.set_function(lambda: sum(c['pending'] for c in list(self.conns.values())))
+    SEND_BUFFER.set_function(lambda: sum(len(c['outbuf']) for c in list(self.conns.values())))
+
+
+  def serve_forever(self, host, port):
+    '''Listen on the given address and serve peers until interrupted'''
+
+    self.listener = socket.socket()
+    self.listener.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+
+    # Bind socket to a local port
+    try:
+      self.listener.bind((host, port))
+    except socket.error as e:
+      print('Socket Bind Failed: ' + str(e))
+      return
+
+    # Begin listening on socket
+    self.listener.listen(self.backlog)
+    self.listener.setblocking(False)
+
+    self.sel.register(self.wake_r, selectors.EVENT_READ)
+    self._resume_accepting()
+
+    # Tell peers about each other every so often
+    next_pex = time.monotonic() + pex.INTERVAL
+
+    # Advance the connection timers every tick
+    next_tick = time.monotonic() + lifecycle.TICK
+
+    # Without inotify, rescan the torrents directory every few seconds
+    next_scan = None
+
+    if isinstance(self.torrents, catalog.Catalog):
+      self.watcher = catalog.Watcher(self.torrents.directory)
+
+      if self.watcher.fileno() is not None:
+        self.sel.register(self.watcher.fileno(), selectors.EVENT_READ)
+      else:
+        next_scan = time.monotonic() + catalog.SCAN_INTERVAL
+
+    try:
+      while True:
+        timeout = max(0, min(next_tick, next_pex, next_scan or next_pex) - time.monotonic())
+
+        for key, mask in self.sel.select(timeout):
+
+          if key.fileobj is self.listener:
+            self._accept()
+          elif key.fileobj is self.wake_r:
+            self._drain_completed()
+          elif key.data is None:
+            paths = self.watcher.read()
+            self._catalog_changed(*(self.torrents.scan() if paths is None else self.torrents.update(paths)))
+          else:
+            c = key.data
+
+            if mask & selectors.EVENT_READ and not c['closed']:
+              self._read(c)
+
+            if mask & selectors.EVENT_WRITE and not c['closed']:
+              self._write(c)
+
+        if next_scan is not None and time.monotonic() >= next_scan:
+          self._catalog_changed(*self.torrents.scan())
+          next_scan = time.monotonic() + catalog.SCAN_INTERVAL
+
+        if time.monotonic() >= next_tick:
+          self.timers.expire()
+          next_tick = time.monotonic() + lifecycle.TICK
+
+        if time.monotonic() >= next_pex:
+          self._exchange_peers()
+          next_pex = time.monotonic() + pex.INTERVAL
+    finally:
+      for c in list(self.conns.values()):
+        self._close(c)
+
+      if self.watcher is not None:
+        self.watcher.close()
+
+      self.pool.shutdown()
+      self.files.close()
+      self.sel.close()
+      self.listener.close()
+
+
+  def _catalog_changed(self, added, removed):
+    '''Drain the peers of torrents that are no longer in the catalog'''
+
+    if not added and not removed:
+      return
+
+    self.torrents.report(added, removed)
+
+    for c in list(self.conns.values()):
+      if c['infohash'] in removed:
+        c['draining'] = True
+        self._update_interest(c)
+
+
+  def _exchange_peers(self, only=None):
+    '''Send peers that support ut_pex the changes to their swarms'''
+
+    conns = [c for c in self.conns.values() if c['torr'] is not None and not c['draining']]
+
+    for c, msg in pex.updates(conns, only):
+      c['outbuf'] += msg
+      self._update_interest(c)
+
+
+  def _keep_alive(self, sock):
+    c = self.conns[sock]
+    c['outbuf'] += pwp.keep_alive()
+    self._update_interest(c)
+
+
+  def _pause_accepting(self):
+    if self.accepting:
+      self.sel.unregister(self.listener)
+      self.accepting = False
+
+
+  def _resume_accepting(self):
+    if not self.accepting:
+      self.sel.register(self.listener, selectors.EVENT_READ)
+      self.accepting = True
+
+
+  def _accept(self):
+    '''Accept as many pending connections as we have room for'''
+
+    while len(self.conns) < self.max_connections:
+
+      try:
+        conn, peer_info = self.listener.accept()
+      except (BlockingIOError, InterruptedError):
+        return
+      except OSError as e:
+        # Most likely out of file descriptors; retry once a peer leaves
+        print('Failed to accept connection:', e)
+        self._pause_accepting()
+        return
+
+      # Refuse the peer if too many others are mid-handshake
+      if not self.timers.opened(conn):
+        conn.close()
+        continue
+
+      conn.setblocking(False)
+
+      print('Connected to {}:{}'.format(peer_info[0], peer_info[1]))
+
+      label = '{}:{}'.format(peer_info[0], peer_info[1])
+
+      c = {'sock': conn, 'addr': peer_info, 'label': label, 'parser': pwp.MessageParser(),
+        'outbuf': bytearray(), 'mask': 0, 'closed': False, 'pending': 0,
+        'infohash': None, 'draining': False, 'fast': False, 'allowed_fast': set(),
+        'extended': False, 'listen': None, 'pex_id': None, 'pex_sent': set(), 'torr': None, 'path': None, 'file_len': 0, 'piece_size': 0, 'num_pieces': 0,
+        'am_choking': 1, 'am_interested': 0, 'peer_choking': 1, 'peer_interested': 0,
+        'peer_has': set(), 'first_msg': True,
+        'peer_received': PEER_BYTES_RECEIVED.labels(label), 'peer_sent': PEER_BYTES_SENT.labels(label),
+        'torr_received': None, 'torr_sent': None}
+
+      self.conns[conn] = c
+      self.sel.register(conn, selectors.EVENT_READ, c)
+      c['mask'] = selectors.EVENT_READ
+
+      CONNECTIONS.inc()
+
+    # Leave the remaining peers in the backlog
+    self._pause_accepting()
+
+
+  def _close(self, c):
+    '''Close a connection and release its resources'''
+
+    if c['closed']:
+      return
+
+    c['closed'] = True
+
+    if c['mask']:
+      self.sel.unregister(c['sock'])
+
+    c['sock'].close()
+    del self.conns[c['sock']]
+    self.timers.closed(c['sock'])
+
+    CONNECTIONS.dec()
+    PEER_BYTES_RECEIVED.remove(c['label'])
+    PEER_BYTES_SENT.remove(c['label'])
+
+    print('Closed connection to {}:{}'.format(c['addr'][0], c['addr'][1]), end='\n\n')
+
+    # Hand the upload slot to the peer that has waited longest
+    if not c['am_choking']:
+      self._unchoke_waiting()
+
+    if len(self.conns) < self.max_connections:
+      self._resume_accepting()
+
+
+  def _unchoke(self, c):
+    c['am_choking'] = 0
+    c['outbuf'] += pwp.unchoke()
+
+
+  def _unchoke_waiting(self):
+    '''Give free upload slots to the peers that have waited longest'''
+
+    conns = [c for c in self.conns.values() if c['torr'] is not None and not c['draining']]
+    unchoked = sum(1 for c in conns if not c['am_choking'])
+
+    for c in conns:
+      if self.max_unchoked is not None and unchoked >= self.max_unchoked:
+        break
+
+      if c['am_choking']:
+        self._unchoke(c)
+        self._update_interest(c)
+        unchoked += 1
+
+
+  def _update_interest(self, c):
+    '''Register for the events this connection is ready to handle'''
+
+    mask = 0
+
+    # A draining peer is closed once its requested blocks have been sent
+    if c['draining'] and c['pending'] == 0 and not c['outbuf']:
+      self._close(c)
+      return
+
+    # Stop reading from peers that are not draining what we send them
+    if not c['draining'] and len(c['outbuf']) < WRITE_HIGH_WATER and c['pending'] < MAX_PENDING_READS:
+      mask |= selectors.EVENT_READ
+
+    if c['outbuf']:
+      mask |= selectors.EVENT_WRITE
+
+    if mask == c['mask']:
+      return
+
+    if c['mask'] == 0:
+      self.sel.register(c['sock'], mask, c)
+    elif mask == 0:
+      self.sel.unregister(c['sock'])
+    else:
+      self.sel.modify(c['sock'], mask, c)
+
+    c['mask'] = mask
+
+
+  def _read(self, c):
+    '''Receive data from a peer and handle any complete messages'''
+
+    try:
+      data = c['sock'].recv(2**16)
+    except (BlockingIOError, InterruptedError):
+      return
+    except OSError:
+      data = b''
+
+    # The connection was closed
+    if len(data) == 0:
+      self._close(c)
+      return
+
+    timed = profiling.spans
+    if timed:
+      started = time.perf_counter()
+
+    self._received(c, data)
+
+    if timed:
+      profiling.record('data_received', started)
+
+
+  def _received(self, c, data):
+    '''Parse and handle data received from a peer'''
+
+    c['peer_received'].inc(len(data))
+    if c['torr_received'] is not None:
+      c['torr_received'].inc(len(data))
+
+    self.timers.received(c['sock'])
+
+    c['parser'].add(data)
+
+    try:
+      for msg in c['parser']:
+
+        timed = profiling.spans
+        if timed:
+          started = time.perf_counter()
+
+        ok = self._handle(c, msg)
+
+        if timed:
+          profiling.record('dispatch', started)
+
+        if not ok:
+          self._close(c)
+          return
+    except Exception as e:
+      print('{}:{} sent an invalid message:'.format(c['addr'][0], c['addr'][1]), e)
+      self._close(c)
+      return
+
+    self._update_interest(c)
+
+
+  def _write(self, c):
+    '''Send as much buffered data as the socket will take'''
+
+    try:
+      sent = c['sock'].send(c['outbuf'])
+    except (BlockingIOError, InterruptedError):
+      return
+    except OSError:
+      self._close(c)
+      return
+
+    del c['outbuf'][:sent]
+    self.timers.sent(c['sock'])
+
+    c['peer_sent'].inc(sent)
+    if c['torr_sent'] is not None:
+      c['torr_sent'].inc(sent)
+
+    self._update_interest(c)
+
+
+  def _handle(self, c, msg):
+    '''Handle a single message. Returns False if the peer should be dropped.'''
+
+    handler = self.handlers.get(msg.id)
+
+    if handler is not None and handler(c, msg.payload) is False:
+      return False
+
+    if msg.id >= pwp.KEEP_ALIVE:
+      c['first_msg'] = False
+      MESSAGES_RECEIVED.labels(msg.name).inc()
+
+    return True
+
 
-  print('Connected to {}:{}'.format(peer_info[0], peer_info[1]))
+  def _on_infohash(self, c, infohash):
+    peer_info = c['addr']
 
-  # State of this peer
-  am_choking = 1
-  am_interested = 0
-  peer_choking = 1
-  peer_interested = 0
+    # Get some info for our torrent (read from disk if the catalog is
+    # lazy and no one has asked for it recently)
+    c['infohash'] = infohash
+    c['torr'] = self.torrents.get(infohash)
 
-  # The set of pieces our peer has
-  peer_has = set()
+    # Check that we have the file specified by the infohash
+    if c['torr'] is None:
+      print('{}:{} requested unknown torrent:'.format(peer_info[0], peer_info[1]), infohash.hex())
+      return False
+    c['piece_size'] = c['torr']['info']['piece length']
+    c['num_pieces'] = int(math.ceil(torrent.length(c['torr']) / c['piece_size']))
+    c['parser'].max_length = pwp.max_message_length(c['num_pieces'])
 
-  # Receive the first part of the handshake
-  d = pwp.receive_infohash(conn)
+    # Get the length of the file (opening it, if no one else has)
+    c['path'] = 'files/' + c['torr']['info']['name']
+    c['file_len'] = self.files.size(c['path'])
 
-  # Check that we have the file specified by the infohash
-  if d['info_hash'] not in torrents.keys():
-    print('{}:{} requested unknown torrent:'.format(peer_info[0], peer_info[1]), d['info_hash'].hex())
-    conn.close()
-    print('Closed connection to {}:{}'.format(peer_info[0], peer_info[1]), end='\n\n')
-    return
+    c['torr_received'] = BYTES_RECEIVED.labels(infohash.hex())
+    c['torr_sent'] = BYTES_SENT.labels(infohash.hex())
 
-  # Get some info for our torrent
-  torr_info = torrents[d['info_hash']]
-  piece_size = torr_info['info']['piece length']
-  num_pieces = int(math.ceil(torr_info['info']['length'] / piece_size))
+    # Extensions may be used if both sides advertise them
+    c['fast'] = pwp.supports(c['parser'].reserved, pwp.FAST_EXTENSION)
+    c['extended'] = pwp.supports(c['parser'].reserved, pwp.EXTENSION_PROTOCOL)
 
-  # Send our handshake
-  pwp.send_handshake_reply(conn, d['info_hash'], my_peer_id)
+    # Send our handshake, and tell the peer we have every piece
+    c['outbuf'] += pwp.create_handshake(infohash, self.my_peer_id, reserved=RESERVED)
+    c['outbuf'] += pwp.have_all() if c['fast'] else pwp.full_bitfield(c['num_pieces'])
 
-  # Receive the rest of the handshake (peer_id)
-  d['peer_id'] = pwp.receive_peer_id(conn)
+    # Offer the extensions we support (and the port we listen on)
+    if c['extended']:
+      c['outbuf'] += pwp.extension_handshake(pex.EXTENSIONS, self.listener.getsockname()[1])
 
-  print('Completed handshake with {}:{}'.format(peer_info[0], peer_info[1]))
 
-  # Open the file
-  f = open('files/' + torr_info['info']['name'], 'rb')
+  def _on_peer_id(self, c, peer_id):
+    peer_info = c['addr']
 
-  # Get the length of the file
-  file_len = f.seek(0, 2)
+    print('Completed handshake with {}:{}'.format(peer_info[0], peer_info[1]))
 
-  # TODO: Send our bitfield message
+    # The connection is no longer half-open
+    self.timers.established(c['sock'])
 
-  # Receive and parse the first message
-  msg = pwp.parse_next_message(conn)
-  msg_id = msg['id']
+    # Unchoke the peer if there is a free upload slot, or give it an
+    # allowed fast set if not
+    if self.max_unchoked is None or sum(1 for other in self.conns.values() if not other['am_choking']) < self.max_unchoked:
+      self._unchoke(c)
 
-  # Check for a bitfield message
-  if msg_id == 5:
+    elif c['fast']:
+      c['allowed_fast'] = set(pwp.allowed_fast_set(peer_info[0], c['infohash'], c['num_pieces']))
+
+      for index in c['allowed_fast']:
+        c['outbuf'] += pwp.allowed_fast(index)
+
+
+  def _on_choke(self, c, payload):
+    c['peer_choking'] = 1
+
+  def _on_unchoke(self, c, payload):
+    c['peer_choking'] = 0
+
+  def _on_interested(self, c, payload):
+    c['peer_interested'] = 1
+
+  def _on_uninterested(self, c, payload):
+    c['peer_interested'] = 0
+
+  def _on_have(self, c, index):
+    c['peer_has'].add(index)
+
+  def _on_have_all(self, c, payload):
+    c['peer_has'] = set(range(c['num_pieces']))
+
+  def _on_have_none(self, c, payload):
+    c['peer_has'] = set()
+
+
+  def _on_bitfield(self, c, bitfield):
+    peer_info = c['addr']
+
+    if not c['first_msg']:
+      print('Received bitfield after initial message...closing connection')
+      return False
 
     # Check the bitfield length
-    if len(msg['payload']) != int(math.ceil(num_pieces / 8)):
+    if len(bitfield) != int(math.ceil(c['num_pieces'] / 8)):
       print('Received invalid bitfield from {}:{} (wrong length)'.format(peer_info[0], peer_info[1]))
-      conn.close
-      return
+      return False
 
-    peer_has = bytestring_to_set(msg['payload'])
+    c['peer_has'] = bytestring_to_set(bitfield)
 
     # Check if any invalid bits were set
-    if max(peer_has) >= num_pieces:
+    if len(c['peer_has']) > 0 and max(c['peer_has']) >= c['num_pieces']:
       print('Received invalid bitfield from {}:{} (extra bits were set)'.format(peer_info[0], peer_info[1]))
-      conn.close()
-      return
+      return False
 
-    # Receive and parse the next message
-    msg = pwp.parse_next_message(conn)
-    msg_id = msg['id']
-    
-
-  while True:
-
-    if msg_id == -2:
-      break  # The connection was closed
-    elif msg_id == -1:
-      pass   # Keep-alive
-    elif msg_id == 0:
-      peer_choking = 1
-    elif msg_id == 1:
-      peer_choking = 0
-    elif msg_id == 2:
-      peer_interested = 1
-    elif msg_id == 3:
-      peer_interested = 0
-    elif msg_id == 4:
-      peer_has.add(msg['payload'])
-    elif msg_id == 5:
-      print('Received bitfield after initial message...closing connection')
-      break
-    elif msg_id == 6:
 
-      # Compute the byte-offset of this block within the file
-      offset = (msg['payload']['index'] * piece_size) + msg['payload']['begin']
+  def _on_request(self, c, block):
+    index, begin, length = block
 
-      # Check that the block is valid
-      if offset + msg['payload']['length'] > file_len:
-        print('{}:{} requested invalid block (overflow)'.format(peer_info[0], peer_info[1]))
-        break
+    # Compute the byte-offset of this block within the file
+    offset = (index * c['piece_size']) + begin
 
-      f.seek(offset)
+    # Check that the block is valid
+    if offset + length > c['file_len']:
+      print('{}:{} requested invalid block (overflow)'.format(c['addr'][0], c['addr'][1]))
+      return False
 
-      # Read the requested block
-      block = f.read(msg['payload']['length'])
+    # Choked peers may only request their allowed fast pieces. Peers
+    # with the Fast Extension are told, so they can request elsewhere
+    # without waiting for a timeout.
+    if c['am_choking'] and index not in c['allowed_fast']:
+      if c['fast']:
+        REQUESTS_REJECTED.inc()
+        c['outbuf'] += pwp.reject_request(index, begin, length)
 
-      # Send the requested block
-      conn.send(pwp.piece(msg['payload']['index'], msg['payload']['begin'], block))
+    else:
+      # Read the requested block on a worker thread
+      c['pending'] += 1
+      future = self.pool.submit(timed_pread, self.files, c['path'], length, offset)
+      future.add_done_callback(lambda fut, c=c: self._read_done(c, index, begin, fut))
 
-    elif msg_id == 7:
-      pass
-    elif msg_id == 8:
-      pass
-    elif msg_id == 9:
+
+  def _on_extended(self, c, ext):
+
+    if ext.id == 0:
+      handshake = pwp.parse_extension_handshake(ext.data)
+
+      # The message id the peer wants for ut_pex (0 disables it)
+      c['pex_id'] = handshake['m'].get('ut_pex') or None
+
+      # The peer can be advertised once we know the port it listens on
+      if isinstance(handshake.get('p'), int) and 0 < handshake['p'] < 65536:
+        c['listen'] = (c['addr'][0], handshake['p'])
+
+      # Tell the peer about its swarm straight away
+      if c['pex_id'] is not None:
+        self._exchange_peers(c)
+
+    # We only seed, so have no use for the peers we are told about
+    elif ext.id == pex.UT_PEX:
+      pex.parse(ext.data)
+
+
+  def _read_done(self, c, index, begin, future):
+    '''Called on a worker thread when a disk read completes'''
+
+    self.completed.put((c, index, begin, future))
+
+    # Wake up the I/O loop
+    try:
+      self.wake_w.send(b'\x00')
+    except (BlockingIOError, InterruptedError):
+      pass   # A wake-up is already pending
+
+
+  def _drain_completed(self):
+    '''Queue the blocks read by the disk workers for sending'''
+
+    try:
+      while self.wake_r.recv(4096):
+        pass
+    except (BlockingIOError, InterruptedError):
       pass
 
-    # Receive and parse the next message
-    msg = pwp.parse_next_message(conn)
-    msg_id = msg['id']
+    while True:
 
+      try:
+        c, index, begin, future = self.completed.get_nowait()
+      except queue.Empty:
+        return
 
-  # Close the connection
-  conn.close()
+      c['pending'] -= 1
 
-  print('Closed connection to {}:{}'.format(peer_info[0], peer_info[1]), end='\n\n')
+      # The connection was closed while the read was in flight
+      if c['closed']:
+        continue
 
+      try:
+        block, seconds = future.result()
+      except OSError as e:
+        print('Failed to read block {}:{}:'.format(index, begin), e)
+        self._close(c)
+        continue
 
-def start(port, my_peer_id):
+      DISK_READ_SECONDS.observe(seconds)
 
-  # Create socket for TCP communication
-  s = socket.socket()
+      if profiling.spans:
+        profiling.record_duration('disk_read', seconds)
 
-  # Bind socket to a local port
-  try:
-    s.bind(('192.168.1.123', port))
-  except socket.error as e:
-    print('Socket Bind Failed: ' + e)
+      # Send the requested block
+      c['outbuf'] += pwp.piece(index, begin, block)
+
+      self._update_interest(c)
 
-  # Begin listening on socket
-  s.listen(8)
 
-  # A dictionary of all the infohashes we are seeding
-  torrs = dict()
+def start(port, my_peer_id, host='', backlog=1024, max_connections=10000, workers=4, metrics_address=None, profile_dir='.', max_open_files=1024, metadata_budget=None, max_unchoked=None):
 
-  # Get infohash of all files in the torrents/ directory
-  for (dirpath, dirnames, filenames) in os.walk('torrents'):
-    for filename in filenames:
-      if filename[0] != '.':
-        torr_info = torrent.read_torrent_file(dirpath + '/' + filename)
-        torrs[torrent.infohash(torr_info)] = torr_info
+  # All the infohashes we are seeding, from the torrents/ directory
+  # (kept up to date while we run)
+  torrs = catalog.Catalog('torrents', metadata_budget)
+  torrs.scan()
 
   # Display the torrents we are serving
-  print('Serving...\n' + '\n'.join(ihash.hex() + ' ' + torr['info']['name'] for ihash, torr in torrs.items()), end='\n\n')
+  print('Serving...\n' + '\n'.join(ihash.hex() + ' ' + name for ihash, name in torrs.names.items()), end='\n\n')
 
-  while True:
-    # Accept a connection
-    conn, addr = s.accept()
+  seeder = Seeder(my_peer_id, torrs, backlog, max_connections, workers, max_open_files, max_unchoked)
 
-    # Handle the connection in its own thread
-    t = threading.Thread(target=handle_incoming, args=(conn, my_peer_id, torrs))
+  # Profiling that can be switched on while running (see profiling.py)
+  profiler = profiling.Profiler(profile_dir, connections=CONNECTIONS.get)
+  profiler.install()
 
-    #Start the thread
-    t.start()
+  if metrics_address is not None:
+    metrics.serve(metrics_address, routes=profiler.routes())
+
+  try:
+    seeder.serve_forever(host, port)
+  except KeyboardInterrupt:
+    print('\rshutting down...')
 
 
 def main():
 
   port = 6881
+  host = ''
+  backlog = 1024
+  max_connections = 10000
+  workers = 4
+  max_open_files = 1024
+  metadata_budget = None
+  max_unchoked = None
+  metrics_address = None
+  profile_dir = '.'
   my_peer_id  = b'1' * 20
 
   # Parse Options
@@ -203,7 +726,37 @@ def main():
     if arg.startswith('--port'):
       port = int(arg[6:])
 
-  start(port, my_peer_id)
+    if arg.startswith('--host='):
+      host = arg[7:]
+
+    if arg.startswith('--backlog='):
+      backlog = int(arg[10:])
+
+    if arg.startswith('--max-connections='):
+      max_connections = int(arg[18:])
+
+    if arg.startswith('--workers='):
+      workers = int(arg[10:])
+
+    if arg.startswith('--max-open-files='):
+      max_open_files = int(arg[17:])
+
+    if arg.startswith('--metadata-mb='):
+      metadata_budget = int(arg[14:]) * 2**20
+
+    if arg.startswith('--max-unchoked='):
+      max_unchoked = int(arg[15:])
+
+    if arg.startswith('--metrics='):
+      metrics_address = metrics.parse_address(arg[10:])
+
+    if arg.startswith('--profile-dir='):
+      profile_dir = arg[14:]
+
+    if arg == '--spans':
+      profiling.enable_spans()
+
+  start(port, my_peer_id, host, backlog, max_connections, workers, metrics_address, profile_dir, max_open_files, metadata_budget, max_unchoked)
 
 if __name__ == '__main__':
   main()
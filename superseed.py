@@ -0,0 +1,168 @@
+'''Super-seeding (BEP 16)
+
+A seed that is the only source of a torrent would otherwise upload the
+same first pieces to every peer, and the whole torrent many times over
+before the peers could serve each other. A super-seed instead hides
+which pieces it has. Each peer is told (with a have message) about one
+piece at a time, a piece that no connected peer has or has been offered,
+and may only request the pieces it was told about. Pieces that other
+peers have are left for them to pass on.
+
+A peer is offered its next piece once the last one has reached another
+peer, as seen in that peer's have messages. A peer that keeps its piece
+to itself is therefore offered nothing more, and every piece is uploaded
+by the seed about once. A peer that is the only one connected is offered
+its next piece as soon as it has the last. When a peer leaves, the
+pieces that no one else has (or was offered) are offered again.
+
+Every connection taking part is a dictionary with the keys
+
+  infohash         the torrent of the connection
+  pieces_expected  the number of pieces of the torrent
+  peer_has         the pieces the peer has told us it has
+  offered          the pieces offered to the peer and not seen elsewhere
+  advertised       every piece offered to the peer, which it may request
+
+which the async seeder keeps in its connection state.
+'''
+
+# Project
+import metrics, pwp
+
+
+OFFERS = metrics.counter('simpletorrent_super_seed_offers_total', 'Pieces offered to a single peer while super-seeding')
+PASSED_ON = metrics.counter('simpletorrent_super_seed_pieces_passed_total', 'Offered pieces seen at another peer')
+
+
+class _Torrent():
+
+  __slots__ = ('peers', 'offered', 'seen')
+
+  def __init__(self, num_pieces):
+
+    # The connected peers, by id
+    self.peers = dict()
+
+    # Mapping from index to the peers (by id) the piece is offered to
+    self.offered = dict()
+
+    # The number of connected peers that have each piece
+    self.seen = [0] * num_pieces
+
+
+class SuperSeeder():
+  '''Decides which pieces the peers of each torrent are told about'''
+
+  def __init__(self):
+
+    # Mapping from infohash to the state of each torrent with peers
+    self.torrents = dict()
+
+
+  def joined(self, peer):
+    '''Offer a new peer its first piece'''
+
+    torrent = self.torrents.get(peer['infohash'])
+
+    if torrent is None:
+      torrent = self.torrents[peer['infohash']] = _Torrent(peer['pieces_expected'])
+
+    torrent.peers[id(peer)] = peer
+
+    self._count(torrent, peer['peer_has'], 1)
+    self._offer(torrent, peer)
+
+
+  def have(self, peer, indices):
+    '''A peer announced pieces it did not have before'''
+
+    torrent = self.torrents.get(peer['infohash'])
+
+    if torrent is None or id(peer) not in torrent.peers:
+      return
+
+    self._count(torrent, indices, 1)
+
+    for index in indices:
+      for other in list(torrent.offered.get(index, dict()).values()):
+
+        # The peer got its own piece. It has passed it on only if someone
+        # else has it too (or there is no one to pass it to).
+        if other is peer and torrent.seen[index] < 2 and len(torrent.peers) > 1:
+          continue
+
+        PASSED_ON.inc()
+        self._release(torrent, other, index)
+
+
+  def left(self, peer):
+    '''A peer disconnected. Its offered pieces may be offered again.'''
+
+    torrent = self.torrents.get(peer['infohash'])
+
+    if torrent is None or id(peer) not in torrent.peers:
+      return
+
+    del torrent.peers[id(peer)]
+    self._count(torrent, peer['peer_has'], -1)
+
+    for index in peer['offered']:
+      self._withdraw(torrent, peer, index)
+
+    if not torrent.peers:
+      del self.torrents[peer['infohash']]
+      return
+
+    # A peer left on its own need not wait for its piece to be passed on
+    if len(torrent.peers) == 1:
+      last, = torrent.peers.values()
+
+      for index in list(last['offered'] & last['peer_has']):
+        self._release(torrent, last, index)
+
+    # The pieces only the peer had, or was offered, go to those waiting
+    for other in list(torrent.peers.values()):
+      self._offer(torrent, other)
+
+
+  def _count(self, torrent, indices, change):
+    for index in indices:
+      if 0 <= index < len(torrent.seen):
+        torrent.seen[index] += change
+
+
+  def _withdraw(self, torrent, peer, index):
+    offered = torrent.offered[index]
+    del offered[id(peer)]
+
+    if not offered:
+      del torrent.offered[index]
+
+
+  def _release(self, torrent, peer, index):
+    '''A peer's offered piece has been passed on. It is offered another.'''
+
+    self._withdraw(torrent, peer, index)
+
+    peer['offered'].discard(index)
+    self._offer(torrent, peer)
+
+
+  def _offer(self, torrent, peer):
+    '''Tell a peer about a new piece, unless it is still waiting for its
+       last one to be passed on'''
+
+    if peer['offered'] or peer['transport'].is_closing():
+      return
+
+    index = next((index for index, seen in enumerate(torrent.seen) if seen == 0 and index not in torrent.offered and index not in peer['advertised']), None)
+
+    if index is None:
+      return
+
+    torrent.offered.setdefault(index, dict())[id(peer)] = peer
+    peer['offered'].add(index)
+    peer['advertised'].add(index)
+
+    OFFERS.inc()
+    peer['protocol'].send(pwp.have(index))
@@ -3,6 +3,9 @@
 # Stdlib
 import datetime, hashlib
 
+# Project
+import merkle
+
 def parse_bencode(byts, start=0):
   '''Parse a bencoded bytestring'''
 
@@ -58,19 +61,89 @@ def parse_bencode(byts, start=0):
     while byts[pos] != ord('e'):
       raw_key, pos = parse_bencode(byts, pos)
       value, pos = parse_bencode(byts, pos)
-      if raw_key.decode() in {'announce', 'comment', 'created by', 'encoding', 'name'}:
-        res[raw_key.decode()] = value.decode()
+
+      # Binary keys (like the infohashes in a scrape response) stay bytes
+      try:
+        key = raw_key.decode()
+      except UnicodeDecodeError:
+        key = raw_key
+
+      if key in {'announce', 'comment', 'created by', 'encoding', 'name'}:
+        res[key] = value.decode()
       else:
-        res[raw_key.decode()] = value
+        res[key] = value
 
     return res, pos + 1
 
 
 def infohash(torr_dict):
-  '''Return the infohash of a torrent as a hexstring'''
+  '''Return the infohash of a torrent as a hexstring
+
+  A v2-only torrent (see create_torrent) has no SHA-1 infohash, and is
+  identified by its SHA-256 infohash truncated to 20 bytes instead.
+  '''
+
+  if 'pieces' not in torr_dict['info']:
+    return hashlib.sha256(bencode(torr_dict['info'])).digest()[:20]
+
   return hashlib.sha1(bencode(torr_dict['info'])).digest()
 
 
+def is_v2(torr_dict):
+  '''Does the torrent have v2 merkle hashes (BEP 52)?'''
+  return torr_dict['info'].get('meta version') == 2
+
+
+def _file_entry(torr_dict):
+  '''The file tree entry of a v2 torrent's single file'''
+  return next(iter(torr_dict['info']['file tree'].values()))['']
+
+
+def length(torr_dict):
+  '''The length of the torrent's file (in bytes)'''
+
+  if 'length' in torr_dict['info']:
+    return torr_dict['info']['length']
+
+  return _file_entry(torr_dict)['length']
+
+
+def pieces_root(torr_dict):
+  '''The root of the merkle tree of a v2 torrent's file'''
+  return _file_entry(torr_dict)['pieces root']
+
+
+def _piece_layer(torr_dict):
+  '''The concatenated piece hashes of a v2 torrent'''
+
+  root = pieces_root(torr_dict)
+
+  # A file of a single piece has no piece layer, its root being the hash
+  # of its only piece
+  if length(torr_dict) <= torr_dict['info']['piece length']:
+    return root
+
+  # The keys are binary, but may have been decoded (see parse_bencode)
+  layers = torr_dict['piece layers']
+  return layers[root] if root in layers else next(value for key, value in layers.items() if isinstance(key, str) and key.encode() == root)
+
+
+def piece_hash(torr_dict, index):
+  '''The merkle hash of a piece of a v2 torrent'''
+  return _piece_layer(torr_dict)[merkle.HASH * index : merkle.HASH * (index + 1)]
+
+
+def piece_layer(torr_dict):
+  '''The merkle hash of every piece of a v2 torrent
+
+  The piece layer is not part of the info dictionary, so it is only as
+  trustworthy as its root, which should be checked.
+  '''
+
+  layer = _piece_layer(torr_dict)
+  return [layer[i : i + merkle.HASH] for i in range(0, len(layer), merkle.HASH)]
+
+
 def read_torrent_file(file_name):
   '''Read a torrent file'''
 
@@ -80,19 +153,29 @@ def read_torrent_file(file_name):
   return parse_bencode(byts)[0]
 
 
-def create_torrent(file_name, piece_length=2**18, comment=''):
+def create_torrent(file_name, piece_length=2**18, comment='', announce='', version=1):
   '''Generate torrent info for the given file.
 
+  version is 1 for SHA-1 piece hashes, 2 for the merkle hashes of
+  BitTorrent v2 (BEP 52), or 'hybrid' for both, so the torrent can be
+  downloaded by v1 and v2 peers alike.
+
   Return a dictionary containing the torrent info for the given file.
   '''
 
   # TODO: If file_name is a directory, create a multi-file torrent
 
+  if version not in (1, 2, 'hybrid'):
+    raise Exception('Invalid torrent version: {}'.format(version))
+
+  # v2 pieces are whole subtrees of blocks
+  if version != 1 and (piece_length < merkle.BLOCK or piece_length & (piece_length - 1)):
+    raise Exception('The piece length of a v2 torrent must be a power of two of at least {} bytes'.format(merkle.BLOCK))
+
   hash_list = []
-  file_length  = 0
 
   torrent = {
-              'announce': '',
+              'announce': announce,
               'info': {
                 'name': file_name.split('/')[-1],
                 'piece length': piece_length
@@ -102,24 +185,57 @@ def create_torrent(file_name, piece_length=2**18, comment=''):
               'encoding': 'ascii'
             }
 
-  with open(file_name, 'rb') as f:
-    
-    md5hash = hashlib.md5()
+  md5hash = hashlib.md5()
+
+  def read_pieces(f):
+    '''Yield every piece, computing its sha1 digest on the way'''
 
     # Read the first piece
     piece = f.read(piece_length)
 
-    # Compute the sha1 digest of every piece
     while len(piece) > 0:
       md5hash.update(piece)
-      hash_list.append(hashlib.sha1(piece).digest())
+
+      if version != 2:
+        hash_list.append(hashlib.sha1(piece).digest())
+
+      yield piece
       piece = f.read(piece_length)
 
+  with open(file_name, 'rb') as f:
+
+    # The blocks are hashed on a thread pool while the file is read
+    if version == 1:
+      for piece in read_pieces(f):
+        pass
+    else:
+      leaves = merkle.hash_chunks(read_pieces(f))
+
     # The length of the file (in bytes)
-    torrent['info']['length'] = f.tell()
+    file_length = f.tell()
+
+  if version != 2:
+    torrent['info']['length'] = file_length
+
+    # Concatenate the piece hashes to create the 'piece' field
+    torrent['info']['pieces'] = b''.join(hash_list)
 
-  # Concatenate the piece hashes to create the 'piece' field
-  torrent['info']['pieces'] = b''.join(hash_list)
+  if version != 1:
+    torrent['info']['meta version'] = 2
+
+    # An empty file has no root
+    entry = {'length': file_length}
+
+    if file_length > 0:
+      entry['pieces root'] = merkle.pieces_root(leaves, file_length, piece_length)
+
+    torrent['info']['file tree'] = {torrent['info']['name']: {'': entry}}
+
+    # The hashes of the pieces, so each can be checked as it arrives
+    torrent['piece layers'] = dict()
+
+    if file_length > piece_length:
+      torrent['piece layers'][entry['pieces root']] = b''.join(merkle.piece_layer(leaves, file_length, piece_length))
 
   # Add the md5 sum of the file
   torrent['info']['md5sum'] = md5hash.digest().hex()
@@ -128,8 +244,7 @@ def create_torrent(file_name, piece_length=2**18, comment=''):
   torrent['creation date'] = int(datetime.datetime.now().timestamp())
 
   return torrent
-  
- 
+
 
 def bencode(data):
   '''Bencode data
@@ -151,10 +266,10 @@ def bencode(data):
     raise Exception('Invalid data type encountered: {}'.format(data))
 
 
-def create_torrent_file(input_file, save_dir='torrents'):
+def create_torrent_file(input_file, save_dir='torrents', announce='', version=1):
   '''Create a torrent file for the given input file.'''
 
-  t = create_torrent(input_file)
+  t = create_torrent(input_file, announce=announce, version=version)
   output_file = '{}/{}.torrent'.format(save_dir, input_file.split('/')[-1])
 
   with open(output_file, 'bw') as f:
@@ -0,0 +1,721 @@
+'''Tracker clients and announce scheduling
+
+HTTPTracker talks to an HTTP tracker over a small pool of keep-alive
+connections, so the announces for thousands of torrents on the same
+tracker do not each pay for a TCP handshake. Peer lists are requested in
+the compact format (BEP 23) and unpacked straight into (ip, port) tuples.
+
+UDPTracker speaks the UDP tracker protocol (BEP 15), which needs two
+small datagrams per announce instead of a TCP connection and an HTTP
+exchange. Its connection ID is cached for the minute the protocol allows,
+lost datagrams are retransmitted with exponential backoff, and a scrape
+packs as many infohashes into each request as fit.
+
+An Announcer keeps every torrent announced: it re-announces each one when
+the tracker's interval (never less than its min interval) runs out, with
+some jitter so that torrents added together do not stay in lock-step.
+'''
+
+# Stdlib
+import asyncio, socket, struct, random, time, urllib.parse, logging, heapq, collections
+
+# Project
+import torrent, metrics
+
+
+log = logging.getLogger('tracker')
+
+ANNOUNCES = metrics.counter('simpletorrent_tracker_announces_total', 'Tracker announces, by result', ['result'])
+ANNOUNCE_SECONDS = metrics.histogram('simpletorrent_tracker_announce_seconds', 'Latency of tracker announces')
+
+# Compact peer entries: IPv4 or IPv6 address followed by a port
+COMPACT_PEER = struct.Struct('!4sH')
+COMPACT_PEER6 = struct.Struct('!16sH')
+
+# UDP tracker protocol (BEP 15)
+UDP_PROTOCOL_ID = 0x41727101980
+UDP_HEADER = struct.Struct('!QII')
+UDP_RESPONSE = struct.Struct('!II')
+UDP_CONNECT_RESPONSE = struct.Struct('!IIQ')
+UDP_ANNOUNCE = struct.Struct('!20s20sQQQIIIiH')
+UDP_ANNOUNCE_RESPONSE = struct.Struct('!IIIII')
+UDP_SCRAPE_ENTRY = struct.Struct('!III')
+
+ACTION_CONNECT, ACTION_ANNOUNCE, ACTION_SCRAPE, ACTION_ERROR = range(4)
+
+UDP_EVENTS = {None: 0, 'completed': 1, 'started': 2, 'stopped': 3}
+
+# How long a UDP tracker's connection ID may be used (seconds)
+CONNECTION_ID_LIFETIME = 60
+
+# The most infohashes in one UDP scrape request
+MAX_SCRAPE = 74
+
+# Used when a tracker does not say how often to announce (seconds)
+DEFAULT_INTERVAL = 1800
+
+# First retry delay after a failed announce, doubled on every failure
+RETRY_INTERVAL = 60
+
+# The shortest interval a tracker may ask for (seconds)
+MIN_INTERVAL = 60
+
+
+def parse_compact_peers(data):
+  '''Unpack a compact IPv4 peer list into (ip, port) tuples'''
+
+  return [(socket.inet_ntoa(ip), port) for ip, port in COMPACT_PEER.iter_unpack(data[:len(data) - len(data) % COMPACT_PEER.size])]
+
+
+def parse_compact_peers6(data):
+  '''Unpack a compact IPv6 peer list into (ip, port) tuples'''
+
+  return [(socket.inet_ntop(socket.AF_INET6, ip), port) for ip, port in COMPACT_PEER6.iter_unpack(data[:len(data) - len(data) % COMPACT_PEER6.size])]
+
+
+def parse_peers(response):
+  '''All peers in an announce response, compact or not'''
+
+  peers = response.get('peers', b'')
+
+  if isinstance(peers, bytes):
+    peers = parse_compact_peers(peers)
+  else:
+    peers = [(peer['ip'].decode(), peer['port']) for peer in peers]
+
+  return peers + parse_compact_peers6(response.get('peers6', b''))
+
+
+def parse_response(body):
+  '''Decode a bencoded tracker response, raising the tracker's failure'''
+
+  response = torrent.parse_bencode(body)[0]
+
+  if not isinstance(response, dict):
+    raise Exception('invalid tracker response')
+
+  if 'failure reason' in response:
+    raise Exception('tracker failure: ' + response['failure reason'].decode(errors='replace'))
+
+  return response
+
+
+class _Unlimited():
+  '''Stands in for the semaphore of a tracker client with no limit'''
+
+  async def __aenter__(self):
+    pass
+
+  async def __aexit__(self, *exc_info):
+    pass
+
+
+class HTTPTracker():
+  '''A client for one HTTP tracker
+
+     Requests are sent over at most max_connections keep-alive
+     connections, which are reused until the tracker closes them. If a
+     limit (a semaphore, possibly shared with other clients) is given,
+     it is held for each request.
+  '''
+
+  def __init__(self, url, max_connections=4, timeout=15.0, limit=None):
+
+    self.url = url
+
+    parts = urllib.parse.urlsplit(url)
+
+    self.host = parts.hostname
+    self.ssl = parts.scheme == 'https'
+    self.port = parts.port or (443 if self.ssl else 80)
+    self.path = parts.path or '/'
+    self.query = parts.query
+
+    self.timeout = timeout
+
+    # Idle keep-alive connections, as (reader, writer) pairs
+    self.idle = []
+
+    # Limits the connections open at once
+    self.slots = asyncio.Semaphore(max_connections)
+
+    # Limits the requests in flight at once, across clients
+    self.limit = limit if limit is not None else _Unlimited()
+
+
+  def _target(self, path, params):
+    '''The request target for a path and a list of query parameters'''
+
+    query = '&'.join(key + '=' + urllib.parse.quote_from_bytes(value if isinstance(value, bytes) else str(value).encode()) for key, value in params)
+
+    if self.query:
+      query = self.query + '&' + query
+
+    return path + '?' + query
+
+
+  async def _read_response(self, reader):
+    '''Read one response. Returns (status, body, keep_alive).'''
+
+    status_line = await reader.readline()
+
+    if not status_line:
+      raise ConnectionResetError('tracker closed the connection')
+
+    version, status = status_line.split(None, 2)[:2]
+    headers = dict()
+
+    while True:
+      line = await reader.readline()
+
+      if line in (b'\r\n', b'\n', b''):
+        break
+
+      key, _, value = line.decode('latin-1').partition(':')
+      headers[key.strip().lower()] = value.strip()
+
+    keep_alive = headers.get('connection', '').lower() != 'close' and version != b'HTTP/1.0'
+
+    if headers.get('transfer-encoding', '').lower() == 'chunked':
+      body = bytearray()
+
+      while True:
+        size = int((await reader.readline()).split(b';')[0], 16)
+
+        if size == 0:
+          await reader.readline()
+          break
+
+        body += await reader.readexactly(size)
+        await reader.readline()
+
+    elif 'content-length' in headers:
+      body = await reader.readexactly(int(headers['content-length']))
+
+    else:
+      body = await reader.read()
+      keep_alive = False
+
+    return int(status), bytes(body), keep_alive
+
+
+  async def _get(self, target):
+    '''GET a request target, reusing an idle connection if there is one
+
+       The timeout starts once the request may be sent, so time spent
+       queued behind other requests does not count against it.
+    '''
+
+    request = 'GET {} HTTP/1.1\r\nHost: {}\r\nUser-Agent: SimpleTorrent\r\nConnection: keep-alive\r\n\r\n'.format(target, self.host).encode()
+
+    # The tracker's own slot first, so that requests queued behind a
+    # slow tracker do not hold slots shared with the others
+    async with self.slots, self.limit:
+      return await asyncio.wait_for(self._send(request), self.timeout)
+
+
+  async def _send(self, request):
+    '''Send a request and read its response body'''
+
+    # A reused connection may have been closed by the tracker in the
+    # meantime, so a failure on one is retried on a fresh connection
+    while True:
+      reused = bool(self.idle)
+
+      if reused:
+        reader, writer = self.idle.pop()
+      else:
+        reader, writer = await asyncio.open_connection(self.host, self.port, ssl=self.ssl or None)
+
+      try:
+        writer.write(request)
+        status, body, keep_alive = await self._read_response(reader)
+      except (ConnectionError, asyncio.IncompleteReadError, ValueError):
+        writer.close()
+        if reused:
+          continue
+        raise
+      except BaseException:
+        writer.close()
+        raise
+
+      if keep_alive:
+        self.idle.append((reader, writer))
+      else:
+        writer.close()
+
+      if status != 200:
+        raise Exception('tracker returned HTTP {}'.format(status))
+
+      return body
+
+
+  async def announce(self, infohash, peer_id, port, uploaded=0, downloaded=0, left=0, event=None, numwant=50, tracker_id=None):
+    '''Announce a torrent. Returns the decoded response, with the peers
+       in response['peers'] as (ip, port) tuples.
+
+       tracker_id is the 'tracker id' of the tracker's last response for
+       the torrent, if it gave one, which is sent back (BEP 3).
+    '''
+
+    params = [('info_hash', infohash), ('peer_id', peer_id), ('port', port),
+      ('uploaded', uploaded), ('downloaded', downloaded), ('left', left),
+      ('compact', 1), ('numwant', numwant)]
+
+    if event is not None:
+      params.append(('event', event))
+
+    if tracker_id is not None:
+      params.append(('trackerid', tracker_id))
+
+    body = await self._get(self._target(self.path, params))
+
+    response = parse_response(body)
+    response['peers'] = parse_peers(response)
+
+    return response
+
+
+  async def scrape(self, infohashes):
+    '''Scrape several torrents at once. Returns a mapping from infohash to
+       a dictionary with its complete, incomplete and downloaded counts.'''
+
+    # The scrape URL replaces the last 'announce' in the path (BEP 48)
+    head, sep, tail = self.path.rpartition('/')
+
+    if not tail.startswith('announce'):
+      raise Exception('tracker does not support scrape: ' + self.url)
+
+    path = head + sep + 'scrape' + tail[len('announce'):]
+
+    body = await self._get(self._target(path, [('info_hash', ih) for ih in infohashes]))
+
+    files = parse_response(body).get('files', dict())
+
+    # Keys that happen to be valid UTF-8 were decoded by the parser
+    return { key if isinstance(key, bytes) else key.encode() : value for key, value in files.items() }
+
+
+  def close(self):
+    for reader, writer in self.idle:
+      writer.close()
+
+    self.idle = []
+
+
+class _UDPTrackerProtocol(asyncio.DatagramProtocol):
+
+  def __init__(self, tracker):
+    self.tracker = tracker
+
+  def datagram_received(self, data, addr):
+    self.tracker._received(data)
+
+  def error_received(self, exc):
+    # ICMP errors; the request is retransmitted or times out
+    pass
+
+
+class UDPTracker():
+  '''A client for one UDP tracker
+
+     Every request gets a random transaction ID, and responses are
+     matched to their requests by it, so any number of requests can be
+     outstanding on the one socket. A request that gets no response is
+     sent again after timeout * 2**n seconds, for n up to retries.
+
+     If a limit (a semaphore, possibly shared with other clients) is
+     given, it is held while each datagram awaits its response, and not
+     between retransmissions, so a dead tracker does not hold it for the
+     whole of its backoff.
+  '''
+
+  def __init__(self, url, timeout=15.0, retries=8, limit=None):
+
+    self.url = url
+
+    parts = urllib.parse.urlsplit(url)
+
+    self.host = parts.hostname
+    self.port = parts.port
+
+    self.timeout = timeout
+    self.retries = retries
+
+    # Limits the requests in flight at once, across clients
+    self.limit = limit if limit is not None else _Unlimited()
+
+    self.transport = None
+
+    # Mapping from transaction ID to the future awaiting its response
+    self.pending = dict()
+
+    # The current connection ID and when it was obtained
+    self.connection_id = None
+    self.connected_at = 0
+
+    # Only one connect request is sent at a time
+    self.connecting = asyncio.Lock()
+
+    # Identifies us to the tracker if our address changes
+    self.key = random.getrandbits(32)
+
+
+  async def _endpoint(self):
+    if self.transport is None:
+      loop = asyncio.get_event_loop()
+      self.transport, _ = await loop.create_datagram_endpoint(lambda: _UDPTrackerProtocol(self), remote_addr=(self.host, self.port))
+
+    return self.transport
+
+
+  def _received(self, data):
+    '''Hand a datagram to the request waiting for it'''
+
+    if len(data) < UDP_RESPONSE.size:
+      return
+
+    action, transaction_id = UDP_RESPONSE.unpack_from(data)
+    future = self.pending.pop(transaction_id, None)
+
+    if future is None or future.done():
+      return
+
+    if action == ACTION_ERROR:
+      future.set_exception(Exception('tracker error: ' + data[UDP_RESPONSE.size:].decode(errors='replace')))
+    else:
+      future.set_result((action, data))
+
+
+  async def _exchange(self, packet, action, wait):
+    '''Send one request and wait for its response'''
+
+    transport = await self._endpoint()
+
+    async with self.limit:
+      transaction_id = random.getrandbits(32)
+      future = asyncio.get_event_loop().create_future()
+      self.pending[transaction_id] = future
+
+      transport.sendto(packet(transaction_id))
+
+      try:
+        response_action, data = await asyncio.wait_for(future, wait)
+      finally:
+        self.pending.pop(transaction_id, None)
+
+    if response_action != action:
+      raise Exception('tracker answered action {} with action {}'.format(action, response_action))
+
+    return data
+
+
+  async def _request(self, action, body):
+    '''Send a request, connecting first if needed, and return the response'''
+
+    for n in range(self.retries + 1):
+      wait = self.timeout * 2**n
+
+      try:
+        async with self.connecting:
+          if self.connection_id is None or time.monotonic() - self.connected_at > CONNECTION_ID_LIFETIME:
+            data = await self._exchange(lambda tid: UDP_HEADER.pack(UDP_PROTOCOL_ID, ACTION_CONNECT, tid), ACTION_CONNECT, wait)
+
+            if len(data) < UDP_CONNECT_RESPONSE.size:
+              raise Exception('truncated connect response')
+
+            self.connection_id = UDP_CONNECT_RESPONSE.unpack_from(data)[2]
+            self.connected_at = time.monotonic()
+
+        connection_id = self.connection_id
+
+        return await self._exchange(lambda tid: UDP_HEADER.pack(connection_id, action, tid) + body, action, wait)
+
+      except asyncio.TimeoutError:
+        continue
+
+    raise Exception('no response from tracker ' + self.url)
+
+
+  def _ipv6(self):
+    sock = self.transport.get_extra_info('socket')
+    return sock is not None and sock.family == socket.AF_INET6
+
+
+  async def announce(self, infohash, peer_id, port, uploaded=0, downloaded=0, left=0, event=None, numwant=50, tracker_id=None):
+    '''Announce a torrent. Returns a response like HTTPTracker.announce.
+       UDP trackers have no tracker id, so tracker_id is ignored.'''
+
+    body = UDP_ANNOUNCE.pack(infohash, peer_id, downloaded, left, uploaded, UDP_EVENTS[event], 0, self.key, numwant, port)
+
+    data = await self._request(ACTION_ANNOUNCE, body)
+
+    if len(data) < UDP_ANNOUNCE_RESPONSE.size:
+      raise Exception('truncated announce response')
+
+    _, _, interval, leechers, seeders = UDP_ANNOUNCE_RESPONSE.unpack_from(data)
+    peers = data[UDP_ANNOUNCE_RESPONSE.size:]
+
+    return {'interval': interval, 'incomplete': leechers, 'complete': seeders,
+      'peers': parse_compact_peers6(peers) if self._ipv6() else parse_compact_peers(peers)}
+
+
+  async def scrape(self, infohashes):
+    '''Scrape several torrents, MAX_SCRAPE per request. Returns a
+       mapping like HTTPTracker.scrape.'''
+
+    infohashes = list(infohashes)
+    files = dict()
+
+    for i in range(0, len(infohashes), MAX_SCRAPE):
+      batch = infohashes[i : i + MAX_SCRAPE]
+      data = await self._request(ACTION_SCRAPE, b''.join(batch))
+
+      end = UDP_RESPONSE.size + len(batch) * UDP_SCRAPE_ENTRY.size
+
+      if len(data) < end:
+        raise Exception('truncated scrape response')
+
+      for infohash, (seeders, completed, leechers) in zip(batch, UDP_SCRAPE_ENTRY.iter_unpack(data[UDP_RESPONSE.size : end])):
+        files[infohash] = {'complete': seeders, 'downloaded': completed, 'incomplete': leechers}
+
+    return files
+
+
+  def close(self):
+    if self.transport is not None:
+      self.transport.close()
+      self.transport = None
+
+
+def client(url, limit=None):
+  '''A tracker client for the given announce URL, whose requests are
+     limited by the given semaphore (if any)'''
+
+  scheme = urllib.parse.urlsplit(url).scheme
+
+  if scheme in ('http', 'https'):
+    return HTTPTracker(url, limit=limit)
+
+  if scheme == 'udp':
+    return UDPTracker(url, limit=limit)
+
+  raise Exception('unsupported tracker: ' + url)
+
+
+async def announce_once(url, infohash, peer_id, port, left=0):
+  '''Announce a torrent to a tracker once, returning its peers'''
+
+  tracker = client(url)
+
+  try:
+    response = await tracker.announce(infohash, peer_id, port, left=left, event='started')
+  finally:
+    tracker.close()
+
+  return response['peers']
+
+
+class Announcer():
+  '''Keeps many torrents announced to their trackers
+
+     New torrents are first announced at a random time, spread out at
+     about rate announces per second but never later than spread seconds
+     after they were added. After that each torrent is re-announced when its
+     tracker's interval runs out, less up to jitter of the interval (but
+     never sooner than the tracker's min interval). Failed announces are
+     retried with exponential backoff.
+
+     At most concurrency requests are in flight at once: an HTTP request,
+     or a UDP datagram awaiting its response, holds one of the slots.
+
+     stats(infohash) returns the (uploaded, downloaded, left) byte counts
+     to report, and on_peers(infohash, peers) is given the peers of every
+     successful announce.
+  '''
+
+  def __init__(self, peer_id, port, stats=None, on_peers=None, concurrency=32, spread=30.0, rate=100, jitter=0.1):
+
+    self.peer_id = peer_id
+    self.port = port
+    self.stats = stats
+    self.on_peers = on_peers
+
+    self.spread = spread
+    self.rate = rate
+    self.jitter = jitter
+
+    # Mapping from announce URL to the client for that tracker
+    self.trackers = dict()
+
+    # Mapping from infohash to its announce state
+    self.torrents = dict()
+
+    # Announces due, as (time, infohash); entries whose time no longer
+    # matches the torrent's state are stale
+    self.schedule = []
+
+    # Limits the requests in flight at once, shared by the clients
+    self.slots = asyncio.Semaphore(concurrency)
+
+    # Announces in flight (including final 'stopped' ones)
+    self.tasks = set()
+
+    self.running = False
+
+
+  def _tracker(self, url):
+    tracker = self.trackers.get(url)
+
+    if tracker is None:
+      tracker = self.trackers[url] = client(url, limit=self.slots)
+
+    return tracker
+
+
+  def _schedule(self, infohash, delay):
+    state = self.torrents[infohash]
+    state['due'] = time.monotonic() + delay
+    heapq.heappush(self.schedule, (state['due'], infohash))
+
+
+  def add(self, infohash, url):
+    '''Start announcing a torrent to the tracker at url'''
+
+    if infohash in self.torrents:
+      return
+
+    try:
+      self._tracker(url)
+    except Exception as e:
+      log.warning('not announcing %s: %s', infohash.hex(), e)
+      return
+
+    self.torrents[infohash] = {'url': url, 'due': None, 'started': False, 'failures': 0,
+      'interval': DEFAULT_INTERVAL, 'min interval': 0, 'tracker id': None}
+
+    self._schedule(infohash, random.uniform(0, min(self.spread, len(self.torrents) / self.rate)))
+
+
+  def remove(self, infohash):
+    '''Stop announcing a torrent, telling its tracker we have stopped'''
+
+    state = self.torrents.pop(infohash, None)
+
+    if state is not None and state['started']:
+      self._spawn(self._announce(infohash, state, 'stopped'))
+
+
+  def _spawn(self, coro):
+    task = asyncio.ensure_future(coro)
+    self.tasks.add(task)
+    task.add_done_callback(self.tasks.discard)
+
+
+  async def _announce(self, infohash, state, event=None):
+    '''Announce one torrent and schedule its next announce'''
+
+    uploaded, downloaded, left = self.stats(infohash) if self.stats is not None else (0, 0, 0)
+    started = time.perf_counter()
+
+    try:
+      response = await self._tracker(state['url']).announce(infohash, self.peer_id, self.port,
+        uploaded, downloaded, left, event, tracker_id=state['tracker id'])
+    except Exception as e:
+      ANNOUNCES.labels('error').inc()
+      log.warning('announce of %s to %s failed: %s', infohash.hex(), state['url'], e)
+
+      if event != 'stopped' and self.torrents.get(infohash) is state:
+        state['failures'] += 1
+        self._schedule(infohash, min(state['interval'], RETRY_INTERVAL * 2**(state['failures'] - 1)))
+
+      return
+
+    ANNOUNCES.labels('ok').inc()
+    ANNOUNCE_SECONDS.observe(time.perf_counter() - started)
+
+    if event == 'stopped' or self.torrents.get(infohash) is not state:
+      return
+
+    state['started'] = True
+    state['failures'] = 0
+    # A tracker may not make us announce in a tight loop
+    interval = response.get('interval', DEFAULT_INTERVAL)
+    min_interval = response.get('min interval', 0)
+
+    state['interval'] = max(interval if isinstance(interval, int) else DEFAULT_INTERVAL, MIN_INTERVAL)
+    state['min interval'] = max(min_interval if isinstance(min_interval, int) else 0, MIN_INTERVAL)
+
+    # Once given, the tracker id is sent with every later announce
+    if response.get('tracker id') is not None:
+      state['tracker id'] = response['tracker id']
+
+    # Re-announce a little early, by a random fraction of the interval
+    delay = state['interval'] * (1 - random.uniform(0, self.jitter))
+    self._schedule(infohash, max(delay, state['min interval']))
+
+    if self.on_peers is not None and response['peers']:
+      self.on_peers(infohash, response['peers'])
+
+
+  async def run(self, tick=1.0):
+    '''Send announces as they fall due, until close() is called'''
+
+    self.running = True
+
+    while self.running:
+      now = time.monotonic()
+
+      # Start every announce that is due
+      while self.schedule and self.schedule[0][0] <= now:
+        due, infohash = heapq.heappop(self.schedule)
+        state = self.torrents.get(infohash)
+
+        if state is None or state['due'] != due:
+          continue
+
+        state['due'] = None
+        self._spawn(self._announce(infohash, state, None if state['started'] else 'started'))
+
+      delay = self.schedule[0][0] - now if self.schedule else tick
+      await asyncio.sleep(min(max(delay, 0), tick))
+
+
+  async def scrape(self):
+    '''Scrape every torrent, batching the torrents of each tracker into
+       as few requests as it allows. Returns a mapping like
+       HTTPTracker.scrape.'''
+
+    by_url = collections.defaultdict(list)
+
+    for infohash, state in self.torrents.items():
+      by_url[state['url']].append(infohash)
+
+    async def scrape_tracker(url, infohashes):
+      try:
+        return await self._tracker(url).scrape(infohashes)
+      except Exception as e:
+        log.warning('scrape of %s failed: %s', url, e)
+        return dict()
+
+    files = dict()
+
+    for result in await asyncio.gather(*[scrape_tracker(url, infohashes) for url, infohashes in by_url.items()]):
+      files.update(result)
+
+    return files
+
+
+  async def close(self, timeout=5.0):
+    '''Tell the trackers we have stopped, and close their connections'''
+
+    self.running = False
+
+    for infohash in list(self.torrents):
+      self.remove(infohash)
+
+    if self.tasks:
+      await asyncio.wait(list(self.tasks), timeout=timeout)
+
+    for tracker in self.trackers.values():
+      tracker.close()
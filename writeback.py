@@ -0,0 +1,293 @@
+'''A write-back cache for downloaded pieces
+
+Verified pieces are kept in memory instead of being written one at a
+time as they arrive. When the cached pieces reach the memory budget (or
+the owner asks, e.g. every few seconds), they are handed to a background
+thread. That thread sorts them by offset, joins neighbouring pieces into
+large contiguous writes, and fsyncs the file.
+
+Which pieces we have is persisted in a state file next to the download
+(the path plus '.state'), holding one bit per piece. The state file is
+only rewritten after the data of the pieces it adds has been fsynced,
+and it is replaced atomically. After a crash it can therefore only miss
+pieces that are on disk, never claim pieces that are not. A batch that
+fails to be written is not recorded either: its pieces are reported to
+the owner, which must not treat them as saved.
+
+A flush is not started while the last one is still being written, so a
+slow disk gets a few large batches rather than one per piece. The owner
+should stop adding pieces while the cache is full() (and may resume once
+a batch is written), as the cache itself never refuses a piece.
+'''
+
+# Stdlib
+import os, time, logging, threading
+from concurrent.futures import ThreadPoolExecutor
+
+# Project
+import metrics
+
+
+log = logging.getLogger('writeback')
+
+DIRTY_BYTES = metrics.gauge('simpletorrent_write_cache_bytes', 'Verified pieces held in memory until they are written')
+FLUSHES = metrics.counter('simpletorrent_write_cache_flushes_total', 'Batches of pieces written by the write-back cache')
+FLUSH_SECONDS = metrics.histogram('simpletorrent_write_cache_flush_seconds', 'Time taken to write, fsync and record a batch of pieces')
+DISK_WRITE_SECONDS = metrics.histogram('simpletorrent_disk_write_seconds', 'Latency of piece writes')
+
+# The default memory budget (bytes)
+BUDGET = 64 * 2**20
+
+# The largest single write that neighbouring pieces are joined into
+MAX_WRITE = 8 * 2**20
+
+# Seconds between flushes requested by the owner
+FLUSH_INTERVAL = 5.0
+
+
+def load_state(path, num_pieces):
+  '''The set of pieces recorded in a state file (empty if there is none)'''
+
+  try:
+    with open(path, 'rb') as f:
+      bits = f.read()
+  except FileNotFoundError:
+    return set()
+
+  # A state file for a different torrent
+  if len(bits) != (num_pieces + 7) // 8:
+    return set()
+
+  return { i for i in range(num_pieces) if bits[i // 8] & (128 >> (i % 8)) }
+
+
+def save_state(path, pieces, num_pieces):
+  '''Atomically replace a state file'''
+
+  bits = bytearray((num_pieces + 7) // 8)
+
+  for i in pieces:
+    bits[i // 8] |= 128 >> (i % 8)
+
+  tmp = path + '.tmp'
+
+  with open(tmp, 'wb') as f:
+    f.write(bits)
+    f.flush()
+    os.fsync(f.fileno())
+
+  os.replace(tmp, path)
+
+
+class WriteBackCache():
+  '''Verified pieces of one file, written in the background
+
+     put() and flush() are called from the event loop thread. The writes
+     happen on a single background thread, so batches are written in the
+     order they were flushed.
+
+     Caches given the same shared list count their pieces against the
+     same budget, and are flushed together when it is reached (see also
+     full()).
+
+     notify(failed) is called on the writer thread after each batch, with
+     the indices of its pieces if it failed (an empty set if not). The
+     pieces of a failed batch are held until the owner discard()s them.
+  '''
+
+  def __init__(self, files, path, num_pieces, piece_length, budget=BUDGET, max_write=MAX_WRITE, shared=None, notify=None):
+
+    # The file pool the file is written through (see fdpool.py)
+    self.files = files
+
+    self.path = path
+    self.state_path = path + '.state'
+
+    self.num_pieces = num_pieces
+    self.piece_length = piece_length
+
+    # Flush once this many bytes of pieces are waiting (in every cache
+    # sharing the budget)
+    self.budget = budget
+    self.max_write = max_write
+
+    # The caches sharing the budget, this one included
+    self.shared = shared if shared is not None else []
+    self.shared.append(self)
+
+    # Mapping from index to data of pieces waiting to be flushed
+    self.dirty = dict()
+
+    # Mapping from index to data of pieces being written
+    self.flushing = dict()
+
+    # Size of the dirty and flushing pieces
+    self.cached = 0
+
+    # The pieces that are on disk and recorded in the state file
+    self.have = load_state(self.state_path, num_pieces)
+
+    # Guards flushing, cached and have, which the writer thread updates
+    self.lock = threading.Lock()
+
+    self.notify = notify
+
+    self.pool = ThreadPoolExecutor(max_workers=1)
+
+    # The most recently submitted batch
+    self.last = None
+
+
+  def put(self, index, data):
+    '''Cache a verified piece, flushing if the budget is reached'''
+
+    self.dirty[index] = data
+
+    with self.lock:
+      self.cached += len(data)
+
+    DIRTY_BYTES.inc(len(data))
+
+    self.relieve()
+
+
+  def full(self):
+    '''Are the pieces cached (written or not) over the budget?
+
+       Once the budget shared with other caches is used up, each cache is
+       still allowed its even share of it, so that one on a slow disk
+       cannot hold back the others.
+    '''
+
+    if sum(cache.cached for cache in self.shared) < self.budget:
+      return False
+
+    return self.cached >= self.budget / max(len(self.shared), 1)
+
+
+  def relieve(self):
+    '''Flush the caches sharing the budget if it is reached'''
+
+    if sum(cache.cached for cache in self.shared) >= self.budget:
+      for cache in self.shared:
+        cache.flush()
+
+
+  def get(self, index):
+    '''The data of a piece that has not been written yet, or None'''
+
+    data = self.dirty.get(index)
+
+    if data is None:
+      with self.lock:
+        data = self.flushing.get(index)
+
+    return data
+
+
+  def flush(self, force=False):
+    '''Start writing every cached piece, unless (and not force) the
+       last batch is still being written'''
+
+    if not self.dirty or (not force and self.last is not None and not self.last.done()):
+      return
+
+    batch, self.dirty = self.dirty, dict()
+
+    with self.lock:
+      self.flushing.update(batch)
+
+    self.last = self.pool.submit(self._write, batch)
+    self.last.add_done_callback(self._written)
+
+
+  def _write(self, batch):
+    '''Runs on the writer thread'''
+
+    started = time.perf_counter()
+
+    try:
+      # Join pieces that are next to each other into single writes
+      indices = sorted(batch)
+      run = [indices[0]]
+
+      for index in indices[1:]:
+        if index == run[-1] + 1 and (len(run) + 1) * self.piece_length <= self.max_write:
+          run.append(index)
+        else:
+          self._write_run(run, batch)
+          run = [index]
+
+      self._write_run(run, batch)
+
+      self.files.fsync(self.path)
+
+      # Only now may the pieces be recorded as ours
+      with self.lock:
+        have = self.have | set(batch)
+
+      save_state(self.state_path, have, self.num_pieces)
+
+    except Exception:
+      # The pieces are not ours. The owner decides what becomes of them.
+      if self.notify is not None:
+        self.notify(set(batch))
+      else:
+        self.discard(batch)
+      raise
+
+    with self.lock:
+      self.have.update(batch)
+
+    self.discard(batch)
+
+    FLUSHES.inc()
+    FLUSH_SECONDS.observe(time.perf_counter() - started)
+
+    if self.notify is not None:
+      self.notify(set())
+
+
+  def discard(self, indices):
+    '''Forget pieces that were being written'''
+
+    with self.lock:
+      size = sum(len(self.flushing.pop(index)) for index in indices if index in self.flushing)
+      self.cached -= size
+
+    DIRTY_BYTES.dec(size)
+
+
+  def _write_run(self, run, batch):
+    '''Write consecutive pieces with one call'''
+
+    started = time.perf_counter()
+
+    data = memoryview(b''.join(batch[index] for index in run))
+    offset = run[0] * self.piece_length
+
+    # A large write may be split
+    while data:
+      written = self.files.pwrite(self.path, data, offset)
+      data, offset = data[written:], offset + written
+
+    DISK_WRITE_SECONDS.observe(time.perf_counter() - started)
+
+
+  def _written(self, future):
+    if future.exception() is not None:
+      log.error('failed to write pieces to %s: %s', self.path, future.exception())
+
+
+  def close(self, wait=True):
+    '''Write every cached piece and stop the writer thread
+
+       Without wait, returns a future that is done once the pieces are
+       written (None if nothing was ever written).
+    '''
+
+    self.flush(force=True)
+    self.shared.remove(self)
+    self.pool.shutdown(wait=wait)
+
+    return self.last